@@ -0,0 +1,66 @@
+"""
+Content scanning: the original on_message sequence (start check, trigger
+loop, LINK_PATTERN, BAD_WORDS_RE) vs classify_content(), in messages per
+second on one core over a synthetic group-chat corpus.
+
+    python bench/bench_classifier.py [--messages N] [--triggers N]
+"""
+import argparse
+import time
+
+from corpus import make_messages, make_triggers
+
+import main
+
+
+def original_scan(text: str, triggers: dict):
+    # the scans on_message used to run over one message, in order
+    if text.strip().lower() == "start":
+        return None
+    txt = text.lower()
+    matched = None
+    for trigger_phrase in triggers:
+        if trigger_phrase and trigger_phrase.lower() in txt:
+            matched = trigger_phrase
+            break
+    link = main.LINK_PATTERN.search(text)
+    bad = main.BAD_WORDS_RE.search(text)
+    return matched, link, bad
+
+
+def unified_scan(text: str, triggers: dict):
+    if len(text) == 5 and text.lower() == "start":
+        return None
+    matcher = main.get_trigger_matcher(0, triggers) if triggers else None
+    return main.classify_content(text, matcher)
+
+
+def rate(fn, messages, triggers, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for m in messages:
+            fn(m, triggers)
+        best = min(best, time.perf_counter() - started)
+    return len(messages) / best
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--triggers", type=int, default=10)
+    args = parser.parse_args()
+    triggers = make_triggers(args.triggers)
+    messages = make_messages(args.messages, triggers=triggers)
+    for m in messages:
+        old, new = original_scan(m, triggers), unified_scan(m, triggers)
+        assert bool(old[1]) == bool(new.link) and bool(old[2]) == bool(new.profanity)
+    before = rate(original_scan, messages, triggers)
+    after = rate(unified_scan, messages, triggers)
+    print(f"{len(messages)} messages, {len(triggers)} triggers, one core")
+    print(f"original scans:   {before:>10,.0f} msgs/s")
+    print(f"classify_content: {after:>10,.0f} msgs/s  ({after / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,62 @@
+"""
+Near-duplicate detection cost: time per message for
+content_fingerprint() alone and with DuplicateTracker.observe(), and the
+share of one core that costs at --rate messages per second. Messages are
+spread over --chats chats and --users senders; --spam-share of them are
+copies of a few spam texts, so clusters and floods are exercised too.
+
+    python bench/bench_duplicates.py [--messages N] [--rate N]
+"""
+import argparse
+import random
+import time
+
+from corpus import make_messages
+
+import main
+
+SPAM = [
+    "Join our amazing crypto giveaway now and win free tokens, limited offer for the first 100 members",
+    "Earn 500 dollars a day from home, message me for details, no experience needed at all",
+]
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--spam-share", type=float, default=0.05)
+    parser.add_argument("--rate", type=int, default=10000)
+    args = parser.parse_args()
+    rng = random.Random(3)
+    texts = [
+        rng.choice(SPAM) + (" now" if rng.random() < 0.5 else "") if rng.random() < args.spam_share else m
+        for m in make_messages(args.messages)
+    ]
+    n = len(texts)
+
+    started = time.perf_counter()
+    sigs = [main.content_fingerprint(t) for t in texts]
+    sketch = (time.perf_counter() - started) / n
+
+    tracker = main.DuplicateTracker(main.DUP_WINDOW_SEC, main.DUP_USERS, main.DUP_SIMILARITY_PCT / 100.0, main.DUP_TRACK_PER_CHAT, args.chats)
+    senders = [rng.randrange(args.users) for _ in texts]
+    floods = 0
+    started = time.perf_counter()
+    for i, t in enumerate(texts):
+        sig = main.content_fingerprint(t)
+        # messages arrive at --rate per second
+        if sig is not None and tracker.observe(-(i % args.chats), senders[i], i, sig, i / args.rate) is not None:
+            floods += 1
+    total = (time.perf_counter() - started) / n
+
+    fingerprinted = sum(s is not None for s in sigs)
+    print(f"{n:,} messages, {fingerprinted:,} long enough to fingerprint, {floods:,} flagged")
+    print(f"content_fingerprint:      {sketch * 1e6:6.2f} us/msg")
+    print(f"fingerprint + observe:    {total * 1e6:6.2f} us/msg")
+    print(f"at {args.rate:,} msgs/s:       {total * args.rate * 100:6.1f} % of one core")
+
+
+if __name__ == "__main__":
+    main_()
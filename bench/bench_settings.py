@@ -0,0 +1,94 @@
+"""
+Chat-settings footprint and hot-path reads: the original 12-key settings
+dict vs ChatSettings. Memory is measured with tracemalloc over
+--chats cached entries built from realistic DB rows; reads time the three
+toggles on_message checks (anti_link, locked, spam_enabled) and spam_limit.
+
+    python bench/bench_settings.py [--chats N]
+"""
+import argparse
+import gc
+import timeit
+import tracemalloc
+
+import corpus  # noqa: F401  (puts the repo root on sys.path)
+
+import main
+
+
+def row(i: int):
+    # the SETTINGS_SELECT columns of a typical configured chat
+    return (
+        f"Welcome {{first_name}} to group {i}!" if i % 3 else None,
+        None,
+        None,
+        1,
+        "",
+        0,
+        "Be kind." if i % 2 else "",
+        "",
+        None,
+        1,
+        20,
+        None,
+        None,
+    )
+
+
+def original_dict(r):
+    # load_chat_settings before ChatSettings
+    return {
+        "welcome": r[0] or main.WELCOME_FALLBACK,
+        "welcome_photo": r[1] or None,
+        "welcome_video": r[2] or None,
+        "anti_link": bool(r[3]),
+        "sticker_triggers": {},
+        "locked": bool(r[5]),
+        "rules_text": r[6] or "",
+        "bye_text": r[7] or "",
+        "bye_photo": r[8] or None,
+        "spam_enabled": True if r[9] is None else bool(r[9]),
+        "spam_limit": int(r[10]) if r[10] is not None and str(r[10]).isdigit() else main.SPAM_MAX_MSG,
+        "spam_ban_reason": r[11] or "auto-spam-limit",
+    }
+
+
+def measure(build, n: int) -> int:
+    rows = [row(i) for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    cache = {-i: build(r) for i, r in enumerate(rows)}
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del cache
+    return used
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100_000)
+    args = parser.parse_args()
+    n = args.chats
+    before = measure(original_dict, n)
+    after = measure(lambda r: main.ChatSettings.from_row(r, None), n)
+    print(f"{n:,} cached chats")
+    print(f"dict:         {before / 2**20:7.1f} MiB  {before / n:5.0f} B/chat")
+    print(f"ChatSettings: {after / 2**20:7.1f} MiB  {after / n:5.0f} B/chat")
+
+    d, s = original_dict(row(1)), main.ChatSettings.from_row(row(1), None)
+    env = {"d": d, "s": s, "A": main.FLAG_ANTI_LINK, "L": main.FLAG_LOCKED, "S": main.FLAG_SPAM}
+    reads = {
+        "toggles, dict.get": "d.get('locked', False); d.get('anti_link', True); d.get('spam_enabled', True)",
+        "toggles, flags": "f = s.flags; f & L; f & A; f & S",
+        "spam_limit, dict.get": "d.get('spam_limit', 20)",
+        "spam_limit, slot": "s.spam_limit",
+    }
+    number = 1_000_000
+    for name, stmt in reads.items():
+        ns = min(timeit.repeat(stmt, globals=env, number=number, repeat=5)) / number * 1e9
+        print(f"{name:<22} {ns:6.1f} ns")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,66 @@
+"""
+Spam-window memory: bytes per active (chat, user) pair for the original
+message_history (defaultdict of defaultdict of deque, one timestamp each)
+vs SlidingWindowStore, measured with tracemalloc. The default of 1M pairs
+needs about 1.5 GB of RAM for the original structure; use --pairs to scale down.
+
+    python bench/bench_spam_windows.py [--pairs N] [--users-per-chat N]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+import corpus  # noqa: F401  (puts the repo root on sys.path)
+
+import main
+
+
+def pairs(n: int, users_per_chat: int):
+    for i in range(n):
+        yield -1000000 - i // users_per_chat, 1000 + i
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = build()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del keep
+    gc.collect()
+    return used
+
+
+def build_original(n: int, users_per_chat: int):
+    message_history = defaultdict(lambda: defaultdict(deque))
+    now = time.time()
+    for chat_id, user_id in pairs(n, users_per_chat):
+        message_history[user_id][chat_id].append(now)
+    return message_history
+
+
+def build_store(n: int, users_per_chat: int):
+    store = main.SlidingWindowStore(main.SPAM_WINDOW_SEC, n)
+    now = time.monotonic()
+    for key in pairs(n, users_per_chat):
+        store.hit(key, now)
+    return store
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=1_000_000)
+    parser.add_argument("--users-per-chat", type=int, default=200)
+    args = parser.parse_args()
+    before = measure(lambda: build_original(args.pairs, args.users_per_chat))
+    after = measure(lambda: build_store(args.pairs, args.users_per_chat))
+    print(f"{args.pairs:,} active (chat, user) pairs")
+    print(f"message_history:    {before / 2**20:8.1f} MiB  {before / args.pairs:6.0f} B/pair")
+    print(f"SlidingWindowStore: {after / 2**20:8.1f} MiB  {after / args.pairs:6.0f} B/pair")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,52 @@
+"""
+Sticker-trigger matching: the original per-trigger substring loop from
+on_message vs the cached TriggerMatcher, in messages per second at 10, 100
+and 1000 triggers.
+
+    python bench/bench_triggers.py [--messages N]
+"""
+import argparse
+import time
+
+from corpus import make_messages, make_triggers
+
+import main
+
+
+def loop_match(text: str, triggers: dict):
+    # on_message before the matcher
+    txt = text.lower()
+    for trigger_phrase, file_id in triggers.items():
+        if not trigger_phrase:
+            continue
+        if trigger_phrase.lower() in txt:
+            return trigger_phrase
+    return None
+
+
+def per_message_us(fn, messages) -> float:
+    started = time.perf_counter()
+    for m in messages:
+        fn(m)
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+    print(f"{'triggers':>8} {'loop us/msg':>12} {'matcher us/msg':>15} {'speedup':>8}")
+    for n in (10, 100, 1000):
+        triggers = make_triggers(n)
+        messages = make_messages(args.messages, triggers=triggers)
+        matcher = main.TriggerMatcher(triggers)
+        for m in messages:
+            # both must agree on whether anything matched
+            assert (loop_match(m, triggers) is None) == (matcher.find(m.lower()) is None)
+        loop = per_message_us(lambda m: loop_match(m, triggers), messages)
+        auto = per_message_us(lambda m: matcher.find(m.lower()), messages)
+        print(f"{n:>8} {loop:>12.2f} {auto:>15.2f} {loop / auto:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_()
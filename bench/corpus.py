@@ -0,0 +1,47 @@
+"""
+Shared synthetic inputs for the bench/ scripts. Deterministic (fixed seed) so
+runs are comparable; importing this module also puts the repo root on sys.path
+so the scripts can `import main`.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_PATH", os.devnull)
+
+WORDS = (
+    "hey guys anyone know when the next meeting is i think it was moved to friday "
+    "lol same here thanks for the update can someone share the notes from yesterday "
+    "please check the pinned message before asking good morning everyone what time "
+    "does it start the link is in the description i will be late today sorry"
+).split()
+LINKS = ["https://example.com/page", "t.me/somechannel", "bit.ly/3xYz", "youtube.com/watch?v=abc"]
+BAD = ["shit", "fuck"]
+
+
+def make_triggers(n: int, seed: int = 1) -> dict:
+    rng = random.Random(seed)
+    return {f"{rng.choice(WORDS)}{i} {rng.choice(WORDS)}": f"sticker-{i}" for i in range(n)}
+
+
+def make_messages(n: int, seed: int = 2, triggers: dict = None) -> list:
+    """
+    Group-chat-like texts: mostly 3-30 plain words, about 5% with a link,
+    2% with a bad word, and 3% containing a trigger phrase when triggers are given.
+    """
+    rng = random.Random(seed)
+    trigger_list = list(triggers or ())
+    out = []
+    for _ in range(n):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 30))]
+        roll = rng.random()
+        if roll < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(LINKS))
+        elif roll < 0.07:
+            words.insert(rng.randrange(len(words)), rng.choice(BAD))
+        elif roll < 0.10 and trigger_list:
+            words.insert(rng.randrange(len(words)), rng.choice(trigger_list))
+        text = " ".join(words)
+        out.append(text.capitalize() if rng.random() < 0.5 else text)
+    return out
@@ -1,10 +1,16 @@
 import os
+import io
+import csv
+import html
 import time
 import json
+import tempfile
 import logging
 import asyncio
-from collections import defaultdict, deque
-from typing import Dict, Deque, Optional, Tuple
+import contextlib
+import heapq
+from collections import OrderedDict, defaultdict, deque
+from typing import Dict, Hashable, List, Optional, Tuple
 from datetime import datetime
 import re
 import inspect
@@ -22,12 +28,15 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     ContextTypes,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
 )
+from telegram.error import RetryAfter
 
 # --------------------- Load .env ---------------------
 load_dotenv()
@@ -60,6 +69,183 @@ try:
     SPAM_MAX_MSG = int(os.getenv("SPAM_MAX_MSG", "20"))
 except ValueError:
     SPAM_MAX_MSG = 20
+# hard cap on tracked (chat, user) spam windows; least recently active are evicted first
+try:
+    SPAM_TRACK_MAX = int(os.getenv("SPAM_TRACK_MAX", "200000"))
+except ValueError:
+    SPAM_TRACK_MAX = 200000
+# cross-chat flood: a user who starts posting in more than CROSS_CHAT_THRESHOLD chats within
+# CROSS_CHAT_WINDOW_SEC is banned in all of them (CROSS_CHAT_ACTION=off disables the check);
+# CROSS_CHAT_BAN_CONCURRENCY of those bans run at once
+try:
+    CROSS_CHAT_THRESHOLD = int(os.getenv("CROSS_CHAT_THRESHOLD", "8"))
+except ValueError:
+    CROSS_CHAT_THRESHOLD = 8
+try:
+    CROSS_CHAT_WINDOW_SEC = int(os.getenv("CROSS_CHAT_WINDOW_SEC", "120"))
+except ValueError:
+    CROSS_CHAT_WINDOW_SEC = 120
+try:
+    CROSS_CHAT_BAN_CONCURRENCY = int(os.getenv("CROSS_CHAT_BAN_CONCURRENCY", "8"))
+except ValueError:
+    CROSS_CHAT_BAN_CONCURRENCY = 8
+CROSS_CHAT_ACTION = os.getenv("CROSS_CHAT_ACTION", "ban").lower()
+# near-duplicate floods: the same (or DUP_SIMILARITY_PCT% similar) text from DUP_USERS distinct users
+# within DUP_WINDOW_SEC is deleted; texts shorter than DUP_MIN_CHARS are ignored, DUP_USERS=0 disables
+try:
+    DUP_USERS = int(os.getenv("DUP_USERS", "3"))
+except ValueError:
+    DUP_USERS = 3
+try:
+    DUP_WINDOW_SEC = int(os.getenv("DUP_WINDOW_SEC", "300"))
+except ValueError:
+    DUP_WINDOW_SEC = 300
+try:
+    DUP_SIMILARITY_PCT = int(os.getenv("DUP_SIMILARITY_PCT", "75"))
+except ValueError:
+    DUP_SIMILARITY_PCT = 75
+try:
+    DUP_MIN_CHARS = int(os.getenv("DUP_MIN_CHARS", "24"))
+except ValueError:
+    DUP_MIN_CHARS = 24
+# fingerprints remembered per chat (least recently matched dropped first)
+try:
+    DUP_TRACK_PER_CHAT = int(os.getenv("DUP_TRACK_PER_CHAT", "256"))
+except ValueError:
+    DUP_TRACK_PER_CHAT = 256
+# shared DB connection pool (one writer + N readers)
+try:
+    DB_READERS = int(os.getenv("DB_READERS", "4"))
+except ValueError:
+    DB_READERS = 4
+try:
+    DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+except ValueError:
+    DB_CACHE_KB = 16384
+# write-behind queue: group-commit window (ms) and max buffered ops before an early flush
+try:
+    WRITE_FLUSH_MS = int(os.getenv("WRITE_FLUSH_MS", "50"))
+except ValueError:
+    WRITE_FLUSH_MS = 50
+try:
+    WRITE_FLUSH_OPS = int(os.getenv("WRITE_FLUSH_OPS", "500"))
+except ValueError:
+    WRITE_FLUSH_OPS = 500
+# settings changes are debounced this long (ms) so rapid toggles land as one UPDATE
+try:
+    SETTINGS_FLUSH_MS = int(os.getenv("SETTINGS_FLUSH_MS", "1000"))
+except ValueError:
+    SETTINGS_FLUSH_MS = 1000
+# chat settings cache: max chats held, seconds before an entry is re-read (0 = never),
+# and how many of the most recently active chats are pre-loaded at startup
+try:
+    SETTINGS_CACHE_MAX = int(os.getenv("SETTINGS_CACHE_MAX", "5000"))
+except ValueError:
+    SETTINGS_CACHE_MAX = 5000
+try:
+    SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", "0"))
+except ValueError:
+    SETTINGS_CACHE_TTL = 0
+try:
+    SETTINGS_WARM_CHATS = int(os.getenv("SETTINGS_WARM_CHATS", "1000"))
+except ValueError:
+    SETTINGS_WARM_CHATS = 1000
+# warns at which a user is banned automatically, and lock stripes serializing warn changes per user
+try:
+    WARN_BAN_LIMIT = int(os.getenv("WARN_BAN_LIMIT", "3"))
+except ValueError:
+    WARN_BAN_LIMIT = 3
+try:
+    WARN_LOCK_STRIPES = int(os.getenv("WARN_LOCK_STRIPES", "64"))
+except ValueError:
+    WARN_LOCK_STRIPES = 64
+# warns expire after this many days unless a chat sets its own window (/setwarn_decay; 0 = never)
+try:
+    WARN_DECAY_DAYS = int(os.getenv("WARN_DECAY_DAYS", "30"))
+except ValueError:
+    WARN_DECAY_DAYS = 30
+# users whose live warn timestamps are kept in memory, and how often expired warn events are purged (s)
+try:
+    WARN_CACHE_MAX = int(os.getenv("WARN_CACHE_MAX", "50000"))
+except ValueError:
+    WARN_CACHE_MAX = 50000
+try:
+    WARN_COMPACT_INTERVAL = int(os.getenv("WARN_COMPACT_INTERVAL", "3600"))
+except ValueError:
+    WARN_COMPACT_INTERVAL = 3600
+# seconds a chat's admin roster is trusted before get_chat_administrators is called again
+try:
+    ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))
+except ValueError:
+    ADMIN_CACHE_TTL = 300
+# max updates handled at once; updates from the same chat still run one at a time, in order
+try:
+    UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+except ValueError:
+    UPDATE_CONCURRENCY = 64
+# outbound Bot API pacing: global calls/s, messages per chat per minute, queued notices cap, calls in flight
+try:
+    OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+except ValueError:
+    OUTBOUND_GLOBAL_RATE = 30.0
+try:
+    OUTBOUND_CHAT_PER_MIN = float(os.getenv("OUTBOUND_CHAT_PER_MIN", "20"))
+except ValueError:
+    OUTBOUND_CHAT_PER_MIN = 20.0
+try:
+    OUTBOUND_NOTICE_MAX = int(os.getenv("OUTBOUND_NOTICE_MAX", "500"))
+except ValueError:
+    OUTBOUND_NOTICE_MAX = 500
+try:
+    OUTBOUND_MAX_INFLIGHT = int(os.getenv("OUTBOUND_MAX_INFLIGHT", "16"))
+except ValueError:
+    OUTBOUND_MAX_INFLIGHT = 16
+# background enforcement chains (ban -> record -> notice) allowed to run at once
+try:
+    SIDE_EFFECT_MAX_INFLIGHT = int(os.getenv("SIDE_EFFECT_MAX_INFLIGHT", "256"))
+except ValueError:
+    SIDE_EFFECT_MAX_INFLIGHT = 256
+# users kept in the in-memory directory (the DB keeps everyone seen)
+try:
+    USER_DIR_MAX = int(os.getenv("USER_DIR_MAX", "100000"))
+except ValueError:
+    USER_DIR_MAX = 100000
+# joins within this window (ms) of the first one share a single welcome listing up to WELCOME_MAX_NAMES names
+try:
+    WELCOME_DEBOUNCE_MS = int(os.getenv("WELCOME_DEBOUNCE_MS", "3000"))
+except ValueError:
+    WELCOME_DEBOUNCE_MS = 3000
+try:
+    WELCOME_MAX_NAMES = int(os.getenv("WELCOME_MAX_NAMES", "10"))
+except ValueError:
+    WELCOME_MAX_NAMES = 10
+# raid mode: more than RAID_JOIN_THRESHOLD joins within RAID_WINDOW_SEC locks the chat for RAID_COOLDOWN_SEC;
+# joiners during a raid cannot send messages for RAID_RESTRICT_SEC
+try:
+    RAID_JOIN_THRESHOLD = int(os.getenv("RAID_JOIN_THRESHOLD", "15"))
+except ValueError:
+    RAID_JOIN_THRESHOLD = 15
+try:
+    RAID_WINDOW_SEC = int(os.getenv("RAID_WINDOW_SEC", "60"))
+except ValueError:
+    RAID_WINDOW_SEC = 60
+try:
+    RAID_COOLDOWN_SEC = int(os.getenv("RAID_COOLDOWN_SEC", "900"))
+except ValueError:
+    RAID_COOLDOWN_SEC = 900
+try:
+    RAID_RESTRICT_SEC = int(os.getenv("RAID_RESTRICT_SEC", "86400"))
+except ValueError:
+    RAID_RESTRICT_SEC = 86400
+# unbans in flight per /unbanall job
+try:
+    UNBANALL_CONCURRENCY = int(os.getenv("UNBANALL_CONCURRENCY", "8"))
+except ValueError:
+    UNBANALL_CONCURRENCY = 8
+try:
+    BANLOG_PAGE_SIZE = int(os.getenv("BANLOG_PAGE_SIZE", "15"))
+except ValueError:
+    BANLOG_PAGE_SIZE = 15
 
 # matches many links (broad)
 LINK_PATTERN = re.compile(
@@ -86,14 +272,499 @@ BAD_WORDS = [
 # compiled whole-word regex (case-insensitive)
 BAD_WORDS_RE = re.compile(r"\b(?:" + "|".join(re.escape(w) for w in BAD_WORDS) + r")\b", re.IGNORECASE)
 
+# links and bad words in one alternation, run over already-lowercased text (see classify_content)
+CONTENT_RE = re.compile(
+    r"(?P<link>" + LINK_PATTERN.pattern + r")|(?P<bad>\b(?:" + "|".join(re.escape(w.lower()) for w in BAD_WORDS) + r")\b)"
+)
+
 
 # --------------------- Logging ---------------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --------------------- Sliding-window counters ---------------------
+class _WindowCounter:
+    __slots__ = ("start", "cur", "prev")
+
+
+class SlidingWindowStore:
+    """
+    Approximate sliding-window hit counters keyed by any hashable (e.g. (chat_id, user_id)).
+    Each entry is three slots: start of the current fixed window, hits in it, and hits
+    in the previous window; the estimate weights the previous window by how much of it
+    still overlaps the sliding one. Entries are kept in LRU order, capped at max_entries,
+    and sweep() drops the ones idle for more than a window.
+    """
+
+    entry_type = _WindowCounter
+
+    def __init__(self, window: float, max_entries: int):
+        self.window = float(window)
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Hashable, _WindowCounter]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit(self, key: Hashable, now: float) -> float:
+        """Record one hit for key at time now and return the estimated hits in the last window."""
+        entries = self._entries
+        e = entries.get(key)
+        if e is None:
+            e = self.entry_type()
+            e.start = now
+            e.cur = 0
+            e.prev = 0
+            entries[key] = e
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+        else:
+            entries.move_to_end(key)
+        window = self.window
+        elapsed = now - e.start
+        if elapsed >= window:
+            periods = int(elapsed // window)
+            e.prev = e.cur if periods == 1 else 0
+            e.cur = 0
+            e.start += periods * window
+            elapsed -= periods * window
+        e.cur += 1
+        return e.prev * (1.0 - elapsed / window) + e.cur
+
+    def sweep(self, now: float) -> int:
+        """Drop entries whose hits have all left the window; LRU order puts them at the front."""
+        entries = self._entries
+        cutoff = now - 2 * self.window
+        removed = 0
+        while entries:
+            e = next(iter(entries.values()))
+            if e.start >= cutoff:
+                break
+            entries.popitem(last=False)
+            removed += 1
+        return removed
+
+
+class _ChatSpread(_WindowCounter):
+    __slots__ = ("chats",)
+
+    def __init__(self):
+        self.chats: Dict[int, float] = {}
+
+
+class CrossChatWindows(SlidingWindowStore):
+    """
+    Per-user sliding window over chat activations: a message counts only when the user
+    had not posted in that chat during the last window, so the estimate approximates
+    how many distinct chats the user is spreading into. Each entry also remembers up to
+    max_chats of those chats (most recent last) for the action taken on a flood.
+    """
+
+    entry_type = _ChatSpread
+
+    def __init__(self, window: float, max_entries: int, max_chats: int):
+        super().__init__(window, max_entries)
+        self.max_chats = max(1, max_chats)
+
+    def activate(self, user_id: int, chat_id: int, now: float) -> float:
+        """Record a message; returns the estimated activations in the window, or 0.0 if chat_id was already active."""
+        e = self._entries.get(user_id)
+        if e is not None:
+            last = e.chats.get(chat_id)
+            if last is not None and now - last < self.window:
+                return 0.0
+        recent = self.hit(user_id, now)
+        chats = self._entries[user_id].chats
+        chats.pop(chat_id, None)
+        chats[chat_id] = now
+        if len(chats) > self.max_chats:
+            del chats[next(iter(chats))]
+        return recent
+
+    def chats_of(self, user_id: int) -> List[int]:
+        e = self._entries.get(user_id)
+        return list(e.chats) if e is not None else []
+
+    def forget(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+
+# --------------------- Chat settings cache ---------------------
+class SettingsCache:
+    """
+    chat_id -> settings map kept in LRU order and capped at max_entries.
+    lookup() is the load path: it counts hits and misses and, when ttl is set,
+    treats entries older than ttl seconds as misses so they are re-read from the DB.
+    Plain item access never expires anything, so a handler that has just loaded a
+    chat can keep indexing it. on_evict(chat_id) runs for every entry that leaves
+    the cache, whether dropped for the cap, expired by lookup() or removed by pop().
+    """
+
+    def __init__(self, max_entries: int, ttl: float = 0, on_evict=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = max(0.0, float(ttl))
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[int, ChatSettings]" = OrderedDict()
+        self._loaded_at: Dict[int, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self._entries
+
+    def __getitem__(self, chat_id: int) -> "ChatSettings":
+        s = self._entries[chat_id]
+        self._entries.move_to_end(chat_id)
+        return s
+
+    def __setitem__(self, chat_id: int, settings: "ChatSettings"):
+        entries = self._entries
+        entries[chat_id] = settings
+        entries.move_to_end(chat_id)
+        self._loaded_at[chat_id] = time.monotonic()
+        while len(entries) > self.max_entries:
+            old, _ = entries.popitem(last=False)
+            self._loaded_at.pop(old, None)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old)
+
+    def get(self, chat_id: int, default=None):
+        if chat_id not in self._entries:
+            return default
+        return self[chat_id]
+
+    def lookup(self, chat_id: int) -> Optional["ChatSettings"]:
+        s = self._entries.get(chat_id)
+        if s is not None and self.ttl and time.monotonic() - self._loaded_at.get(chat_id, 0.0) > self.ttl:
+            self.pop(chat_id)
+            s = None
+        if s is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(chat_id)
+        return s
+
+    def pop(self, chat_id: int) -> Optional["ChatSettings"]:
+        self._loaded_at.pop(chat_id, None)
+        s = self._entries.pop(chat_id, None)
+        if s is not None and self.on_evict is not None:
+            self.on_evict(chat_id)
+        return s
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
 # --------------------- In-memory runtime (temporary caches) ---------------------
-message_history: Dict[int, Dict[int, Deque[float]]] = defaultdict(lambda: defaultdict(deque))
-chat_settings_cache: Dict[int, Dict] = {}
+spam_windows = SlidingWindowStore(SPAM_WINDOW_SEC, SPAM_TRACK_MAX)
+# user_id -> chats the user started posting in recently (cross-chat flood detection)
+cross_chat_windows = CrossChatWindows(CROSS_CHAT_WINDOW_SEC, SPAM_TRACK_MAX, 4 * max(1, CROSS_CHAT_THRESHOLD))
+# an evicted chat's trigger automaton goes with it; both are rebuilt on the next load
+chat_settings_cache = SettingsCache(
+    SETTINGS_CACHE_MAX, SETTINGS_CACHE_TTL, on_evict=lambda chat_id: trigger_matchers.pop(chat_id, None)
+)
+# chat_id -> last time (epoch s) the chat was seen; flushed to chat_settings.last_seen by periodic_job
+chat_activity: Dict[int, int] = {}
+# compiled sticker-trigger automata, rebuilt only when a chat's triggers change
+trigger_matchers: Dict[int, "TriggerMatcher"] = {}
+# (chat_id, user_id) -> ascending timestamps of the user's unexpired warns, in LRU order;
+# the warn_events rows behind them are written by write_queue
+warn_history: "OrderedDict[Tuple[int, int], deque]" = OrderedDict()
+
+# --------------------- Sticker trigger matcher (Aho-Corasick) ---------------------
+class TriggerMatcher:
+    """
+    Aho-Corasick automaton over a chat's trigger phrases (matched case-insensitively).
+    find() walks the lowercased text once and returns the leftmost hit, preferring
+    the longest phrase when several start at the same position.
+    Small trigger sets skip the automaton: a handful of C-level str.find calls beats
+    a per-character Python walk until a chat has on the order of a hundred triggers.
+    """
+
+    LINEAR_MAX = 128
+
+    __slots__ = ("_goto", "_fail", "_out", "_maxlen", "_linear")
+
+    def __init__(self, phrases):
+        self._linear = None
+        keys = [k for k in phrases if k]
+        if len(keys) <= self.LINEAR_MAX:
+            self._linear = [(k, k.lower()) for k in keys]
+            self._goto = self._fail = self._out = None
+            self._maxlen = 0
+            return
+
+        goto = [{}]
+        out = [()]
+        maxlen = 0
+        for key in keys:
+            pattern = key.lower()
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(())
+                node = nxt
+            out[node] = out[node] + ((key, len(pattern)),)
+            maxlen = max(maxlen, len(pattern))
+
+        # breadth-first pass: failure links plus outputs inherited along them
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._maxlen = maxlen
+
+    def find(self, text: str) -> Optional[Tuple[str, int, int]]:
+        """Return (trigger, start, end) for the leftmost-longest hit in lowercased text, or None."""
+        if self._linear is not None:
+            return self._find_linear(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        best_key = None
+        best_start = best_len = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for key, length in out[node]:
+                start = i - length + 1
+                if best_key is None or start < best_start or (start == best_start and length > best_len):
+                    best_key, best_start, best_len = key, start, length
+            # nothing ending later can start before best_start once we are maxlen past it
+            if best_key is not None and i - best_start + 1 >= self._maxlen:
+                break
+        if best_key is None:
+            return None
+        return best_key, best_start, best_start + best_len
+
+    def _find_linear(self, text: str) -> Optional[Tuple[str, int, int]]:
+        best = None
+        for key, pattern in self._linear:
+            start = text.find(pattern)
+            if start < 0:
+                continue
+            if best is None or start < best[1] or (start == best[1] and len(pattern) > best[2] - best[1]):
+                best = (key, start, start + len(pattern))
+        return best
+
+
+# --------------------- Content classifier ---------------------
+class ContentVerdict:
+    """
+    Result of one classify_content() pass. Spans are (start, end) offsets into the
+    normalized (lowercased) text, or None when nothing was found.
+    """
+
+    __slots__ = ("link", "profanity", "trigger", "trigger_span")
+
+    def __init__(self):
+        self.link: Optional[Tuple[int, int]] = None
+        self.profanity: Optional[Tuple[int, int]] = None
+        self.trigger: Optional[str] = None
+        self.trigger_span: Optional[Tuple[int, int]] = None
+
+
+def classify_content(text: str, matcher: Optional[TriggerMatcher] = None) -> ContentVerdict:
+    """
+    Normalize text once and scan it for links, profanity and (when a matcher is
+    given) sticker triggers. Rule handling in on_message branches on the verdict
+    instead of re-running each search.
+    """
+    verdict = ContentVerdict()
+    if not text:
+        return verdict
+    norm = text.lower()
+    for m in CONTENT_RE.finditer(norm):
+        if m.lastgroup == "link":
+            if verdict.link is None:
+                verdict.link = m.span()
+        elif verdict.profanity is None:
+            verdict.profanity = m.span()
+        if verdict.link is not None and verdict.profanity is not None:
+            break
+    if matcher is not None:
+        hit = matcher.find(norm)
+        if hit:
+            verdict.trigger = hit[0]
+            verdict.trigger_span = (hit[1], hit[2])
+    return verdict
+
+
+def get_trigger_matcher(chat_id: int, triggers: Dict[str, str]) -> TriggerMatcher:
+    matcher = trigger_matchers.get(chat_id)
+    if matcher is None:
+        matcher = trigger_matchers[chat_id] = TriggerMatcher(triggers)
+    return matcher
+
+
+def rebuild_trigger_matcher(chat_id: int, triggers: Dict[str, str]):
+    trigger_matchers[chat_id] = TriggerMatcher(triggers)
+
+
+# --------------------- Near-duplicate detection ---------------------
+_WORD_RE = re.compile(r"\w+")
+# bottom-k sketch size and how many of its smallest hashes are indexed for candidate lookup
+DUP_SKETCH = 16
+DUP_INDEX_KEYS = 4
+
+
+def content_fingerprint(text: str) -> Optional[Tuple[int, ...]]:
+    """
+    Bottom-k MinHash sketch of the text's distinct words: the DUP_SKETCH smallest word
+    hashes, ascending. One tokenizing pass plus C-level hashing and sorting; None for
+    texts too short to say anything about (three words or fewer than DUP_MIN_CHARS).
+    """
+    if len(text) < DUP_MIN_CHARS:
+        return None
+    words = set(_WORD_RE.findall(text.lower()))
+    if len(words) < 3:
+        return None
+    return tuple(sorted(map(hash, words))[:DUP_SKETCH])
+
+
+def sketch_similarity(a, b: Tuple[int, ...]) -> float:
+    """
+    Jaccard similarity of two sketches (a may already be a set): exact when both texts
+    have at most DUP_SKETCH distinct words, a slight underestimate for longer ones.
+    """
+    shared = len((a if isinstance(a, set) else set(a)).intersection(b))
+    return shared / (len(a) + len(b) - shared)
+
+
+class _DupCluster:
+    __slots__ = ("sig", "started", "users", "messages", "flooded")
+
+    def __init__(self, sig: Tuple[int, ...], started: float):
+        self.sig = sig
+        self.started = started
+        self.users = set()
+        # (user_id, message_id) seen before the flood was detected; capped at one bulk delete
+        self.messages: List[Tuple[int, int]] = []
+        self.flooded = False
+
+
+class _DupChat:
+    __slots__ = ("clusters", "index", "last_seen")
+
+    def __init__(self):
+        self.clusters: "OrderedDict[_DupCluster, None]" = OrderedDict()
+        self.index: Dict[int, _DupCluster] = {}
+        self.last_seen = 0.0
+
+
+class DuplicateTracker:
+    """
+    Per-chat LRU of recent message fingerprints, grouped into clusters of near-identical
+    texts. A cluster lives for one window from its first message; once min_users distinct
+    users have posted into it, observe() hands back every message collected so far and
+    then each further match, so the caller can delete them. Candidates are found through
+    a hash index on the smallest sketch values, so a lookup is a few dict probes plus at
+    most DUP_INDEX_KEYS similarity checks.
+    """
+
+    def __init__(self, window: float, min_users: int, similarity: float, per_chat: int, max_chats: int):
+        self.window = float(window)
+        self.min_users = max(2, min_users)
+        self.similarity = similarity
+        self.per_chat = max(1, per_chat)
+        self.max_chats = max(1, max_chats)
+        self._chats: "OrderedDict[int, _DupChat]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._chats)
+
+    def observe(self, chat_id: int, user_id: int, message_id: int, sig: Tuple[int, ...], now: float) -> Optional[List[Tuple[int, int]]]:
+        """Record a message; returns (user_id, message_id) pairs to delete once its cluster is a flood, else None."""
+        chats = self._chats
+        chat = chats.get(chat_id)
+        if chat is None:
+            chat = chats[chat_id] = _DupChat()
+            if len(chats) > self.max_chats:
+                chats.popitem(last=False)
+        else:
+            chats.move_to_end(chat_id)
+        chat.last_seen = now
+
+        cluster = None
+        sig_set = checked = None
+        for h in sig[:DUP_INDEX_KEYS]:
+            c = chat.index.get(h)
+            if c is None or c is checked or now - c.started >= self.window:
+                continue
+            if c.sig == sig:
+                cluster = c
+                break
+            if sig_set is None:
+                sig_set = set(sig)
+            if sketch_similarity(sig_set, c.sig) >= self.similarity:
+                cluster = c
+                break
+            checked = c
+        if cluster is None:
+            cluster = self._add_cluster(chat, sig, now)
+        else:
+            chat.clusters.move_to_end(cluster)
+
+        if cluster.flooded:
+            return [(user_id, message_id)]
+        cluster.users.add(user_id)
+        if len(cluster.messages) < 100:
+            cluster.messages.append((user_id, message_id))
+        if len(cluster.users) < self.min_users:
+            return None
+        cluster.flooded = True
+        found, cluster.messages = cluster.messages, []
+        return found
+
+    def _add_cluster(self, chat: _DupChat, sig: Tuple[int, ...], now: float) -> _DupCluster:
+        cluster = _DupCluster(sig, now)
+        chat.clusters[cluster] = None
+        for h in sig[:DUP_INDEX_KEYS]:
+            chat.index[h] = cluster
+        while len(chat.clusters) > self.per_chat:
+            old, _ = chat.clusters.popitem(last=False)
+            for h in old.sig[:DUP_INDEX_KEYS]:
+                if chat.index.get(h) is old:
+                    del chat.index[h]
+        return cluster
+
+    def sweep(self, now: float) -> int:
+        """Drop chats with no fingerprint newer than a window; LRU order puts them at the front."""
+        chats = self._chats
+        cutoff = now - self.window
+        removed = 0
+        while chats:
+            chat = next(iter(chats.values()))
+            if chat.last_seen >= cutoff:
+                break
+            chats.popitem(last=False)
+            removed += 1
+        return removed
+
+
+dup_tracker = DuplicateTracker(DUP_WINDOW_SEC, DUP_USERS, DUP_SIMILARITY_PCT / 100.0, DUP_TRACK_PER_CHAT, SETTINGS_CACHE_MAX)
+
 
 # --------------------- Compatibility helper for ChatPermissions ---------------------
 def make_perms(**kwargs):
@@ -110,225 +781,760 @@ def make_perms(**kwargs):
         return ChatPermissions(can_send_messages=kwargs.get("can_send_messages", True))
 
 
+# --------------------- Database connection pool ---------------------
+class DBPool:
+    """
+    Long-lived aiosqlite connections shared by every DB helper.
+    One writer connection (serialized by a lock, commits on exit) and N read-only
+    reader connections handed out from a queue. All connections run in WAL mode so
+    readers never block the writer.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._reader_conns = []
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        # cached_statements is handed to sqlite3.connect: repeated SQL reuses its prepared statement
+        db = await aiosqlite.connect(self.path, cached_statements=256)
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA busy_timeout=5000")
+        if readonly:
+            await db.execute("PRAGMA query_only=1")
+        return db
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._write_lock = asyncio.Lock()
+        # writer first so the WAL switch happens before any reader attaches
+        self._writer = await self._connect(readonly=False)
+        self._idle = asyncio.Queue()
+        for _ in range(self.readers):
+            conn = await self._connect(readonly=True)
+            self._reader_conns.append(conn)
+            self._idle.put_nowait(conn)
+        logger.info("DB pool opened — 1 writer, %d readers (WAL)", self.readers)
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                try:
+                    await self._writer.rollback()
+                except Exception:
+                    logger.exception("DB rollback failed")
+                raise
+            else:
+                await self._writer.commit()
+
+    async def close(self):
+        if self._writer is None:
+            return
+        for conn in self._reader_conns:
+            try:
+                await conn.close()
+            except Exception:
+                logger.exception("Failed to close DB reader connection")
+        self._reader_conns = []
+        try:
+            await self._writer.execute("PRAGMA optimize")
+            await self._writer.commit()
+        except Exception:
+            pass
+        await self._writer.close()
+        self._writer = None
+        logger.info("DB pool closed")
+
+
+db_pool = DBPool(DB_PATH)
+
+
+# --------------------- Write-behind queue (group commit) ---------------------
+class WriteBehindQueue:
+    """
+    Buffers warn events, ban records and mute upserts and writes them in a single
+    transaction (one executemany per table) every WRITE_FLUSH_MS, or sooner once
+    WRITE_FLUSH_OPS operations are pending. Warn events are appended; ban and mute
+    entries are keyed by (chat_id, user_id), so the latest operation for a user
+    wins, and a value of None means "delete the row".
+
+    Chat settings columns are merged per chat and held for SETTINGS_FLUSH_MS
+    after the first change, so a burst of toggles becomes one UPDATE.
+    """
+
+    def __init__(
+        self,
+        pool: DBPool,
+        interval_ms: int = WRITE_FLUSH_MS,
+        max_ops: int = WRITE_FLUSH_OPS,
+        settings_delay_ms: int = SETTINGS_FLUSH_MS,
+    ):
+        self.pool = pool
+        self.interval = max(1, interval_ms) / 1000.0
+        self.max_ops = max(1, max_ops)
+        self.settings_delay = max(0, settings_delay_ms) / 1000.0
+        self._warn_events: Dict[Tuple[int, int], List[Tuple[str, str, int]]] = {}
+        # (chat_id, user_id) whose stored warn events are deleted ahead of this batch's inserts
+        self._warn_clears: set = set()
+        self._bans: Dict[Tuple[int, int], Optional[tuple]] = {}
+        self._mutes: Dict[Tuple[int, int], Optional[int]] = {}
+        self._settings: Dict[int, Dict[str, object]] = {}
+        self._settings_timer: Optional[asyncio.TimerHandle] = None
+        self._settings_due = False
+        self._ops = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    def _touch(self):
+        self._ops += 1
+        if self._wakeup is None:
+            return
+        self._wakeup.set()
+        if self._ops >= self.max_ops:
+            self._full.set()
+
+    def put_warn_event(self, chat_id: int, user_id: int, reason: str, source: str, ts: int):
+        self._warn_events.setdefault((chat_id, user_id), []).append((reason, source, ts))
+        self._touch()
+
+    def has_pending_warns(self, chat_id: int, user_id: int) -> bool:
+        key = (chat_id, user_id)
+        return key in self._warn_events or key in self._warn_clears
+
+    def clear_warns(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        self._warn_events.pop(key, None)
+        self._warn_clears.add(key)
+        self._touch()
+
+    def put_ban(self, chat_id: int, user_id: int, row: tuple):
+        self._bans[(chat_id, user_id)] = row
+        self._touch()
+
+    def delete_ban(self, chat_id: int, user_id: int):
+        self._bans[(chat_id, user_id)] = None
+        self._touch()
+
+    def put_mute(self, chat_id: int, user_id: int, until_ts: Optional[int]):
+        self._mutes[(chat_id, user_id)] = until_ts
+        self._touch()
+
+    def pending_mute(self, chat_id: int, user_id: int) -> Tuple[bool, Optional[int]]:
+        key = (chat_id, user_id)
+        if key in self._mutes:
+            return True, self._mutes[key]
+        return False, None
+
+    def put_settings(self, chat_id: int, columns: Dict[str, object]):
+        self._settings.setdefault(chat_id, {}).update(columns)
+        if self._wakeup is None or self._settings_timer is not None:
+            return
+        self._settings_timer = asyncio.get_running_loop().call_later(self.settings_delay, self._release_settings)
+
+    def has_pending_settings(self, chat_id: int) -> bool:
+        return chat_id in self._settings
+
+    def _release_settings(self):
+        self._settings_timer = None
+        self._settings_due = True
+        self._wakeup.set()
+        self._full.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Write-behind flush failed")
+
+    async def flush(self, force: bool = False):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            take_settings = bool(self._settings) and (force or self._settings_due)
+            if not (self._warn_events or self._warn_clears or self._bans or self._mutes or take_settings):
+                return
+            warn_events, warn_clears, bans, mutes = self._warn_events, self._warn_clears, self._bans, self._mutes
+            self._warn_events, self._warn_clears, self._bans, self._mutes = {}, set(), {}, {}
+            settings: Dict[int, Dict[str, object]] = {}
+            if take_settings:
+                settings, self._settings, self._settings_due = self._settings, {}, False
+            self._ops = 0
+            try:
+                async with self.pool.write() as db:
+                    if warn_clears:
+                        await db.executemany("DELETE FROM warn_events WHERE chat_id=? AND user_id=?", list(warn_clears))
+                    if warn_events:
+                        await db.executemany(
+                            "INSERT INTO warn_events (chat_id,user_id,reason,source,ts) VALUES(?,?,?,?,?)",
+                            [(c, u, *ev) for (c, u), evs in warn_events.items() for ev in evs],
+                        )
+                    ban_deletes = [k for k, row in bans.items() if row is None]
+                    ban_rows = [row for row in bans.values() if row is not None]
+                    if ban_deletes:
+                        await db.executemany("DELETE FROM bans WHERE chat_id=? AND user_id=?", ban_deletes)
+                    if ban_rows:
+                        await db.executemany(
+                            "REPLACE INTO bans (chat_id,user_id,username,mod_id,reason,banned_at) VALUES(?,?,?,?,?,?)",
+                            ban_rows,
+                        )
+                    mute_deletes = [k for k, until_ts in mutes.items() if until_ts is None]
+                    mute_rows = [(c, u, t) for (c, u), t in mutes.items() if t is not None]
+                    if mute_deletes:
+                        await db.executemany("DELETE FROM mutes WHERE chat_id=? AND user_id=?", mute_deletes)
+                    if mute_rows:
+                        await db.executemany("REPLACE INTO mutes(chat_id,user_id,until_ts) VALUES(?,?,?)", mute_rows)
+                    # one statement per distinct column set, touching only the changed columns
+                    by_cols: Dict[Tuple[str, ...], List[tuple]] = {}
+                    for chat_id, cols in settings.items():
+                        names = tuple(sorted(cols))
+                        by_cols.setdefault(names, []).append((chat_id, *(cols[n] for n in names)))
+                    for names, rows in by_cols.items():
+                        await db.executemany(
+                            f"INSERT INTO chat_settings (chat_id,{','.join(names)}) VALUES(?{',?' * len(names)}) "
+                            f"ON CONFLICT(chat_id) DO UPDATE SET {','.join(f'{n}=excluded.{n}' for n in names)}",
+                            rows,
+                        )
+            except Exception:
+                # keep the batch for the next flush; anything queued meanwhile is newer and wins
+                # a clear queued meanwhile already dropped the events it supersedes
+                for k, evs in warn_events.items():
+                    if k not in self._warn_clears:
+                        self._warn_events[k] = evs + self._warn_events.get(k, [])
+                self._warn_clears |= warn_clears
+                for k, v in bans.items():
+                    self._bans.setdefault(k, v)
+                for k, v in mutes.items():
+                    self._mutes.setdefault(k, v)
+                for chat_id, cols in settings.items():
+                    merged = dict(cols)
+                    merged.update(self._settings.get(chat_id, {}))
+                    self._settings[chat_id] = merged
+                if settings:
+                    self._settings_due = True
+                self._ops = len(self._warn_events) + len(self._warn_clears) + len(self._bans) + len(self._mutes)
+                raise
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._settings_timer is not None:
+            self._settings_timer.cancel()
+            self._settings_timer = None
+        await self.flush(force=True)
+
+
+write_queue = WriteBehindQueue(db_pool)
+
+
 # --------------------- Database helpers & migration ---------------------
-async def migrate_bans_table(db):
-    try:
-        cur = await db.execute("PRAGMA table_info(bans)")
-        cols = await cur.fetchall()
-        colnames = [c[1] for c in cols]
-        if "mod_id" not in colnames:
-            await db.execute("ALTER TABLE bans ADD COLUMN mod_id INTEGER DEFAULT 0")
-            logger.info("Migrated bans table: added column 'mod_id'")
-        if "reason" not in colnames:
-            await db.execute("ALTER TABLE bans ADD COLUMN reason TEXT DEFAULT ''")
-            logger.info("Migrated bans table: added column 'reason'")
-    except Exception as e:
-        logger.warning("migrate_bans_table failed: %s", e)
+async def _add_column(db, table: str, column: str, decl: str):
+    """ALTER TABLE ... ADD COLUMN unless the column is already there (databases created before versioning)."""
+    async with db.execute(f"PRAGMA table_info({table})") as cur:
+        colnames = [c[1] for c in await cur.fetchall()]
+    if column not in colnames:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        logger.info("Migrated %s: added column '%s'", table, column)
 
 
-async def migrate_chat_settings_table(db):
+async def _migrate_base_tables(db):
     """
-    Add fields 'sticker_triggers' (JSON), 'locked' (INTEGER), 'rules_text', 'bye_text', 'bye_photo' if missing,
-    ensure 'anti_link' exists, and add spam-specific fields: spam_enabled, spam_limit, spam_ban_reason.
+    Baseline schema. Databases that predate versioning may hold any older shape of
+    these tables, so the tables are created if missing and late-added columns are backfilled.
     """
-    try:
-        cur = await db.execute("PRAGMA table_info(chat_settings)")
-        cols = await cur.fetchall()
-        colnames = [c[1] for c in cols]
-        if "sticker_triggers" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN sticker_triggers TEXT DEFAULT ''")
-            logger.info("Migrated chat_settings: added column 'sticker_triggers'")
-        if "locked" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN locked INTEGER DEFAULT 0")
-            logger.info("Migrated chat_settings: added column 'locked'")
-        if "rules_text" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN rules_text TEXT DEFAULT ''")
-            logger.info("Migrated chat_settings: added column 'rules_text'")
-        if "bye_text" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN bye_text TEXT DEFAULT ''")
-            logger.info("Migrated chat_settings: added column 'bye_text'")
-        if "bye_photo" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN bye_photo TEXT DEFAULT ''")
-            logger.info("Migrated chat_settings: added column 'bye_photo'")
-        if "anti_link" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN anti_link INTEGER DEFAULT 1")
-            logger.info("Migrated chat_settings: added column 'anti_link'")
-
-        # New spam-related columns
-        if "spam_enabled" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN spam_enabled INTEGER DEFAULT 1")
-            logger.info("Migrated chat_settings: added column 'spam_enabled'")
-        if "spam_limit" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN spam_limit INTEGER DEFAULT 20")
-            logger.info("Migrated chat_settings: added column 'spam_limit'")
-        if "spam_ban_reason" not in colnames:
-            await db.execute("ALTER TABLE chat_settings ADD COLUMN spam_ban_reason TEXT DEFAULT 'auto-spam-limit'")
-            logger.info("Migrated chat_settings: added column 'spam_ban_reason'")
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS warns (
+           chat_id INTEGER, user_id INTEGER, warns INTEGER,
+           PRIMARY KEY (chat_id, user_id))"""
+    )
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS mutes (
+           chat_id INTEGER, user_id INTEGER, until_ts INTEGER,
+           PRIMARY KEY (chat_id, user_id))"""
+    )
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS bans (
+           chat_id INTEGER,
+           user_id INTEGER,
+           username TEXT,
+           mod_id INTEGER DEFAULT 0,
+           reason TEXT DEFAULT '',
+           banned_at INTEGER,
+           PRIMARY KEY (chat_id, user_id)
+        )"""
+    )
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS chat_settings (
+           chat_id INTEGER PRIMARY KEY,
+           welcome_text TEXT,
+           welcome_photo TEXT,
+           welcome_video TEXT,
+           anti_link INTEGER DEFAULT 1,
+           sticker_triggers TEXT DEFAULT '',
+           locked INTEGER DEFAULT 0,
+           rules_text TEXT DEFAULT '',
+           bye_text TEXT DEFAULT '',
+           bye_photo TEXT DEFAULT '',
+           spam_enabled INTEGER DEFAULT 1,
+           spam_limit INTEGER DEFAULT 20,
+           spam_ban_reason TEXT DEFAULT 'auto-spam-limit'
+        )"""
+    )
+    await _add_column(db, "bans", "mod_id", "INTEGER DEFAULT 0")
+    await _add_column(db, "bans", "reason", "TEXT DEFAULT ''")
+    await _add_column(db, "chat_settings", "sticker_triggers", "TEXT DEFAULT ''")
+    await _add_column(db, "chat_settings", "locked", "INTEGER DEFAULT 0")
+    await _add_column(db, "chat_settings", "rules_text", "TEXT DEFAULT ''")
+    await _add_column(db, "chat_settings", "bye_text", "TEXT DEFAULT ''")
+    await _add_column(db, "chat_settings", "bye_photo", "TEXT DEFAULT ''")
+    await _add_column(db, "chat_settings", "anti_link", "INTEGER DEFAULT 1")
+    await _add_column(db, "chat_settings", "spam_enabled", "INTEGER DEFAULT 1")
+    await _add_column(db, "chat_settings", "spam_limit", "INTEGER DEFAULT 20")
+    await _add_column(db, "chat_settings", "spam_ban_reason", "TEXT DEFAULT 'auto-spam-limit'")
+
+
+async def _migrate_mute_expiry_index(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_mutes_until ON mutes(until_ts)")
+
+
+async def _migrate_ban_log_and_unban_jobs(db):
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_bans_chat_banned_at ON bans(chat_id, banned_at, user_id)")
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS unban_jobs (
+           chat_id INTEGER PRIMARY KEY,
+           cursor INTEGER DEFAULT 0,
+           done INTEGER DEFAULT 0,
+           failed INTEGER DEFAULT 0,
+           total INTEGER DEFAULT 0,
+           progress_chat_id INTEGER,
+           progress_message_id INTEGER,
+           started_at INTEGER
+        )"""
+    )
 
-    except Exception as e:
-        logger.warning("migrate_chat_settings_table failed: %s", e)
+
+async def _migrate_sticker_triggers_table(db):
+    await db.execute(
+        """CREATE TABLE IF NOT EXISTS chat_sticker_triggers (
+           chat_id INTEGER,
+           trigger TEXT,
+           file_id TEXT,
+           PRIMARY KEY (chat_id, trigger)
+        )"""
+    )
+
+
+async def _migrate_chat_last_seen(db):
+    await _add_column(db, "chat_settings", "last_seen", "INTEGER DEFAULT 0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_chat_settings_last_seen ON chat_settings(last_seen)")
+
+
+async def _migrate_warn_events(db):
+    """Replace the warns counter table with an append-only ledger; NULL warn_decay_days means WARN_DECAY_DAYS."""
+    await db.execute(
+        """CREATE TABLE warn_events (
+           id INTEGER PRIMARY KEY,
+           chat_id INTEGER NOT NULL,
+           user_id INTEGER NOT NULL,
+           reason TEXT DEFAULT '',
+           source TEXT DEFAULT '',
+           ts INTEGER NOT NULL
+        )"""
+    )
+    await db.execute("CREATE INDEX idx_warn_events_user_ts ON warn_events(chat_id, user_id, ts)")
+    await db.execute("CREATE INDEX idx_warn_events_chat_ts ON warn_events(chat_id, ts)")
+    await _add_column(db, "chat_settings", "warn_decay_days", "INTEGER")
+    # existing counters become events stamped now, so they start decaying from the upgrade
+    await db.execute(
+        """WITH RECURSIVE n(i) AS (
+               SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < (SELECT COALESCE(MAX(warns), 0) FROM warns)
+           )
+           INSERT INTO warn_events (chat_id, user_id, reason, source, ts)
+           SELECT w.chat_id, w.user_id, '', 'migrated', CAST(strftime('%s', 'now') AS INTEGER)
+           FROM warns w JOIN n ON n.i <= w.warns"""
+    )
+    await db.execute("DROP TABLE warns")
+
+
+async def _migrate_user_directory(db):
+    await db.execute(
+        """CREATE TABLE users (
+           user_id INTEGER PRIMARY KEY,
+           username TEXT,
+           first_name TEXT,
+           last_seen INTEGER
+        )"""
+    )
+    await db.execute("CREATE INDEX idx_users_username ON users(username COLLATE NOCASE)")
+    await db.execute(
+        """CREATE TABLE user_chats (
+           user_id INTEGER,
+           chat_id INTEGER,
+           last_seen INTEGER,
+           PRIMARY KEY (user_id, chat_id)
+        ) WITHOUT ROWID"""
+    )
+
+
+async def _migrate_raid_state(db):
+    await _add_column(db, "chat_settings", "raid_until", "INTEGER DEFAULT 0")
+    await _add_column(db, "chat_settings", "raid_locked", "INTEGER DEFAULT 0")
+    await db.execute("CREATE INDEX idx_chat_settings_raid ON chat_settings(raid_until) WHERE raid_until > 0")
+
+
+# Ordered schema steps; step i brings the database to PRAGMA user_version i+1.
+# Append only — never reorder or edit a step that has shipped.
+# The first steps are idempotent because they also run on databases created before versioning.
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_mute_expiry_index,
+    _migrate_ban_log_and_unban_jobs,
+    _migrate_sticker_triggers_table,
+    _migrate_chat_last_seen,
+    _migrate_warn_events,
+    _migrate_user_directory,
+    _migrate_raid_state,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def migrate_schema():
+    """
+    Bring the schema up to SCHEMA_VERSION. A current database costs one PRAGMA read;
+    otherwise every pending step runs in a single transaction together with the
+    version bump, so a failure leaves the database as it was and is raised to the caller.
+    """
+    async with db_pool.read() as db:
+        async with db.execute("PRAGMA user_version") as cur:
+            (version,) = await cur.fetchone()
+    if version == SCHEMA_VERSION:
+        return
+    async with db_pool.write() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("PRAGMA user_version") as cur:
+            (version,) = await cur.fetchone()
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema v{version} is newer than this bot (v{SCHEMA_VERSION})")
+        for step in range(version, SCHEMA_VERSION):
+            logger.info("Applying schema migration %d: %s", step + 1, MIGRATIONS[step].__name__)
+            await MIGRATIONS[step](db)
+        await db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    logger.info("DB schema migrated v%d -> v%d", version, SCHEMA_VERSION)
 
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """CREATE TABLE IF NOT EXISTS warns (
-               chat_id INTEGER, user_id INTEGER, warns INTEGER,
-               PRIMARY KEY (chat_id, user_id))"""
-        )
-        await db.execute(
-            """CREATE TABLE IF NOT EXISTS mutes (
-               chat_id INTEGER, user_id INTEGER, until_ts INTEGER,
-               PRIMARY KEY (chat_id, user_id))"""
-        )
-        await db.execute(
-            """CREATE TABLE IF NOT EXISTS bans (
-               chat_id INTEGER,
-               user_id INTEGER,
-               username TEXT,
-               mod_id INTEGER DEFAULT 0,
-               reason TEXT DEFAULT '',
-               banned_at INTEGER,
-               PRIMARY KEY (chat_id, user_id)
-            )"""
-        )
-        await db.execute(
-           """CREATE TABLE IF NOT EXISTS chat_settings (
-       chat_id INTEGER PRIMARY KEY,
-       welcome_text TEXT,
-       welcome_photo TEXT,
-       welcome_video TEXT,
-       anti_link INTEGER DEFAULT 1,
-       sticker_triggers TEXT DEFAULT '',
-       locked INTEGER DEFAULT 0,
-       rules_text TEXT DEFAULT '',
-       bye_text TEXT DEFAULT '',
-       bye_photo TEXT DEFAULT '',
-       spam_enabled INTEGER DEFAULT 1,
-       spam_limit INTEGER DEFAULT 20,
-       spam_ban_reason TEXT DEFAULT 'auto-spam-limit'
-    )"""
+    await db_pool.open()
+    await migrate_schema()
+    logger.info("DB ready (schema v%d) — %s", SCHEMA_VERSION, DB_PATH)
+
+
+async def close_db():
+    await db_pool.close()
+
+
+# ---------- chat settings persistence ----------
+DEFAULT_SPAM_BAN_REASON = "auto-spam-limit"
+# settings key -> (chat_settings column, encoder for the stored value)
+SETTINGS_COLUMNS = {
+    "welcome": ("welcome_text", lambda v: v or WELCOME_FALLBACK),
+    "welcome_photo": ("welcome_photo", lambda v: v or ""),
+    "welcome_video": ("welcome_video", lambda v: v or ""),
+    "anti_link": ("anti_link", lambda v: 1 if v else 0),
+    "locked": ("locked", lambda v: 1 if v else 0),
+    "rules_text": ("rules_text", lambda v: v or ""),
+    "bye_text": ("bye_text", lambda v: v or ""),
+    "bye_photo": ("bye_photo", lambda v: v or ""),
+    "spam_enabled": ("spam_enabled", lambda v: 1 if v else 0),
+    "spam_limit": ("spam_limit", int),
+    "spam_ban_reason": ("spam_ban_reason", lambda v: v or DEFAULT_SPAM_BAN_REASON),
+    "warn_decay_days": ("warn_decay_days", int),
+}
+
+
+# ChatSettings.flags bits
+FLAG_ANTI_LINK = 1
+FLAG_LOCKED = 2
+FLAG_SPAM = 4
+
+
+def _shared_str(value: Optional[str], default: str) -> str:
+    """Reuse the module-level default string instead of keeping a per-chat copy of it."""
+    if not value or value == default:
+        return default
+    return value
+
+
+class ChatSettings:
+    """
+    One chat's settings. Fixed slots and a single int for the on/off toggles keep
+    an entry around 150 bytes; defaults match a chat that has never been configured.
+    Assigning any persisted setting records it in `dirty`, and save_chat_settings
+    writes only those columns. sticker_triggers lives in its own table and is None
+    when the chat has none.
+    """
+
+    __slots__ = (
+        "flags",
+        "welcome",
+        "welcome_photo",
+        "welcome_video",
+        "rules_text",
+        "bye_text",
+        "bye_photo",
+        "spam_limit",
+        "spam_ban_reason",
+        "sticker_triggers",
+        "warn_decay_days",
+        "dirty",
+    )
+
+    def __init__(self):
+        init = object.__setattr__
+        init(self, "flags", FLAG_ANTI_LINK | FLAG_SPAM)
+        init(self, "welcome", WELCOME_FALLBACK)
+        init(self, "welcome_photo", None)
+        init(self, "welcome_video", None)
+        init(self, "rules_text", "")
+        init(self, "bye_text", "")
+        init(self, "bye_photo", None)
+        init(self, "spam_limit", SPAM_MAX_MSG)
+        init(self, "spam_ban_reason", DEFAULT_SPAM_BAN_REASON)
+        init(self, "sticker_triggers", None)
+        init(self, "warn_decay_days", WARN_DECAY_DAYS)
+        init(self, "dirty", None)
+
+    @classmethod
+    def from_row(cls, row, triggers: Optional[Dict[str, str]]) -> "ChatSettings":
+        """Build from a SETTINGS_SELECT row without marking anything dirty."""
+        (
+            welcome_text,
+            welcome_photo,
+            welcome_video,
+            anti_link,
+            _legacy_triggers,
+            locked,
+            rules_text,
+            bye_text,
+            bye_photo,
+            spam_enabled,
+            spam_limit,
+            spam_ban_reason,
+            warn_decay_days,
+        ) = row
+        flags = 0
+        if anti_link:
+            flags |= FLAG_ANTI_LINK
+        if locked:
+            flags |= FLAG_LOCKED
+        if spam_enabled is None or spam_enabled:
+            flags |= FLAG_SPAM
+        self = cls.__new__(cls)
+        init = object.__setattr__
+        init(self, "flags", flags)
+        init(self, "welcome", _shared_str(welcome_text, WELCOME_FALLBACK))
+        init(self, "welcome_photo", welcome_photo or None)
+        init(self, "welcome_video", welcome_video or None)
+        init(self, "rules_text", rules_text or "")
+        init(self, "bye_text", bye_text or "")
+        init(self, "bye_photo", bye_photo or None)
+        init(
+            self,
+            "spam_limit",
+            int(spam_limit) if spam_limit is not None and str(spam_limit).isdigit() else SPAM_MAX_MSG,
         )
-        await db.commit()
+        init(self, "spam_ban_reason", _shared_str(spam_ban_reason, DEFAULT_SPAM_BAN_REASON))
+        init(self, "sticker_triggers", triggers or None)
+        init(self, "warn_decay_days", WARN_DECAY_DAYS if warn_decay_days is None else int(warn_decay_days))
+        init(self, "dirty", None)
+        return self
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in SETTINGS_COLUMNS:
+            if self.dirty is None:
+                object.__setattr__(self, "dirty", set())
+            self.dirty.add(name)
+
+    def _flag(bit):
+        def get(self) -> bool:
+            return bool(self.flags & bit)
 
-        await migrate_bans_table(db)
-        await migrate_chat_settings_table(db)
-        await db.commit()
+        def set_(self, on: bool):
+            object.__setattr__(self, "flags", self.flags | bit if on else self.flags & ~bit)
 
-    logger.info("DB initialized and migrated (if necessary) — %s", DB_PATH)
+        return property(get, set_)
 
+    anti_link = _flag(FLAG_ANTI_LINK)
+    locked = _flag(FLAG_LOCKED)
+    spam_enabled = _flag(FLAG_SPAM)
+    del _flag
 
-async def get_bans_for_chat(chat_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    def take_dirty(self) -> Dict[str, object]:
+        if not self.dirty:
+            return {}
+        cols = {}
+        for key in self.dirty:
+            column, encode = SETTINGS_COLUMNS[key]
+            cols[column] = encode(getattr(self, key))
+        object.__setattr__(self, "dirty", None)
+        return cols
+
+
+# read-only stand-in for chats whose settings are not cached
+DEFAULT_SETTINGS = ChatSettings()
+
+
+async def _load_sticker_triggers(chat_id: int, legacy_blob: Optional[str]) -> Dict[str, str]:
+    """
+    Read a chat's triggers from chat_sticker_triggers. A leftover JSON blob in
+    chat_settings.sticker_triggers is moved into the table first (once per chat).
+    """
+    if legacy_blob and legacy_blob != "{}":
         try:
-            cur = await db.execute(
-                "SELECT user_id,username,mod_id,reason,banned_at FROM bans WHERE chat_id=?", (chat_id,)
-            )
-            rows = await cur.fetchall()
-            return rows
-        except Exception as e:
-            logger.warning("get_bans_for_chat primary query failed, falling back: %s", e)
-            try:
-                cur = await db.execute("SELECT user_id,username,banned_at FROM bans WHERE chat_id=?", (chat_id,))
-                rows = await cur.fetchall()
-                padded = []
-                for r in rows:
-                    user_id = r[0]
-                    username = r[1] if len(r) > 1 else ""
-                    banned_at = r[2] if len(r) > 2 else 0
-                    padded.append((user_id, username, 0, "", banned_at))
-                return padded
-            except Exception as e2:
-                logger.error("get_bans_for_chat fallback query also failed: %s", e2)
-                return []
+            legacy = json.loads(legacy_blob) or {}
+        except Exception:
+            legacy = {}
+        async with db_pool.write() as db:
+            if legacy:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO chat_sticker_triggers (chat_id,trigger,file_id) VALUES(?,?,?)",
+                    [(chat_id, t, f) for t, f in legacy.items() if t and f],
+                )
+            await db.execute("UPDATE chat_settings SET sticker_triggers='' WHERE chat_id=?", (chat_id,))
+        logger.info("Migrated %d sticker triggers for chat %s to chat_sticker_triggers", len(legacy), chat_id)
+    async with db_pool.read() as db:
+        rows = await db.execute_fetchall("SELECT trigger,file_id FROM chat_sticker_triggers WHERE chat_id=?", (chat_id,))
+    return {t: f for t, f in rows}
 
 
-# ---------- chat settings persistence ----------
-async def load_chat_settings(chat_id: int) -> Dict:
-    if chat_id in chat_settings_cache:
-        return chat_settings_cache[chat_id]
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT welcome_text, welcome_photo, welcome_video, anti_link, sticker_triggers, locked, rules_text, bye_text, bye_photo, spam_enabled, spam_limit, spam_ban_reason FROM chat_settings WHERE chat_id=?",
-            (chat_id,),
+async def add_sticker_trigger(chat_id: int, trigger: str, file_id: str):
+    async with db_pool.write() as db:
+        await db.execute(
+            "REPLACE INTO chat_sticker_triggers (chat_id,trigger,file_id) VALUES(?,?,?)", (chat_id, trigger, file_id)
         )
-        row = await cur.fetchone()
-        if row:
-            (
-                welcome_text,
-                welcome_photo,
-                welcome_video,
-                anti_link,
-                sticker_triggers,
-                locked,
-                rules_text,
-                bye_text,
-                bye_photo,
-                spam_enabled,
-                spam_limit,
-                spam_ban_reason,
-            ) = row
-            try:
-                triggers = json.loads(sticker_triggers) if sticker_triggers else {}
-            except Exception:
-                triggers = {}
-            settings = {
-                "welcome": welcome_text or WELCOME_FALLBACK,
-                "welcome_photo": welcome_photo or None,
-                "welcome_video": welcome_video or None,
-                "anti_link": bool(anti_link),
-                "sticker_triggers": triggers or {},
-                "locked": bool(locked),
-                "rules_text": rules_text or "",
-                "bye_text": bye_text or "",
-                "bye_photo": bye_photo or None,
-                "spam_enabled": True if spam_enabled is None else bool(spam_enabled),
-                "spam_limit": int(spam_limit) if spam_limit is not None and str(spam_limit).isdigit() else SPAM_MAX_MSG,
-                "spam_ban_reason": spam_ban_reason or "auto-spam-limit",
-            }
-        else:
-            settings = {
-                "welcome": WELCOME_FALLBACK,
-                "welcome_photo": None,
-                "welcome_video": None,
-                "anti_link": True,
-                "sticker_triggers": {},
-                "locked": False,
-                "rules_text": "",
-                "bye_text": "",
-                "bye_photo": None,
-                "spam_enabled": True,
-                "spam_limit": SPAM_MAX_MSG,
-                "spam_ban_reason": "auto-spam-limit",
-            }
+
+
+async def remove_sticker_trigger(chat_id: int, trigger: str):
+    async with db_pool.write() as db:
+        await db.execute("DELETE FROM chat_sticker_triggers WHERE chat_id=? AND trigger=?", (chat_id, trigger))
+
+
+SETTINGS_SELECT = (
+    "welcome_text, welcome_photo, welcome_video, anti_link, sticker_triggers, locked, "
+    "rules_text, bye_text, bye_photo, spam_enabled, spam_limit, spam_ban_reason, warn_decay_days"
+)
+
+
+async def load_chat_settings(chat_id: int) -> ChatSettings:
+    chat_activity[chat_id] = int(time.time())
+    cached = chat_settings_cache.lookup(chat_id)
+    if cached is not None:
+        return cached
+    # an entry evicted (or expired) with changes still debounced must not be re-read stale
+    if write_queue.has_pending_settings(chat_id):
+        await write_queue.flush(force=True)
+    async with db_pool.read() as db:
+        async with db.execute(f"SELECT {SETTINGS_SELECT} FROM chat_settings WHERE chat_id=?", (chat_id,)) as cur:
+            row = await cur.fetchone()
+    if row:
+        triggers = await _load_sticker_triggers(chat_id, row[4])
+        settings = ChatSettings.from_row(row, triggers)
+    else:
+        settings = ChatSettings()
+        async with db_pool.write() as db:
             await db.execute(
                 "INSERT OR IGNORE INTO chat_settings (chat_id,welcome_text,anti_link,sticker_triggers,locked,rules_text,bye_text,bye_photo,spam_enabled,spam_limit,spam_ban_reason) VALUES(?,?,?,?,?,?,?,?,?,?,?)",
-                (chat_id, settings["welcome"], 1, "{}", 0, "", "", "", 1, SPAM_MAX_MSG, "auto-spam-limit"),
+                (chat_id, settings.welcome, 1, "", 0, "", "", "", 1, SPAM_MAX_MSG, DEFAULT_SPAM_BAN_REASON),
             )
-            await db.commit()
+    # another handler may have filled the cache while we awaited the DB
+    if chat_id in chat_settings_cache:
+        return chat_settings_cache[chat_id]
     chat_settings_cache[chat_id] = settings
     return settings
 
 
-async def save_chat_settings(chat_id: int):
-    s = chat_settings_cache.get(chat_id)
-    if s is None:
-        return
-    welcome_text = s.get("welcome", WELCOME_FALLBACK)
-    welcome_photo = s.get("welcome_photo") or ""
-    welcome_video = s.get("welcome_video") or ""
-    anti_link = 1 if s.get("anti_link", True) else 0
-    triggers_json = json.dumps(s.get("sticker_triggers", {}))
-    locked = 1 if s.get("locked", False) else 0
-    rules_text = s.get("rules_text", "") or ""
-    bye_text = s.get("bye_text", "") or ""
-    bye_photo = s.get("bye_photo") or ""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "REPLACE INTO chat_settings (chat_id,welcome_text,welcome_photo,welcome_video,anti_link,sticker_triggers,locked,rules_text,bye_text,bye_photo) VALUES(?,?,?,?,?,?,?,?,?,?)",
-            (chat_id, welcome_text, welcome_photo, welcome_video, anti_link, triggers_json, locked, rules_text, bye_text, bye_photo),
+async def save_chat_settings(chat_id: int, settings: ChatSettings):
+    """
+    Queue the columns changed on settings since its last save; the write is debounced
+    by write_queue. Callers pass the object they changed rather than having it looked
+    up again, since the cache may have evicted or reloaded the chat in between.
+    """
+    cols = settings.take_dirty()
+    if cols:
+        write_queue.put_settings(chat_id, cols)
+
+
+async def warm_chat_settings(limit: int = SETTINGS_WARM_CHATS) -> int:
+    """
+    Pre-load settings for the most recently active chats with one query for the
+    settings rows and one for their triggers. Chats still holding a legacy JSON
+    trigger blob are left to the lazy path, which migrates them.
+    """
+    limit = min(limit, chat_settings_cache.max_entries)
+    if limit <= 0:
+        return 0
+    async with db_pool.read() as db:
+        rows = await db.execute_fetchall(
+            f"SELECT chat_id, {SETTINGS_SELECT} FROM chat_settings ORDER BY last_seen DESC LIMIT ?", (limit,)
+        )
+        if not rows:
+            return 0
+        trigger_rows = await db.execute_fetchall(
+            "SELECT t.chat_id, t.trigger, t.file_id FROM chat_sticker_triggers t "
+            "JOIN (SELECT chat_id FROM chat_settings ORDER BY last_seen DESC LIMIT ?) c ON c.chat_id = t.chat_id",
+            (limit,),
         )
-        await db.commit()
+    triggers: Dict[int, Dict[str, str]] = {}
+    for cid, trigger, file_id in trigger_rows:
+        triggers.setdefault(cid, {})[trigger] = file_id
+    warmed = 0
+    # least recent first, so the most active chats end up at the MRU end
+    for row in reversed(rows):
+        cid, legacy = row[0], row[5]
+        if (legacy and legacy != "{}") or cid in chat_settings_cache:
+            continue
+        chat_settings_cache[cid] = ChatSettings.from_row(row[1:], triggers.get(cid))
+        warmed += 1
+    return warmed
 
 
 # ---------- warns / mutes / bans helpers ----------
@@ -336,79 +1542,250 @@ async def save_chat_settings(chat_id: int):
 
 
 
-async def change_warns(chat_id: int, user_id: int, delta: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT warns FROM warns WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        row = await cur.fetchone()
-        if row:
-            new = max(0, row[0] + delta)
-            await db.execute("UPDATE warns SET warns=? WHERE chat_id=? AND user_id=?", (new, chat_id, user_id))
-        else:
-            new = max(0, delta)
-            await db.execute("INSERT INTO warns (chat_id,user_id,warns) VALUES(?,?,?)", (chat_id, user_id, new))
-        await db.commit()
-        return new
+def _warn_cutoff(chat_id: int, now: int) -> int:
+    """Oldest warn timestamp still counted in this chat."""
+    days = chat_settings_cache.get(chat_id, DEFAULT_SETTINGS).warn_decay_days
+    return now - days * 86400 if days > 0 else 0
+
+
+async def _live_warn_history(chat_id: int, user_id: int, cutoff: int) -> deque:
+    """
+    The user's unexpired warn timestamps, oldest first, with expired ones dropped
+    from the front. A cache miss is one indexed range read of warn_events.
+    Call with the user's warn lock held.
+    """
+    key = (chat_id, user_id)
+    history = warn_history.get(key)
+    if history is None:
+        # events still sitting in the write-behind buffer must be in the DB before it is read
+        if write_queue.has_pending_warns(chat_id, user_id):
+            await write_queue.flush()
+        async with db_pool.read() as db:
+            rows = await db.execute_fetchall(
+                "SELECT ts FROM warn_events WHERE chat_id=? AND user_id=? AND ts>=? ORDER BY ts",
+                (chat_id, user_id, cutoff),
+            )
+        history = deque(ts for (ts,) in rows)
+        warn_history[key] = history
+        if len(warn_history) > WARN_CACHE_MAX:
+            warn_history.popitem(last=False)
+    else:
+        warn_history.move_to_end(key)
+    while history and history[0] < cutoff:
+        history.popleft()
+    return history
+
+
+# a fixed pool of locks shared by hash; one user's warn changes never interleave
+_warn_locks = [asyncio.Lock() for _ in range(max(1, WARN_LOCK_STRIPES))]
+
+
+def _warn_lock(chat_id: int, user_id: int) -> asyncio.Lock:
+    return _warn_locks[hash((chat_id, user_id)) % len(_warn_locks)]
+
+
+async def add_warn(chat_id: int, user_id: int, source: str, reason: str = "") -> Tuple[int, bool]:
+    """
+    Record one warn event (source names the rule or command that issued it) and
+    return (live warn count, crossed). crossed is True only for the warn that lifts
+    the count from below WARN_BAN_LIMIT to at or above it, so callers ban exactly
+    once per crossing. Warns older than the chat's decay window no longer count.
+    """
+    await load_chat_settings(chat_id)
+    now = int(time.time())
+    async with _warn_lock(chat_id, user_id):
+        history = await _live_warn_history(chat_id, user_id, _warn_cutoff(chat_id, now))
+        old = len(history)
+        history.append(now)
+        write_queue.put_warn_event(chat_id, user_id, reason, source, now)
+    new = old + 1
+    return new, old < WARN_BAN_LIMIT <= new
 
 
 async def get_warns(chat_id: int, user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT warns FROM warns WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        row = await cur.fetchone()
-        return row[0] if row else 0
+    await load_chat_settings(chat_id)
+    async with _warn_lock(chat_id, user_id):
+        history = await _live_warn_history(chat_id, user_id, _warn_cutoff(chat_id, int(time.time())))
+        return len(history)
+
+
+async def reset_warns(chat_id: int, user_id: int):
+    """
+    Forget all of a user's warns in a chat, e.g. once they are unbanned, so the
+    next warn that reaches WARN_BAN_LIMIT is a fresh crossing and bans again.
+    """
+    async with _warn_lock(chat_id, user_id):
+        warn_history.pop((chat_id, user_id), None)
+        write_queue.clear_warns(chat_id, user_id)
+
+
+def forget_chat_warns(chat_id: int):
+    """Drop a chat's cached warn histories, e.g. after its decay window changed."""
+    for key in [k for k in warn_history if k[0] == chat_id]:
+        del warn_history[key]
+
+
+async def compact_warn_events(context: ContextTypes.DEFAULT_TYPE):
+    """Delete warn events that fell out of their chat's decay window, in bounded batches."""
+    now = int(time.time())
+    removed = 0
+    try:
+        while True:
+            async with db_pool.write() as db:
+                cur = await db.execute(
+                    "DELETE FROM warn_events WHERE id IN ("
+                    " SELECT e.id FROM chat_settings c JOIN warn_events e ON e.chat_id = c.chat_id"
+                    " WHERE COALESCE(c.warn_decay_days, ?) > 0"
+                    " AND e.ts < ? - COALESCE(c.warn_decay_days, ?) * 86400 LIMIT 5000)",
+                    (WARN_DECAY_DAYS, now, WARN_DECAY_DAYS),
+                )
+                batch = cur.rowcount
+            removed += batch
+            if batch < 5000:
+                break
+        if removed:
+            logger.info("Compacted %d expired warn events", removed)
+    except Exception as e:
+        logger.exception("Warn compaction failed: %s", e)
 
 
 async def set_mute(chat_id: int, user_id: int, until_ts: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("REPLACE INTO mutes(chat_id,user_id,until_ts) VALUES(?,?,?)", (chat_id, user_id, until_ts))
-        await db.commit()
+    """until_ts of 0 clears the mute row instead of keeping a dead entry around."""
+    write_queue.put_mute(chat_id, user_id, until_ts if until_ts else None)
+    mute_scheduler.schedule(chat_id, user_id, until_ts)
 
 
 async def get_mute(chat_id: int, user_id: int) -> Optional[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT until_ts FROM mutes WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        row = await cur.fetchone()
+    pending, until_ts = write_queue.pending_mute(chat_id, user_id)
+    if pending:
+        return until_ts
+    async with db_pool.read() as db:
+        async with db.execute("SELECT until_ts FROM mutes WHERE chat_id=? AND user_id=?", (chat_id, user_id)) as cur:
+            row = await cur.fetchone()
         return row[0] if row else None
 
 
-async def clear_expired_mutes(application):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT chat_id,user_id,until_ts FROM mutes")
-        rows = await cur.fetchall()
+# --------------------- Mute expiry scheduler ---------------------
+class MuteScheduler:
+    """
+    Keeps upcoming mute expiries in a min-heap and sleeps until the earliest one,
+    so only rows that are actually due get touched. Rescheduling a user just pushes
+    a new entry; superseded heap entries are skipped lazily against _due.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int, int]] = []
+        self._due: Dict[Tuple[int, int], int] = {}
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._bot = None
+
+    async def start(self, bot):
+        self._bot = bot
+        self._changed = asyncio.Event()
         now = int(time.time())
+        async with db_pool.write() as db:
+            # mutes are applied with until_date, so Telegram has already lifted anything
+            # that expired while we were down (and unmute_cmd used to leave until_ts=0 rows)
+            await db.execute("DELETE FROM mutes WHERE until_ts<=?", (now,))
+        async with db_pool.read() as db:
+            rows = await db.execute_fetchall("SELECT chat_id,user_id,until_ts FROM mutes WHERE until_ts>?", (now,))
         for chat_id, user_id, until_ts in rows:
-            if until_ts and until_ts <= now:
+            self.schedule(int(chat_id), int(user_id), int(until_ts))
+        self._task = asyncio.create_task(self._run())
+        logger.info("Mute scheduler started with %d pending expiries", len(self._due))
+
+    def schedule(self, chat_id: int, user_id: int, until_ts: Optional[int]):
+        key = (chat_id, user_id)
+        if not until_ts or until_ts <= 0:
+            self._due.pop(key, None)
+            return
+        self._due[key] = until_ts
+        heapq.heappush(self._heap, (until_ts, chat_id, user_id))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(t, c, u) for (c, u), t in self._due.items()]
+            heapq.heapify(self._heap)
+        if self._changed is not None and self._heap[0][0] == until_ts:
+            self._changed.set()
+
+    def _drop_stale_head(self):
+        while self._heap:
+            until_ts, chat_id, user_id = self._heap[0]
+            if self._due.get((chat_id, user_id)) == until_ts:
+                return
+            heapq.heappop(self._heap)
+
+    async def _run(self):
+        while True:
+            self._drop_stale_head()
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
                 try:
-                    await application.bot.restrict_chat_member(
-                        int(chat_id),
-                        int(user_id),
-                        make_perms(
-                            can_send_messages=True,
-                            can_send_media_messages=True,
-                            can_send_polls=True,
-                            can_send_other_messages=True,
-                            can_add_web_page_previews=True,
-                        ),
-                    )
-                except Exception as e:
-                    logger.info("Failed to unmute %s in %s: %s", user_id, chat_id, e)
-                await db.execute("DELETE FROM mutes WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        await db.commit()
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = int(time.time())
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                until_ts, chat_id, user_id = heapq.heappop(self._heap)
+                if self._due.get((chat_id, user_id)) == until_ts:
+                    del self._due[(chat_id, user_id)]
+                    due.append((chat_id, user_id))
+            if due:
+                try:
+                    await self._expire(due, now)
+                except Exception:
+                    logger.exception("Mute expiry batch failed")
+
+    async def _expire(self, due: List[Tuple[int, int]], now: int):
+        perms = make_perms(
+            can_send_messages=True,
+            can_send_media_messages=True,
+            can_send_polls=True,
+            can_send_other_messages=True,
+            can_add_web_page_previews=True,
+        )
+        results = await asyncio.gather(
+            *(
+                outbound.call(PRIO_ENFORCE, chat_id, self._bot.restrict_chat_member, chat_id, user_id, perms)
+                for chat_id, user_id in due
+            ),
+            return_exceptions=True,
+        )
+        for (chat_id, user_id), res in zip(due, results):
+            if isinstance(res, Exception):
+                logger.info("Failed to unmute %s in %s: %s", user_id, chat_id, res)
+        # land any queued mute upserts first, or they would re-create rows this delete clears
+        await write_queue.flush()
+        # one indexed range delete for the whole batch
+        async with db_pool.write() as db:
+            await db.execute("DELETE FROM mutes WHERE until_ts>0 AND until_ts<=?", (now,))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+mute_scheduler = MuteScheduler()
 
 
 async def record_ban(chat_id: int, user_id: int, username: Optional[str], mod_id: Optional[int], reason: Optional[str]):
-    async with aiosqlite.connect(DB_PATH) as db:
-        ts = int(time.time())
-        await db.execute(
-            "REPLACE INTO bans (chat_id,user_id,username,mod_id,reason,banned_at) VALUES(?,?,?,?,?,?)",
-            (chat_id, user_id, username or "", mod_id or 0, reason or "", ts),
-        )
-        await db.commit()
+    ts = int(time.time())
+    write_queue.put_ban(chat_id, user_id, (chat_id, user_id, username or "", mod_id or 0, reason or "", ts))
 
 
 async def remove_ban_record(chat_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM bans WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-        await db.commit()
+    write_queue.delete_ban(chat_id, user_id)
 
 
 # --------------------- Utility helpers ---------------------
@@ -476,19 +1853,483 @@ async def info_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+# --------------------- Outbound Telegram request scheduler ---------------------
+# lanes, highest priority first
+PRIO_ENFORCE = 0  # deletions, bans, restrictions
+PRIO_REPLY = 1  # report DMs, trigger stickers, progress edits
+PRIO_NOTICE = 2  # warn notices, welcomes, goodbyes — dropped or coalesced under pressure
+PRIO_BULK = 3  # long-running bulk jobs
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1.0
+
+
+class _OutboundItem:
+    __slots__ = ("prio", "chat_id", "func", "args", "kwargs", "future", "coalesce_key", "attempts")
+
+    def __init__(self, prio, chat_id, func, args, kwargs, future, coalesce_key):
+        self.prio = prio
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    """
+    Paces every moderation-path Bot API call. A global token bucket
+    (OUTBOUND_GLOBAL_RATE/s) covers all calls; messages posted into a chat
+    (PRIO_REPLY / PRIO_NOTICE) also spend from that chat's bucket
+    (OUTBOUND_CHAT_PER_MIN/min). Lanes are served strictly by priority. RetryAfter
+    pauses the affected chat (or everything, when the call had no chat) for the
+    requested time plus a growing backoff, and the call is retried. Once the
+    notice lane holds OUTBOUND_NOTICE_MAX items, new notices are dropped, and a
+    notice submitted with a coalesce_key replaces the payload of a still-queued
+    one with the same key.
+
+    `func` is any coroutine function (usually a bound Bot/Message method), so the
+    scheduler can be driven by a fake bot that raises RetryAfter.
+    """
+
+    SCAN_DEPTH = 64
+    MAX_RETRIES = 5
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_per_min: float = OUTBOUND_CHAT_PER_MIN,
+        notice_max: int = OUTBOUND_NOTICE_MAX,
+        max_inflight: int = OUTBOUND_MAX_INFLIGHT,
+    ):
+        self.global_rate = max(0.1, global_rate)
+        self.chat_rate = max(0.01, chat_per_min) / 60.0
+        self.chat_burst = max(1.0, chat_per_min)
+        self.notice_max = max(1, notice_max)
+        self.max_inflight = max(1, max_inflight)
+        self._lanes = [deque() for _ in range(PRIO_BULK + 1)]
+        self._coalesce: Dict[Hashable, _OutboundItem] = {}
+        self._chat_buckets: Dict[int, _TokenBucket] = {}
+        self._paused_until: Dict[Optional[int], float] = {}
+        self._global: Optional[_TokenBucket] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = set()
+        self.dropped = 0
+
+    def start(self):
+        self._global = _TokenBucket(self.global_rate, self.global_rate, time.monotonic())
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, prio: int, chat_id: Optional[int], func, /, *args, coalesce_key: Hashable = None, **kwargs) -> asyncio.Future:
+        """Queue func(*args, **kwargs); the returned future resolves to its result (None when dropped)."""
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            # not started (e.g. outside the bot): just run it
+            return asyncio.ensure_future(func(*args, **kwargs))
+        if coalesce_key is not None:
+            queued = self._coalesce.get(coalesce_key)
+            if queued is not None and not queued.future.done():
+                queued.func, queued.args, queued.kwargs = func, args, kwargs
+                return queued.future
+        future = loop.create_future()
+        if prio == PRIO_NOTICE and len(self._lanes[PRIO_NOTICE]) >= self.notice_max:
+            self.dropped += 1
+            future.set_result(None)
+            return future
+        item = _OutboundItem(prio, chat_id, func, args, kwargs, future, coalesce_key)
+        if coalesce_key is not None:
+            self._coalesce[coalesce_key] = item
+        self._lanes[prio].append(item)
+        self._wakeup.set()
+        return future
+
+    async def call(self, prio: int, chat_id: Optional[int], func, /, *args, **kwargs):
+        """Queue a call and wait for its result; the call's exception is re-raised here."""
+        return await self.submit(prio, chat_id, func, *args, **kwargs)
+
+    def post(self, prio: int, chat_id: Optional[int], func, /, *args, fallback=None, **kwargs):
+        """
+        Fire-and-forget variant of call(). Failures are only logged; when the call
+        fails and fallback is given, fallback() runs instead (usually another post).
+        """
+        fut = self.submit(prio, chat_id, func, *args, **kwargs)
+        if fallback is None:
+            fut.add_done_callback(self._log_failure)
+        else:
+            fut.add_done_callback(lambda f: self._run_fallback(f, fallback))
+
+    @staticmethod
+    def _log_failure(fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception() is not None:
+            logger.debug("Outbound call failed: %s", fut.exception())
+
+    @classmethod
+    def _run_fallback(cls, fut: asyncio.Future, fallback):
+        if fut.cancelled() or fut.exception() is None:
+            return
+        cls._log_failure(fut)
+        try:
+            fallback()
+        except Exception:
+            logger.exception("Outbound fallback failed")
+
+    def _chat_delay(self, item: _OutboundItem, now: float) -> float:
+        delay = self._paused_until.get(item.chat_id, 0.0) - now
+        if item.prio in (PRIO_REPLY, PRIO_NOTICE) and item.chat_id is not None:
+            bucket = self._chat_buckets.get(item.chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[item.chat_id] = _TokenBucket(self.chat_rate, self.chat_burst, now)
+            delay = max(delay, bucket.wait_time(now))
+        return delay
+
+    def _next_ready(self, now: float) -> Tuple[Optional[_OutboundItem], Optional[float]]:
+        global_pause = self._paused_until.get(None, 0.0) - now
+        if global_pause > 0:
+            return None, global_pause
+        soonest = None
+        for lane in self._lanes:
+            idx = 0
+            while idx < len(lane) and idx < self.SCAN_DEPTH:
+                item = lane[idx]
+                if item.future.done():
+                    del lane[idx]
+                    continue
+                delay = self._chat_delay(item, now)
+                if delay <= 0:
+                    global_wait = self._global.wait_time(now)
+                    if global_wait > 0:
+                        return None, global_wait
+                    del lane[idx]
+                    if item.coalesce_key is not None and self._coalesce.get(item.coalesce_key) is item:
+                        del self._coalesce[item.coalesce_key]
+                    self._global.take()
+                    bucket = self._chat_buckets.get(item.chat_id)
+                    if bucket is not None and item.prio in (PRIO_REPLY, PRIO_NOTICE):
+                        bucket.take()
+                    return item, None
+                soonest = delay if soonest is None else min(soonest, delay)
+                idx += 1
+        return None, soonest
+
+    async def _run(self):
+        while True:
+            item, delay = self._next_ready(time.monotonic())
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._execute(item))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, item: _OutboundItem):
+        try:
+            result = await item.func(*item.args, **item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, "total_seconds"):
+                retry_after = retry_after.total_seconds()
+            item.attempts += 1
+            pause = float(retry_after) + min(30.0, 0.5 * (2 ** item.attempts))
+            until = time.monotonic() + pause
+            self._paused_until[item.chat_id] = max(self._paused_until.get(item.chat_id, 0.0), until)
+            logger.warning("Flood limit hit (chat %s): pausing %.1fs", item.chat_id, pause)
+            if item.attempts <= self.MAX_RETRIES and not item.future.done():
+                self._lanes[item.prio].appendleft(item)
+            elif not item.future.done():
+                item.future.set_exception(e)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+    def sweep(self):
+        now = time.monotonic()
+        for chat_id in [c for c, t in self._paused_until.items() if t <= now]:
+            del self._paused_until[chat_id]
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.wait_time(now) == 0 and b.tokens >= b.capacity]:
+            del self._chat_buckets[chat_id]
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        for lane in self._lanes:
+            while lane:
+                item = lane.popleft()
+                if not item.future.done():
+                    item.future.cancel()
+
+
+outbound = OutboundScheduler()
+
+
+# --------------------- Supervised side effects ---------------------
+class SideEffects:
+    """
+    Runs enforcement follow-ups as background tasks so a handler can return once
+    its decision is made. At most max_inflight run at once and spawn() waits for
+    a free slot when saturated. A failing task is logged and never affects the
+    handler or its siblings. drain() lets the remaining tasks finish at shutdown.
+    """
+
+    def __init__(self, max_inflight: int = SIDE_EFFECT_MAX_INFLIGHT):
+        self.max_inflight = max(1, max_inflight)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+
+    async def spawn(self, coro, name: str):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_inflight)
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            coro.close()
+            raise
+        task = asyncio.create_task(self._guard(coro, name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _guard(self, coro, name: str):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Side effect %s failed", name)
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float = 10.0):
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning("Cancelled %d side effects still running at shutdown", len(pending))
+
+
+side_effects = SideEffects()
+
+
+# --------------------- Admin roster cache ---------------------
+class AdminCache:
+    """
+    Per-chat set of admin user ids filled from get_chat_administrators and trusted
+    for ttl seconds. Concurrent lookups for a chat share one in-flight request, and
+    invalidate() (driven by chat_member updates) drops a roster immediately.
+    sweep() (from periodic_job) forgets expired rosters so idle chats do not pile up.
+    """
+
+    def __init__(self, ttl: int = ADMIN_CACHE_TTL):
+        self.ttl = ttl
+        self._rosters: Dict[int, Tuple[float, frozenset]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self._generation: Dict[int, int] = defaultdict(int)
+
+    async def get_admins(self, bot, chat_id: int) -> frozenset:
+        entry = self._rosters.get(chat_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        fut = self._inflight.get(chat_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = fut
+            fut.add_done_callback(lambda _f, c=chat_id: self._inflight.pop(c, None))
+        # shield: one waiter being cancelled must not cancel the shared request
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, bot, chat_id: int) -> frozenset:
+        gen = self._generation[chat_id]
+        admins = await bot.get_chat_administrators(chat_id)
+        ids = frozenset(m.user.id for m in admins if m and m.user)
+        # a promotion/demotion seen while we were fetching makes this roster stale
+        if self._generation[chat_id] == gen:
+            self._rosters[chat_id] = (time.monotonic() + self.ttl, ids)
+        return ids
+
+    def invalidate(self, chat_id: int):
+        self._rosters.pop(chat_id, None)
+        self._generation[chat_id] += 1
+
+    def sweep(self, now: float) -> int:
+        """Drop rosters past their ttl; returns how many were removed."""
+        expired = [chat_id for chat_id, (until, _) in self._rosters.items() if until <= now]
+        for chat_id in expired:
+            del self._rosters[chat_id]
+        # generations only guard a fetch that is still running
+        for chat_id in [c for c in self._generation if c not in self._inflight]:
+            del self._generation[chat_id]
+        return len(expired)
+
+
+admin_cache = AdminCache()
+
+
+# --------------------- User directory ---------------------
+class UserDirectory:
+    """
+    Passive id/username directory fed by every message the bot sees, so @username
+    targets and mentions resolve without get_chat. Recently seen users sit in an
+    LRU with a lowercase-username index; sightings are buffered and written to the
+    users / user_chats tables in one transaction by flush(). Lookups that miss
+    memory fall back to the NOCASE username index.
+    """
+
+    def __init__(self, max_entries: int = USER_DIR_MAX):
+        self.max_entries = max(1, max_entries)
+        # user_id -> (username, first_name)
+        self._users: "OrderedDict[int, Tuple[Optional[str], str]]" = OrderedDict()
+        self._by_name: Dict[str, int] = {}
+        self._pending_users: Dict[int, Tuple[Optional[str], str, int]] = {}
+        self._pending_chats: Dict[Tuple[int, int], int] = {}
+
+    def _forget_name(self, user_id: int, username: Optional[str]):
+        if username and self._by_name.get(username.lower()) == user_id:
+            del self._by_name[username.lower()]
+
+    def observe(self, user, chat_id: Optional[int] = None):
+        if user is None:
+            return
+        uid = user.id
+        username = user.username or None
+        first_name = user.first_name or ""
+        now = int(time.time())
+        known = self._users.get(uid)
+        if known != (username, first_name):
+            if known is not None:
+                self._forget_name(uid, known[0])
+            self._users[uid] = (username, first_name)
+            if username:
+                self._by_name[username.lower()] = uid
+            if len(self._users) > self.max_entries:
+                old_uid, (old_name, _) = self._users.popitem(last=False)
+                self._forget_name(old_uid, old_name)
+        self._users.move_to_end(uid)
+        self._pending_users[uid] = (username, first_name, now)
+        if chat_id is not None:
+            self._pending_chats[(uid, chat_id)] = now
+
+    async def lookup(self, username: str) -> Optional[Tuple[int, Optional[str]]]:
+        """(user_id, username) for an @username (case-insensitive), or None if never seen."""
+        name = username.lstrip("@").lower()
+        if not name:
+            return None
+        uid = self._by_name.get(name)
+        if uid is not None:
+            return uid, self._users[uid][0]
+        async with db_pool.read() as db:
+            async with db.execute(
+                "SELECT user_id, username FROM users WHERE username = ? COLLATE NOCASE ORDER BY last_seen DESC LIMIT 1",
+                (name,),
+            ) as cur:
+                row = await cur.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def flush(self):
+        if not (self._pending_users or self._pending_chats):
+            return
+        users, chats = self._pending_users, self._pending_chats
+        self._pending_users, self._pending_chats = {}, {}
+        try:
+            async with db_pool.write() as db:
+                if users:
+                    await db.executemany(
+                        "INSERT INTO users (user_id,username,first_name,last_seen) VALUES(?,?,?,?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, "
+                        "first_name=excluded.first_name, last_seen=excluded.last_seen",
+                        [(uid, *row) for uid, row in users.items()],
+                    )
+                if chats:
+                    await db.executemany(
+                        "INSERT INTO user_chats (user_id,chat_id,last_seen) VALUES(?,?,?) "
+                        "ON CONFLICT(user_id,chat_id) DO UPDATE SET last_seen=excluded.last_seen",
+                        [(uid, cid, ts) for (uid, cid), ts in chats.items()],
+                    )
+        except Exception:
+            # newer sightings queued meanwhile win
+            for k, v in users.items():
+                self._pending_users.setdefault(k, v)
+            for k, v in chats.items():
+                self._pending_chats.setdefault(k, v)
+            raise
+
+
+user_directory = UserDirectory()
+
+
 async def is_user_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
     try:
         if user_id in ADMINS:
             return True
         chat = update.effective_chat
-        if not chat:
+        if not chat or chat.type == "private":
             return False
-        member = await context.bot.get_chat_member(chat.id, user_id)
-        return member.status in ("administrator", "creator")
+        admins = await admin_cache.get_admins(context.bot, chat.id)
+        return user_id in admins
     except Exception:
         return False
 
 
+async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Drop the cached admin roster when someone is promoted, demoted or an admin's rights change.
+    """
+    cmu = update.chat_member or update.my_chat_member
+    if not cmu:
+        return
+    if update.chat_member:
+        user_directory.observe(getattr(cmu.new_chat_member, "user", None), cmu.chat.id)
+    admin_statuses = ("administrator", "creator")
+    old_status = getattr(cmu.old_chat_member, "status", None)
+    new_status = getattr(cmu.new_chat_member, "status", None)
+    if old_status in admin_statuses or new_status in admin_statuses:
+        admin_cache.invalidate(cmu.chat.id)
+    # the bot itself left or was removed: nothing of that chat's settings is needed any more
+    if update.my_chat_member and new_status in ("left", "kicked"):
+        chat_settings_cache.pop(cmu.chat.id)
+        chat_activity.pop(cmu.chat.id, None)
+        welcome_batcher.forget(cmu.chat.id)
+
+
 async def require_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
     if not user:
@@ -518,10 +2359,10 @@ def build_full_commands_menu(chat_id: Optional[int] = None, context: Optional[Co
 
     try:
         # use cached settings if available, otherwise use safe defaults
-        s = chat_settings_cache.get(chat_id, {}) if chat_id is not None else {}
-        anti = s.get("anti_link", True)
-        locked = s.get("locked", False)
-        spam_on = s.get("spam_enabled", True)
+        s = chat_settings_cache.get(chat_id, DEFAULT_SETTINGS) if chat_id is not None else DEFAULT_SETTINGS
+        anti = s.anti_link
+        locked = s.locked
+        spam_on = s.spam_enabled
 
         anti_label = "🔗 Links: ON" if anti else "🔗 Links: OFF"
         lock_label = "🔓 Unlock chat" if locked else "🔒 Lock chat"
@@ -586,7 +2427,7 @@ def pretty_welcome_text(chat_id: int, first_name: str, username: Optional[str])
     chat = chat_settings_cache.get(chat_id)
 
     # Load saved welcome text (admin custom)
-    welcome_template = (chat["welcome"] if chat and chat.get("welcome") else WELCOME_FALLBACK)
+    welcome_template = (chat.welcome if chat and chat.welcome else WELCOME_FALLBACK)
 
     # Format the custom part
     try:
@@ -597,9 +2438,6 @@ def pretty_welcome_text(chat_id: int, first_name: str, username: Optional[str])
     except Exception:
         custom_text = welcome_template
 
-    # Use stored title if available
-    chat_title = chat.get("chat_title", "") if chat else ""
-
     # Stylish full welcome banner
     welcome_banner = (
         f"📀 <b>WELCOME TO BOT_NAME</b> 🎵\n\n"
@@ -659,6 +2497,9 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/weather <city> — get weather (OpenWeatherMap API required)\n"
         "/translate <text> <lang> — translate text to target language (e.g. en, hi, fr)\n\n"
         "Moderation: /ban /unban /unbanall /banlog /kick /mute /unmute /warn /warnings\n(Reply to a user's message to target them)\n"
+        "/banlog export [csv|json] — download the full ban log\n"
+        "/setwarn_decay <days> — warns older than this stop counting, 0 = never (admin only)\n"
+        "/modstats — moderation stage counters and latency (bot owners only)\n"
     )
     await update.effective_message.reply_html(text)
 
@@ -672,9 +2513,9 @@ async def setwelcome_text_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.effective_message.reply_text("Usage: /setwelcome_text Your welcome text (use {first_name})")
         return
     text = " ".join(context.args)
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["welcome"] = text
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.welcome = text
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text("Welcome text updated.")
 
 
@@ -688,10 +2529,10 @@ async def setwelcome_photo_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
     photo = msg.reply_to_message.photo[-1]
     file_id = photo.file_id
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["welcome_photo"] = file_id
-    chat_settings_cache[chat_id]["welcome_video"] = None
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.welcome_photo = file_id
+    s.welcome_video = None
+    await save_chat_settings(chat_id, s)
     await msg.reply_text("Welcome photo saved. New members will receive this photo as welcome (no buttons).")
 
 
@@ -707,10 +2548,10 @@ async def setwelcome_video_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         file_id = msg.reply_to_message.document.file_id
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["welcome_video"] = file_id
-    chat_settings_cache[chat_id]["welcome_photo"] = None
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.welcome_video = file_id
+    s.welcome_photo = None
+    await save_chat_settings(chat_id, s)
     await msg.reply_text("Welcome video saved. New members will receive this video as welcome (no buttons).")
 
 
@@ -718,10 +2559,10 @@ async def clear_welcome_media_cmd(update: Update, context: ContextTypes.DEFAULT_
     if not await require_admin(update, context):
         return
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["welcome_photo"] = None
-    chat_settings_cache[chat_id]["welcome_video"] = None
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.welcome_photo = None
+    s.welcome_video = None
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text("Cleared welcome photo & video.")
 
 
@@ -734,9 +2575,9 @@ async def setbye_text_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Usage: /setbye_text Your bye text (use {first_name})")
         return
     text = " ".join(context.args)
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["bye_text"] = text
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.bye_text = text
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text("Goodbye text updated.")
 
 
@@ -750,9 +2591,9 @@ async def setbye_photo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = msg.reply_to_message.photo[-1]
     file_id = photo.file_id
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["bye_photo"] = file_id
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.bye_photo = file_id
+    await save_chat_settings(chat_id, s)
     await msg.reply_text("Goodbye photo saved. When a member leaves, the bot will send this photo (if set).")
 
 
@@ -760,9 +2601,9 @@ async def clear_bye_media_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not await require_admin(update, context):
         return
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["bye_photo"] = None
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.bye_photo = None
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text("Cleared goodbye photo.")
 
 
@@ -788,13 +2629,13 @@ async def filter_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         sticker_file_id = msg.reply_to_message.sticker.file_id
 
-        await load_chat_settings(chat_id)
-        triggers = chat_settings_cache[chat_id].get("sticker_triggers", {}) or {}
+        s = await load_chat_settings(chat_id)
+        triggers = s.sticker_triggers or {}
 
+        await add_sticker_trigger(chat_id, trigger, sticker_file_id)
         triggers[trigger] = sticker_file_id
-        chat_settings_cache[chat_id]["sticker_triggers"] = triggers
-
-        await save_chat_settings(chat_id)
+        s.sticker_triggers = triggers
+        rebuild_trigger_matcher(chat_id, triggers)
 
         await msg.reply_text(f"Sticker trigger added: '{trigger}'")
         return
@@ -810,24 +2651,24 @@ async def filter_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         trigger = " ".join(context.args[1:]).strip().lower()
 
-        await load_chat_settings(chat_id)
-        triggers = chat_settings_cache[chat_id].get("sticker_triggers", {}) or {}
+        s = await load_chat_settings(chat_id)
+        triggers = s.sticker_triggers or {}
 
         if trigger not in triggers:
             await msg.reply_text("No such trigger found.")
             return
 
-        triggers.pop(trigger)
-        chat_settings_cache[chat_id]["sticker_triggers"] = triggers
-
-        await save_chat_settings(chat_id)
+        await remove_sticker_trigger(chat_id, trigger)
+        triggers.pop(trigger, None)
+        s.sticker_triggers = triggers or None
+        rebuild_trigger_matcher(chat_id, triggers)
         await msg.reply_text(f"Removed trigger '{trigger}'.")
         return
 
     # list triggers
     if context.args and context.args[0].lower() == "list":
-        await load_chat_settings(chat_id)
-        triggers = chat_settings_cache[chat_id].get("sticker_triggers", {}) or {}
+        s = await load_chat_settings(chat_id)
+        triggers = s.sticker_triggers or {}
 
         if not triggers:
             await msg.reply_text("No triggers set.")
@@ -858,6 +2699,13 @@ async def resolve_target_user(update: Update, context: ContextTypes.DEFAULT_TYPE
         if arg.isdigit():
             return int(arg), None
         username = arg.lstrip("@")
+        try:
+            known = await user_directory.lookup(username)
+            if known:
+                return known
+        except Exception:
+            logger.exception("User directory lookup failed for %s", username)
+        # never seen by the bot: ask Telegram
         try:
             chat = await context.bot.get_chat(username)
             return chat.id, getattr(chat, "username", None)
@@ -879,7 +2727,7 @@ async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     reason = " ".join(context.args[1:]) if len(context.args) > 1 else ""
     try:
-        await context.bot.ban_chat_member(update.effective_chat.id, target_id)
+        await outbound.call(PRIO_ENFORCE, update.effective_chat.id, context.bot.ban_chat_member, update.effective_chat.id, target_id)
         await record_ban(update.effective_chat.id, target_id, target_username, update.effective_user.id, reason)
         await update.effective_message.reply_text(f"Banned {target_id}{(' (@' + target_username + ')') if target_username else ''}.")
     except Exception as e:
@@ -894,50 +2742,258 @@ async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Reply to user or use: /unban <user_id or @username>")
         return
     try:
-        await context.bot.unban_chat_member(update.effective_chat.id, target_id)
+        await outbound.call(PRIO_ENFORCE, update.effective_chat.id, context.bot.unban_chat_member, update.effective_chat.id, target_id)
         await remove_ban_record(update.effective_chat.id, target_id)
+        await reset_warns(update.effective_chat.id, target_id)
         await update.effective_message.reply_text(f"User {target_id} has been unbanned.")
     except Exception as e:
         await update.effective_message.reply_text("Failed to unban: " + str(e))
 
 
+# --------------------- Background /unbanall jobs ---------------------
+class UnbanAllRunner:
+    """
+    Runs /unbanall as one background task per chat. Bans are walked in user_id
+    order in batches; each batch is unbanned with bounded concurrency through the
+    outbound scheduler's bulk lane, then the unbanned rows are deleted and the
+    cursor saved in one transaction, so a restart resumes where the job stopped.
+    """
+
+    BATCH = 200
+
+    def __init__(self, concurrency: int = UNBANALL_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def is_running(self, chat_id: int) -> bool:
+        return chat_id in self._tasks
+
+    async def start(self, bot, chat_id: int, total: int, progress_chat_id: int, progress_message_id: int):
+        async with db_pool.write() as db:
+            await db.execute(
+                "REPLACE INTO unban_jobs (chat_id,cursor,done,failed,total,progress_chat_id,progress_message_id,started_at) "
+                "VALUES(?,?,?,?,?,?,?,?)",
+                (chat_id, 0, 0, 0, total, progress_chat_id, progress_message_id, int(time.time())),
+            )
+        self._spawn(bot, (chat_id, 0, 0, 0, total, progress_chat_id, progress_message_id))
+
+    async def resume_all(self, bot):
+        async with db_pool.read() as db:
+            jobs = await db.execute_fetchall(
+                "SELECT chat_id,cursor,done,failed,total,progress_chat_id,progress_message_id FROM unban_jobs"
+            )
+        for job in jobs:
+            logger.info("Resuming unbanall for chat %s from user_id > %s", job[0], job[1])
+            self._spawn(bot, tuple(job))
+
+    def _spawn(self, bot, job: tuple):
+        chat_id = job[0]
+        task = asyncio.create_task(self._run(bot, *job))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _t, c=chat_id: self._tasks.pop(c, None))
+
+    def _report(self, bot, chat_id: int, text: str, progress_chat_id: Optional[int], progress_message_id: Optional[int]):
+        if not progress_chat_id or not progress_message_id:
+            return
+        outbound.post(
+            PRIO_REPLY,
+            progress_chat_id,
+            bot.edit_message_text,
+            text,
+            chat_id=progress_chat_id,
+            message_id=progress_message_id,
+            coalesce_key=("unbanall", chat_id),
+        )
+
+    async def _run(self, bot, chat_id, cursor, done, failed, total, progress_chat_id, progress_message_id):
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def unban_one(user_id: int) -> bool:
+            async with sem:
+                try:
+                    await outbound.call(PRIO_BULK, chat_id, bot.unban_chat_member, chat_id, user_id)
+                    return True
+                except Exception as e:
+                    logger.info("Failed unban %s: %s", user_id, e)
+                    return False
+
+        try:
+            while True:
+                # user ids are positive, so the initial cursor of 0 starts at the beginning
+                async with db_pool.read() as db:
+                    rows = await db.execute_fetchall(
+                        "SELECT user_id FROM bans WHERE chat_id=? AND user_id>? ORDER BY user_id LIMIT ?",
+                        (chat_id, cursor, self.BATCH),
+                    )
+                if not rows:
+                    break
+                user_ids = [r[0] for r in rows]
+                results = await asyncio.gather(*(unban_one(u) for u in user_ids))
+                unbanned = [(chat_id, u) for u, ok in zip(user_ids, results) if ok]
+                for _, u in unbanned:
+                    await reset_warns(chat_id, u)
+                done += len(unbanned)
+                failed += len(user_ids) - len(unbanned)
+                cursor = user_ids[-1]
+                async with db_pool.write() as db:
+                    if unbanned:
+                        await db.executemany("DELETE FROM bans WHERE chat_id=? AND user_id=?", unbanned)
+                    await db.execute(
+                        "UPDATE unban_jobs SET cursor=?, done=?, failed=? WHERE chat_id=?",
+                        (cursor, done, failed, chat_id),
+                    )
+                self._report(bot, chat_id, f"Unbanall in progress: {done + failed}/{total} (failed: {failed})", progress_chat_id, progress_message_id)
+
+            async with db_pool.write() as db:
+                await db.execute("DELETE FROM unban_jobs WHERE chat_id=?", (chat_id,))
+            self._report(bot, chat_id, f"Unbanall complete. Success: {done}, Failed: {failed}", progress_chat_id, progress_message_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Unbanall job for chat %s failed; it will resume on restart", chat_id)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+unbanall_runner = UnbanAllRunner()
+
+
 async def unbanall_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_admin(update, context):
         return
     chat_id = update.effective_chat.id
-    rows = await get_bans_for_chat(chat_id)
-    if not rows:
+    if unbanall_runner.is_running(chat_id):
+        await update.effective_message.reply_text("Unbanall is already running for this chat.")
+        return
+    await write_queue.flush()
+    async with db_pool.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM bans WHERE chat_id=?", (chat_id,)) as cur:
+            total = (await cur.fetchone())[0]
+    if not total:
         await update.effective_message.reply_text("No recorded bans for this chat.")
         return
-    success = failed = 0
+    progress = await update.effective_message.reply_text(f"Unbanall started: 0/{total}")
+    await unbanall_runner.start(context.bot, chat_id, total, progress.chat_id, progress.message_id)
+
+
+# --------------------- Ban log (keyset pages & export) ---------------------
+_BAN_COLUMNS = "user_id,username,mod_id,reason,banned_at"
+
+
+async def fetch_ban_page(chat_id: int, older_than: Optional[Tuple[int, int]] = None, newer_than: Optional[Tuple[int, int]] = None, limit: int = BANLOG_PAGE_SIZE):
+    """
+    One page of the ban log, newest first, using (banned_at, user_id) as the keyset.
+    older_than / newer_than are the keys of the rows at the edge of the current page.
+    Returns (rows, has_newer, has_older).
+    """
+    await write_queue.flush()
+    async with db_pool.read() as db:
+        if newer_than is not None:
+            rows = await db.execute_fetchall(
+                f"SELECT {_BAN_COLUMNS} FROM bans WHERE chat_id=? AND (banned_at,user_id) > (?,?) "
+                "ORDER BY banned_at ASC, user_id ASC LIMIT ?",
+                (chat_id, newer_than[0], newer_than[1], limit + 1),
+            )
+            has_newer = len(rows) > limit
+            rows = list(rows[:limit])
+            rows.reverse()
+            return rows, has_newer, True
+        if older_than is not None:
+            rows = await db.execute_fetchall(
+                f"SELECT {_BAN_COLUMNS} FROM bans WHERE chat_id=? AND (banned_at,user_id) < (?,?) "
+                "ORDER BY banned_at DESC, user_id DESC LIMIT ?",
+                (chat_id, older_than[0], older_than[1], limit + 1),
+            )
+            return list(rows[:limit]), True, len(rows) > limit
+        rows = await db.execute_fetchall(
+            f"SELECT {_BAN_COLUMNS} FROM bans WHERE chat_id=? ORDER BY banned_at DESC, user_id DESC LIMIT ?",
+            (chat_id, limit + 1),
+        )
+        return list(rows[:limit]), False, len(rows) > limit
+
+
+def render_ban_page(rows, has_newer: bool, has_older: bool) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    lines = []
     for user_id, username, mod_id, reason, banned_at in rows:
-        try:
-            await context.bot.unban_chat_member(chat_id, user_id)
-            await remove_ban_record(chat_id, user_id)
-            success += 1
-        except Exception as e:
-            logger.info("Failed unban %s: %s", user_id, e)
-            failed += 1
-    await update.effective_message.reply_text(f"Unbanall complete. Success: {success}, Failed: {failed}")
+        ts = datetime.fromtimestamp(banned_at).strftime("%Y-%m-%d %H:%M") if banned_at else "(unknown)"
+        uname = f"@{html.escape(username)}" if username else "(no username)"
+        mod_text = f"{mod_id}" if mod_id else "(unknown)"
+        reason_text = f" — {html.escape(reason)}" if reason else ""
+        lines.append(f"• <code>{user_id}</code> — {uname}\n   banned at: {ts} by {mod_text}{reason_text}")
+    text = "<b>Ban Log:</b>\n\n" + "\n\n".join(lines)
+    buttons = []
+    if has_newer:
+        first = rows[0]
+        buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"banlog:n:{first[4]}:{first[0]}"))
+    if has_older:
+        last = rows[-1]
+        buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"banlog:o:{last[4]}:{last[0]}"))
+    return text, (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+
+async def export_ban_log(chat_id: int, fmt: str):
+    """
+    Stream the chat's whole ban log from a DB cursor into a temporary file (CSV or
+    JSON array) and return it rewound; rows are never collected in memory.
+    """
+    await write_queue.flush()
+    raw = tempfile.TemporaryFile()
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    fields = _BAN_COLUMNS.split(",")
+    csv_writer = csv.writer(out) if fmt == "csv" else None
+    if csv_writer:
+        csv_writer.writerow(fields)
+    else:
+        out.write("[")
+    first = True
+    async with db_pool.read() as db:
+        async with db.execute(
+            f"SELECT {_BAN_COLUMNS} FROM bans WHERE chat_id=? ORDER BY banned_at DESC, user_id DESC", (chat_id,)
+        ) as cur:
+            async for row in cur:
+                if csv_writer:
+                    csv_writer.writerow(row)
+                else:
+                    out.write(("\n" if first else ",\n") + json.dumps(dict(zip(fields, row)), ensure_ascii=False))
+                first = False
+    if not csv_writer:
+        out.write("\n]\n")
+    out.flush()
+    out.detach()
+    raw.seek(0)
+    return raw
 
 
 async def banlog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /banlog — newest bans, one page at a time (Newer / Older buttons)
+    /banlog export [csv|json] — full log as a document
+    """
     if not await require_admin(update, context):
         return
     chat_id = update.effective_chat.id
-    rows = await get_bans_for_chat(chat_id)
+    if context.args and context.args[0].lower() == "export":
+        fmt = context.args[1].lower() if len(context.args) > 1 else "csv"
+        if fmt not in ("csv", "json"):
+            await update.effective_message.reply_text("Usage: /banlog export [csv|json]")
+            return
+        doc = await export_ban_log(chat_id, fmt)
+        try:
+            await update.effective_message.reply_document(document=doc, filename=f"banlog_{chat_id}.{fmt}")
+        finally:
+            doc.close()
+        return
+    rows, has_newer, has_older = await fetch_ban_page(chat_id)
     if not rows:
         await update.effective_message.reply_text("No bans recorded for this chat.")
         return
-    lines = []
-    for user_id, username, mod_id, reason, banned_at in rows:
-        ts = datetime.fromtimestamp(banned_at).strftime("%Y-%m-%d %H:%M")
-        uname = f"@{username}" if username else "(no username)"
-        mod_text = f"{mod_id}" if mod_id else "(unknown)"
-        reason_text = f" — {reason}" if reason else ""
-        lines.append(f"• <code>{user_id}</code> — {uname}\n   banned at: {ts} by {mod_text}{reason_text}")
-    text = "<b>Ban Log:</b>\n\n" + "\n\n".join(lines)
-    await update.effective_message.reply_html(text)
+    text, kb = render_ban_page(rows, has_newer, has_older)
+    await update.effective_message.reply_html(text, reply_markup=kb)
 
 
 async def kick_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -949,8 +3005,8 @@ async def kick_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     target = msg.reply_to_message.from_user
     try:
-        await context.bot.ban_chat_member(update.effective_chat.id, target.id)
-        await context.bot.unban_chat_member(update.effective_chat.id, target.id)
+        await outbound.call(PRIO_ENFORCE, update.effective_chat.id, context.bot.ban_chat_member, update.effective_chat.id, target.id)
+        await outbound.call(PRIO_ENFORCE, update.effective_chat.id, context.bot.unban_chat_member, update.effective_chat.id, target.id)
         await msg.reply_text(f"Kicked {target.full_name}")
     except Exception as e:
         await msg.reply_text("Failed to kick: " + str(e))
@@ -972,7 +3028,10 @@ async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             seconds = 60
     until_ts = int(time.time()) + seconds
     try:
-        await context.bot.restrict_chat_member(
+        await outbound.call(
+            PRIO_ENFORCE,
+            update.effective_chat.id,
+            context.bot.restrict_chat_member,
             update.effective_chat.id,
             target.id,
             make_perms(can_send_messages=False),
@@ -993,7 +3052,10 @@ async def unmute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     target = msg.reply_to_message.from_user
     try:
-        await context.bot.restrict_chat_member(
+        await outbound.call(
+            PRIO_ENFORCE,
+            update.effective_chat.id,
+            context.bot.restrict_chat_member,
             update.effective_chat.id,
             target.id,
             make_perms(
@@ -1018,12 +3080,12 @@ async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("Reply to user to warn.")
         return
     target = msg.reply_to_message.from_user
-    new = await change_warns(update.effective_chat.id, target.id, 1)
+    new, crossed = await add_warn(update.effective_chat.id, target.id, "manual", " ".join(context.args))
     await msg.reply_text(f"Warned {target.full_name}. Total warns: {new}")
-    if new >= 3:
+    if crossed:
         try:
-            await context.bot.ban_chat_member(update.effective_chat.id, target.id)
-            await record_ban(update.effective_chat.id, target.id, target.username or None, update.effective_user.id, "auto-warn-3")
+            await outbound.call(PRIO_ENFORCE, update.effective_chat.id, context.bot.ban_chat_member, update.effective_chat.id, target.id)
+            await record_ban(update.effective_chat.id, target.id, target.username or None, update.effective_user.id, f"auto-warn-{WARN_BAN_LIMIT}")
             await msg.reply_text(f"{target.full_name} was banned after reaching {new} warns.")
         except Exception as e:
             await msg.reply_text("Failed to auto-ban: " + str(e))
@@ -1051,43 +3113,341 @@ async def warnings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def lock_chat_permissions(bot, chat_id: int):
     """
     Set chat permissions so regular users cannot send messages.
-    Uses set_chat_permissions which sets default permissions for the chat.
+    Uses set_chat_permissions which sets default permissions for the chat; the call
+    goes out on the outbound ENFORCE lane, ahead of any queued notices.
     """
     try:
         perms = make_perms(can_send_messages=False)
-        await bot.set_chat_permissions(chat_id, perms)
+        await outbound.call(PRIO_ENFORCE, chat_id, bot.set_chat_permissions, chat_id, perms)
         return True
     except Exception as e:
         logger.exception("Failed to lock chat %s: %s", chat_id, e)
         return False
 
 
-async def unlock_chat_permissions(bot, chat_id: int):
-    """
-    Restore basic permissions (allow sending messages and web previews).
-    Adjust as needed for your group's defaults.
-    """
-    try:
-        perms = make_perms(
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_polls=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-        )
-        await bot.set_chat_permissions(chat_id, perms)
-        return True
-    except Exception as e:
-        logger.exception("Failed to unlock chat %s: %s", chat_id, e)
-        return False
+async def unlock_chat_permissions(bot, chat_id: int):
+    """
+    Restore basic permissions (allow sending messages and web previews).
+    Adjust as needed for your group's defaults.
+    """
+    try:
+        perms = make_perms(
+            can_send_messages=True,
+            can_send_media_messages=True,
+            can_send_polls=True,
+            can_send_other_messages=True,
+            can_add_web_page_previews=True,
+        )
+        await outbound.call(PRIO_ENFORCE, chat_id, bot.set_chat_permissions, chat_id, perms)
+        return True
+    except Exception as e:
+        logger.exception("Failed to unlock chat %s: %s", chat_id, e)
+        return False
+
+
+# --------------------- Coalesced welcomes ---------------------
+class _WelcomeBatch:
+    __slots__ = ("members", "inviters", "count")
+
+    def __init__(self):
+        self.members = []
+        self.inviters = []
+        self.count = 0
+
+
+class WelcomeBatcher:
+    """
+    Folds a burst of joins into one welcome per chat. The first join opens a
+    WELCOME_DEBOUNCE_MS window; joins inside it are added to the same batch, and a
+    single post names up to WELCOME_MAX_NAMES of them. Posting a welcome deletes the
+    chat's previous one; the last welcome id is remembered for at most max_chats
+    chats, least recently welcomed dropped first. Everything goes out on the
+    outbound NOTICE lane.
+    """
+
+    def __init__(
+        self,
+        delay_ms: int = WELCOME_DEBOUNCE_MS,
+        max_names: int = WELCOME_MAX_NAMES,
+        max_chats: int = SETTINGS_CACHE_MAX,
+    ):
+        self.delay = max(0, delay_ms) / 1000.0
+        self.max_names = max(1, max_names)
+        self.max_chats = max(1, max_chats)
+        self._batches: Dict[int, _WelcomeBatch] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+        self._last_welcome: "OrderedDict[int, int]" = OrderedDict()
+
+    def add(self, bot, chat_id: int, members, inviter):
+        batch = self._batches.get(chat_id)
+        if batch is None:
+            batch = self._batches[chat_id] = _WelcomeBatch()
+        for member in members:
+            batch.count += 1
+            if len(batch.members) < self.max_names:
+                batch.members.append(member)
+                batch.inviters.append(inviter)
+        if chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._fire(bot, chat_id))
+
+    def discard(self, chat_id: int):
+        """Drop a chat's pending batch without welcoming anyone."""
+        self._batches.pop(chat_id, None)
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def forget(self, chat_id: int):
+        """Drop everything kept for a chat the bot has left."""
+        self.discard(chat_id)
+        self._last_welcome.pop(chat_id, None)
+
+    async def _fire(self, bot, chat_id: int):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            # a discard() may already have replaced this timer with a newer one
+            if self._timers.get(chat_id) is asyncio.current_task():
+                del self._timers[chat_id]
+        batch = self._batches.pop(chat_id, None)
+        if batch is None or not batch.count:
+            return
+        try:
+            await self._send(bot, chat_id, batch)
+        except Exception:
+            logger.exception("Failed to send welcome in chat %s", chat_id)
+
+    def _caption(self, s: ChatSettings, batch: _WelcomeBatch) -> str:
+        names = [html.escape(m.first_name or "") for m in batch.members]
+        if batch.count == 1:
+            member, inviter = batch.members[0], batch.inviters[0]
+            if inviter and inviter.id != member.id:
+                added_line = f"🫂 <b>Added by:</b> {html.escape(inviter.first_name or '')}"
+            else:
+                added_line = "🟢 <b>Joined via link / self-joined</b>"
+            uname = f"@{member.username}" if member.username else ""
+            header = f"🎉 <b>Welcome {names[0]}!</b>\n{added_line}"
+        else:
+            listed = ", ".join(names)
+            more = batch.count - len(names)
+            if more > 0:
+                listed += f" and {more} more"
+            uname = ""
+            header = f"🎉 <b>Welcome {listed}!</b>"
+        try:
+            formatted = s.welcome.format(first_name=", ".join(names), username=uname)
+        except Exception:
+            formatted = s.welcome or WELCOME_FALLBACK
+        return f"{header}\n\n{formatted}"
+
+    async def _send(self, bot, chat_id: int, batch: _WelcomeBatch):
+        try:
+            s = await load_chat_settings(chat_id)
+        except Exception:
+            logger.exception("Failed to load chat settings for welcome.")
+            s = DEFAULT_SETTINGS
+        caption = self._caption(s, batch)
+        try:
+            if s.welcome_photo:
+                sent = await outbound.call(
+                    PRIO_NOTICE,
+                    chat_id,
+                    bot.send_photo,
+                    chat_id=chat_id,
+                    photo=s.welcome_photo,
+                    caption=caption,
+                    parse_mode="HTML",
+                )
+            elif s.welcome_video:
+                sent = await outbound.call(
+                    PRIO_NOTICE,
+                    chat_id,
+                    bot.send_video,
+                    chat_id=chat_id,
+                    video=s.welcome_video,
+                    caption=caption,
+                    parse_mode="HTML",
+                )
+            else:
+                sent = await outbound.call(
+                    PRIO_NOTICE,
+                    chat_id,
+                    bot.send_message,
+                    chat_id=chat_id,
+                    text=caption,
+                    parse_mode="HTML",
+                )
+        except Exception:
+            # Fallback minimal welcome
+            first = batch.members[0].first_name or ""
+            text = f"Welcome, {first}!" if batch.count == 1 else f"Welcome, {first} and {batch.count - 1} more!"
+            sent = await outbound.call(PRIO_NOTICE, chat_id, bot.send_message, chat_id=chat_id, text=text)
+        if sent is None:
+            # dropped by the outbound scheduler under load
+            return
+        last = self._last_welcome
+        previous = last.pop(chat_id, None)
+        last[chat_id] = sent.message_id
+        while len(last) > self.max_chats:
+            last.popitem(last=False)
+        if previous:
+            outbound.post(PRIO_NOTICE, chat_id, bot.delete_message, chat_id, previous)
+
+    async def stop(self):
+        timers = list(self._timers.values())
+        for timer in timers:
+            timer.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        self._timers.clear()
+        self._batches.clear()
+
+
+welcome_batcher = WelcomeBatcher()
+
+
+# --------------------- Raid detection ---------------------
+class RaidGuard:
+    """
+    Join-rate raid detector: one sliding-window counter per chat (O(1) memory).
+    More than RAID_JOIN_THRESHOLD joins within RAID_WINDOW_SEC starts raid mode for
+    RAID_COOLDOWN_SEC. While it lasts, joiners are restricted, welcomes are
+    suppressed, and the chat is locked unless an admin had already locked it.
+    A timer ends the raid and undoes only the lock it applied. raid_until and
+    raid_locked are persisted so a restart picks the timer back up.
+    """
+
+    def __init__(
+        self,
+        threshold: int = RAID_JOIN_THRESHOLD,
+        window: int = RAID_WINDOW_SEC,
+        cooldown: int = RAID_COOLDOWN_SEC,
+        restrict_for: int = RAID_RESTRICT_SEC,
+    ):
+        self.threshold = max(1, threshold)
+        self.cooldown = max(1, cooldown)
+        self.restrict_for = max(30, restrict_for)
+        self.joins = SlidingWindowStore(max(1, window), SPAM_TRACK_MAX)
+        self._until: Dict[int, int] = {}
+        self._locked_by_raid: Dict[int, bool] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+
+    def active(self, chat_id: int) -> bool:
+        return self._until.get(chat_id, 0) > time.time()
+
+    async def on_joins(self, bot, chat_id: int, members) -> bool:
+        """Count the joins; True when the chat is in raid mode and the joiners were restricted instead of welcomed."""
+        now = time.monotonic()
+        rate = 0.0
+        for _ in members:
+            rate = self.joins.hit(chat_id, now)
+        if not self.active(chat_id):
+            if rate <= self.threshold:
+                return False
+            await self._start(bot, chat_id)
+        until_ts = int(time.time()) + self.restrict_for
+        for member in members:
+            outbound.post(
+                PRIO_ENFORCE,
+                chat_id,
+                bot.restrict_chat_member,
+                chat_id,
+                member.id,
+                make_perms(can_send_messages=False),
+                until_date=until_ts,
+            )
+        return True
+
+    async def _start(self, bot, chat_id: int):
+        until = int(time.time()) + self.cooldown
+        self._until[chat_id] = until
+        welcome_batcher.discard(chat_id)
+        locked_here = False
+        try:
+            s = await load_chat_settings(chat_id)
+            if not s.locked and await lock_chat_permissions(bot, chat_id):
+                s.locked = True
+                await save_chat_settings(chat_id, s)
+                locked_here = True
+        except Exception:
+            logger.exception("Failed to lock chat %s for raid mode", chat_id)
+        self._locked_by_raid[chat_id] = locked_here
+        write_queue.put_settings(chat_id, {"raid_until": until, "raid_locked": int(locked_here)})
+        self._arm(bot, chat_id, self.cooldown)
+        logger.warning("Raid detected in chat %s — raid mode for %ds", chat_id, self.cooldown)
+        outbound.post(
+            PRIO_NOTICE,
+            chat_id,
+            bot.send_message,
+            chat_id,
+            f"🚨 Join raid detected. New members are restricted"
+            f"{' and the chat is locked' if locked_here else ''} for {self.cooldown // 60} minutes.",
+        )
+
+    def _arm(self, bot, chat_id: int, delay: float):
+        old = self._timers.pop(chat_id, None)
+        if old is not None:
+            old.cancel()
+        self._timers[chat_id] = asyncio.create_task(self._end_after(bot, chat_id, delay))
+
+    async def _end_after(self, bot, chat_id: int, delay: float):
+        await asyncio.sleep(max(0.0, delay))
+        self._timers.pop(chat_id, None)
+        try:
+            await self._end(bot, chat_id)
+        except Exception:
+            logger.exception("Failed to end raid mode in chat %s", chat_id)
+
+    async def _end(self, bot, chat_id: int):
+        self._until.pop(chat_id, None)
+        locked_here = self._locked_by_raid.pop(chat_id, False)
+        unlocked = False
+        if locked_here:
+            s = await load_chat_settings(chat_id)
+            # an admin may already have unlocked it by hand
+            if s.locked and await unlock_chat_permissions(bot, chat_id):
+                s.locked = False
+                await save_chat_settings(chat_id, s)
+                unlocked = True
+        write_queue.put_settings(chat_id, {"raid_until": 0, "raid_locked": 0})
+        logger.info("Raid mode ended in chat %s", chat_id)
+        outbound.post(
+            PRIO_NOTICE,
+            chat_id,
+            bot.send_message,
+            chat_id,
+            "Raid mode ended." + (" Chat unlocked." if unlocked else ""),
+        )
+
+    async def resume(self, bot):
+        """Re-arm timers for raids that were running when the bot stopped; overdue ones end now."""
+        async with db_pool.read() as db:
+            rows = await db.execute_fetchall(
+                "SELECT chat_id, raid_until, raid_locked FROM chat_settings WHERE raid_until > 0"
+            )
+        now = time.time()
+        for chat_id, until, locked in rows:
+            self._until[chat_id] = until
+            self._locked_by_raid[chat_id] = bool(locked)
+            self._arm(bot, chat_id, until - now)
+        if rows:
+            logger.info("Resumed raid mode timers for %d chats", len(rows))
+
+    async def stop(self):
+        timers = list(self._timers.values())
+        for timer in timers:
+            timer.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        self._timers.clear()
+
+
+raid_guard = RaidGuard()
 
 
 # --------------------- Member join & leave & message moderation ---------------------
-# on_member_join updated earlier; keep as-is (sends welcome)
 async def on_member_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Sends configured welcome for each new member.
-    + Shows who added the user OR if they joined via link.
+    Queues new members for the chat's coalesced welcome (see WelcomeBatcher),
+    which also shows who added a lone joiner or that they joined via link.
     """
     msg = update.effective_message
     if not msg or not msg.new_chat_members:
@@ -1098,78 +3458,15 @@ async def on_member_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not chat_id:
         return
 
-    # Reload latest settings
-    try:
-        await load_chat_settings(chat_id)
-    except Exception:
-        logger.exception("Failed to load chat settings for welcome.")
-
-    s = chat_settings_cache.get(chat_id, {})
-    welcome_template = s.get("welcome", WELCOME_FALLBACK)
-
-    inviter = msg.from_user  # person who added them (or self-joined)
-
-    for member in msg.new_chat_members:
-
-        # ---------------------------
-        # Detect inviter
-        # ---------------------------
-        if inviter and inviter.id != member.id:
-            added_line = f"🫂 <b>Added by:</b> {inviter.first_name}"
-        else:
-            added_line = "🟢 <b>Joined via link / self-joined</b>"
-
-        # Build caption
-        try:
-            first = member.first_name or ""
-            uname = f"@{member.username}" if member.username else ""
-            try:
-                formatted = welcome_template.format(first_name=first, username=uname)
-            except Exception:
-                formatted = welcome_template
-        except Exception:
-            formatted = WELCOME_FALLBACK
-
-        final_caption = (
-            f"🎉 <b>Welcome {member.first_name}!</b>\n"
-            f"{added_line}\n\n"
-            f"{formatted}"
-        )
-
-        # Send photo / video / text
-        try:
-            if s.get("welcome_photo"):
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=s["welcome_photo"],
-                    caption=final_caption,
-                    parse_mode="HTML"
-                )
-            elif s.get("welcome_video"):
-                await context.bot.send_video(
-                    chat_id=chat_id,
-                    video=s["welcome_video"],
-                    caption=final_caption,
-                    parse_mode="HTML"
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=final_caption,
-                    parse_mode="HTML"
-                )
-        except Exception:
-            # Fallback minimal welcome
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Welcome, {member.first_name}!"
-                )
-            except Exception:
-                logger.exception(
-                    "Failed to send welcome message for member %s in chat %s",
-                    getattr(member, "id", None), chat_id
-                )
+    members = [m for m in msg.new_chat_members if m.id != context.bot.id]
+    if not members:
+        return
+    for member in members:
+        user_directory.observe(member, chat_id)
+    # during a raid joiners are restricted and nobody is welcomed
+    if await raid_guard.on_joins(context.bot, chat_id, members):
+        return
+    welcome_batcher.add(context.bot, chat_id, members, msg.from_user)
 
 
 # NEW: on_member_left handler (goodbye)
@@ -1193,9 +3490,9 @@ async def on_member_left(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         logger.exception("Failed to load chat settings for bye.")
 
-    s = chat_settings_cache.get(chat_id, {})
-    bye_template = s.get("bye_text", "") or ""
-    bye_photo = s.get("bye_photo", None)
+    s = chat_settings_cache.get(chat_id, DEFAULT_SETTINGS)
+    bye_template = s.bye_text or ""
+    bye_photo = s.bye_photo
 
     # format with first_name
     name = left.first_name or left.full_name or ""
@@ -1211,73 +3508,380 @@ async def on_member_left(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         text = f"Goodbye, {name}!"
 
-    # Send photo if configured; else send text
+    # Send photo if configured (falling back to plain text); queued without waiting for delivery
+    def send_text():
+        outbound.post(PRIO_NOTICE, chat_id, context.bot.send_message, chat_id=chat_id, text=text, parse_mode="HTML")
+
     try:
         if bye_photo:
-            try:
-                await context.bot.send_photo(chat_id=chat_id, photo=bye_photo, caption=text, parse_mode="HTML")
-            except Exception:
-                # fallback plain text
-                await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+            outbound.post(
+                PRIO_NOTICE,
+                chat_id,
+                context.bot.send_photo,
+                chat_id=chat_id,
+                photo=bye_photo,
+                caption=text,
+                parse_mode="HTML",
+                fallback=send_text,
+            )
         else:
-            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+            send_text()
     except Exception:
         logger.exception("Failed to send bye message for member %s in chat %s", getattr(left, "id", None), chat_id)
 
 
+# --------------------- Moderation pipeline ---------------------
+class ModContext:
+    """Per-message state handed to every moderation stage; the admin lookup runs at most once."""
+
+    __slots__ = ("update", "context", "message", "user", "chat_id", "settings", "verdict", "fingerprint", "_admin")
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, settings: ChatSettings, verdict: ContentVerdict):
+        self.update = update
+        self.context = context
+        self.message = update.effective_message
+        self.user = self.message.from_user
+        self.chat_id = update.effective_chat.id
+        self.settings = settings
+        self.verdict = verdict
+        # content sketch computed by the duplicate stage's check
+        self.fingerprint: Optional[Tuple[int, ...]] = None
+        self._admin: Optional[bool] = None
+
+    async def exempt(self, skip_bots: bool) -> bool:
+        """Chat admins (or global ADMINS) are never moderated; bots only by stages that skip them."""
+        if skip_bots and self.user.is_bot:
+            return True
+        if self._admin is None:
+            self._admin = await is_user_admin(self.update, self.context, self.user.id)
+        return self._admin
+
+
+class StageTimer:
+    """Run/fire counters and the last `keep` durations (ns) of one pipeline stage."""
+
+    __slots__ = ("runs", "fired", "samples")
+
+    def __init__(self, keep: int = 2048):
+        self.runs = 0
+        self.fired = 0
+        self.samples: deque = deque(maxlen=keep)
+
+    def record(self, elapsed_ns: int, fired: bool):
+        self.runs += 1
+        if fired:
+            self.fired += 1
+        self.samples.append(elapsed_ns)
+
+    def percentiles(self) -> Tuple[float, float]:
+        """(p50, p99) of the recent samples, in microseconds."""
+        if not self.samples:
+            return 0.0, 0.0
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return ordered[last // 2] / 1000.0, ordered[(last * 99) // 100] / 1000.0
+
+
+class ModRule:
+    """
+    One pipeline stage. check(mc) is a cheap synchronous predicate; only when it
+    fires is the sender's exemption looked up and action(mc, rule) run. An action
+    that returns False decided there was nothing to do, and the pipeline goes on.
+    Admins are always exempt; bots only when skip_bots is set.
+    For warn rules, notice/ban_notice are format strings taking {name} and {warns},
+    and ban_reason is a string or a callable taking the ModContext.
+    """
+
+    __slots__ = ("name", "check", "action", "skip_bots", "source", "notice", "ban_notice", "ban_reason", "timer")
+
+    def __init__(
+        self,
+        name: str,
+        check,
+        action,
+        skip_bots: bool = False,
+        source: str = "",
+        notice: str = "",
+        ban_notice: str = "",
+        ban_reason="",
+    ):
+        self.name = name
+        self.check = check
+        self.action = action
+        self.skip_bots = skip_bots
+        self.source = source
+        self.notice = notice
+        self.ban_notice = ban_notice
+        self.ban_reason = ban_reason
+        self.timer = StageTimer()
+
+
+async def enforce_delete(mc: ModContext, rule: ModRule):
+    outbound.post(PRIO_ENFORCE, mc.chat_id, mc.message.delete)
+
+
+async def _auto_ban(bot, chat_id: int, user, rule: ModRule, reason: str, warns: int):
+    # the ban record and the notice only make sense once Telegram accepted the ban
+    try:
+        await outbound.call(PRIO_ENFORCE, chat_id, bot.ban_chat_member, chat_id, user.id)
+    except Exception:
+        logger.exception("Failed auto-ban (%s) for user %s in chat %s", rule.name, user.id, chat_id)
+        return
+    await record_ban(chat_id, user.id, user.username or None, None, reason)
+    outbound.post(
+        PRIO_NOTICE,
+        chat_id,
+        bot.send_message,
+        chat_id,
+        rule.ban_notice.format(name=user.full_name or user.first_name, warns=warns),
+    )
+
+
+async def enforce_warn(mc: ModContext, rule: ModRule):
+    """
+    Delete the message, record a warn, post the notice, and ban when the warn limit
+    is crossed. The delete and notice are queued without waiting and the ban chain
+    runs as a side effect, so the handler only waits for the warn count.
+    """
+    chat_id, user, bot = mc.chat_id, mc.user, mc.context.bot
+    outbound.post(PRIO_ENFORCE, chat_id, mc.message.delete)
+    new, crossed = await add_warn(chat_id, user.id, rule.source)
+    outbound.post(
+        PRIO_NOTICE,
+        chat_id,
+        bot.send_message,
+        chat_id,
+        rule.notice.format(name=user.first_name, warns=new),
+        coalesce_key=("warn", chat_id, user.id),
+    )
+    if crossed:
+        reason = rule.ban_reason(mc) if callable(rule.ban_reason) else rule.ban_reason
+        await side_effects.spawn(_auto_ban(bot, chat_id, user, rule, reason, new), f"auto-ban:{rule.name}")
+
+
+def _spam_check(mc: ModContext) -> bool:
+    # every message that reaches this stage counts towards the window, even when spam protection is off
+    recent = spam_windows.hit((mc.chat_id, mc.user.id), time.monotonic())
+    return bool(mc.settings.flags & FLAG_SPAM) and recent > mc.settings.spam_limit
+
+
+def _cross_chat_check(mc: ModContext) -> bool:
+    if CROSS_CHAT_ACTION == "off" or mc.chat_id > 0:
+        return False
+    return cross_chat_windows.activate(mc.user.id, mc.chat_id, time.monotonic()) > CROSS_CHAT_THRESHOLD
+
+
+async def _ban_everywhere(bot, user, chats: List[int], reason: str):
+    """Ban user in each chat (skipping chats where they are admin), at most CROSS_CHAT_BAN_CONCURRENCY at a time."""
+    sem = asyncio.Semaphore(max(1, CROSS_CHAT_BAN_CONCURRENCY))
+
+    async def ban_one(chat_id: int) -> bool:
+        async with sem:
+            try:
+                if user.id in await admin_cache.get_admins(bot, chat_id):
+                    return False
+                await outbound.call(PRIO_ENFORCE, chat_id, bot.ban_chat_member, chat_id, user.id)
+            except Exception:
+                logger.exception("Cross-chat ban failed for user %s in chat %s", user.id, chat_id)
+                return False
+        await record_ban(chat_id, user.id, user.username or None, None, reason)
+        return True
+
+    banned = await asyncio.gather(*(ban_one(c) for c in chats))
+    logger.warning("Cross-chat flood: banned user %s in %d of %d chats", user.id, sum(banned), len(chats))
+
+
+async def enforce_cross_chat(mc: ModContext, rule: ModRule):
+    """
+    Delete the message and ban the sender in every chat they recently spread into.
+    The window entry is dropped first, so the user's next messages do not re-trigger
+    the sweep while the bans are still in flight.
+    """
+    chat_id, user, bot = mc.chat_id, mc.user, mc.context.bot
+    chats = cross_chat_windows.chats_of(user.id)
+    cross_chat_windows.forget(user.id)
+    outbound.post(PRIO_ENFORCE, chat_id, mc.message.delete)
+    outbound.post(
+        PRIO_NOTICE,
+        chat_id,
+        bot.send_message,
+        chat_id,
+        rule.ban_notice.format(name=user.full_name or user.first_name, warns=len(chats)),
+    )
+    await side_effects.spawn(_ban_everywhere(bot, user, chats, rule.ban_reason), f"cross-chat-ban:{user.id}")
+
+
+def _duplicate_check(mc: ModContext) -> bool:
+    # only fingerprints here; the tracker is fed from the action, after the exemption check,
+    # so admins and bots neither count towards DUP_USERS nor consume a detected flood
+    if DUP_USERS <= 0 or mc.chat_id > 0:
+        return False
+    text = mc.message.text or mc.message.caption
+    mc.fingerprint = content_fingerprint(text) if text else None
+    return mc.fingerprint is not None
+
+
+async def _delete_duplicates(bot, chat_id: int, pairs: List[Tuple[int, int]]):
+    """Bulk-delete the collected copies, leaving admins' messages alone; falls back to one delete per message."""
+    try:
+        admins = await admin_cache.get_admins(bot, chat_id)
+    except Exception:
+        admins = frozenset()
+    ids = [mid for uid, mid in pairs if uid not in admins and uid not in ADMINS]
+    if not ids:
+        return
+    if hasattr(bot, "delete_messages"):
+        try:
+            for i in range(0, len(ids), 100):
+                await outbound.call(PRIO_ENFORCE, chat_id, bot.delete_messages, chat_id, ids[i:i + 100])
+            logger.info("Deleted %d near-duplicate messages in chat %s", len(ids), chat_id)
+            return
+        except Exception:
+            logger.debug("Bulk delete failed in chat %s, deleting one by one", chat_id, exc_info=True)
+    for mid in ids:
+        outbound.post(PRIO_ENFORCE, chat_id, bot.delete_message, chat_id, mid)
+
+
+async def enforce_duplicates(mc: ModContext, rule: ModRule):
+    """
+    Record the fingerprint; once it completes a flood, delete this copy right away
+    and the earlier copies in one bulk delete. False when there is no flood (yet).
+    """
+    found = dup_tracker.observe(mc.chat_id, mc.user.id, mc.message.message_id, mc.fingerprint, time.monotonic())
+    if found is None:
+        return False
+    outbound.post(PRIO_ENFORCE, mc.chat_id, mc.message.delete)
+    earlier = [p for p in found if p[1] != mc.message.message_id]
+    if earlier:
+        await side_effects.spawn(_delete_duplicates(mc.context.bot, mc.chat_id, earlier), f"dup-delete:{mc.chat_id}")
+
+
+# Ordered cheapest first; the first stage that fires, is not exempt and acts ends the pipeline.
+MOD_PIPELINE = [
+    ModRule("lock", lambda mc: bool(mc.settings.flags & FLAG_LOCKED), enforce_delete),
+    # runs ahead of the content rules so every group message counts towards the user's spread
+    ModRule(
+        "crosschat",
+        _cross_chat_check,
+        enforce_cross_chat,
+        skip_bots=True,
+        ban_notice="{name} was banned for flooding {warns} chats at once.",
+        ban_reason="auto-cross-chat-flood",
+    ),
+    ModRule(
+        "link",
+        lambda mc: bool(mc.settings.flags & FLAG_ANTI_LINK) and mc.verdict.link,
+        enforce_warn,
+        source="link",
+        notice="Links are not allowed — {name} was warned. Warns: {warns}",
+        ban_notice="{name} was banned after reaching {warns} warns (links).",
+        ban_reason=f"auto-link-{WARN_BAN_LIMIT}",
+    ),
+    ModRule(
+        "profanity",
+        lambda mc: mc.verdict.profanity,
+        enforce_warn,
+        skip_bots=True,
+        source="profanity",
+        notice="{name}, inappropriate language is not allowed. Warns: {warns}",
+        ban_notice="{name} was banned after reaching {warns} warns (bad language).",
+        ban_reason=f"auto-profanity-{WARN_BAN_LIMIT}",
+    ),
+    ModRule(
+        "spam",
+        _spam_check,
+        enforce_warn,
+        source="spam",
+        notice="{name}, please stop spamming. You were warned. Warns: {warns}",
+        ban_notice="{name} was banned after reaching {warns} warns (spam).",
+        ban_reason=lambda mc: mc.settings.spam_ban_reason,
+    ),
+    # fingerprinting is the costliest check, so it only sees messages every other stage let through
+    ModRule("duplicate", _duplicate_check, enforce_duplicates, skip_bots=True),
+]
+
+
+async def run_moderation(mc: ModContext) -> bool:
+    """Run the stages in order; True when one of them acted on the message."""
+    perf = time.perf_counter_ns
+    for rule in MOD_PIPELINE:
+        started = perf()
+        fired = False
+        try:
+            fired = bool(rule.check(mc)) and not await mc.exempt(rule.skip_bots)
+            if fired:
+                fired = await rule.action(mc, rule) is not False
+        except Exception:
+            logger.exception("Moderation stage %s failed in chat %s", rule.name, mc.chat_id)
+        rule.timer.record(perf() - started, fired)
+        if fired:
+            return True
+    return False
+
+
+async def modstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/modstats (bot owners only) — per-stage counters and recent p50/p99 latency."""
+    user = update.effective_user
+    if not user or user.id not in ADMINS:
+        await update.effective_message.reply_text("Only bot owners can use this command.")
+        return
+    lines = ["Moderation stages — runs / fired / p50 / p99:"]
+    for rule in MOD_PIPELINE:
+        p50, p99 = rule.timer.percentiles()
+        lines.append(f"{rule.name}: {rule.timer.runs} / {rule.timer.fired} / {p50:.0f}µs / {p99:.0f}µs")
+    c = chat_settings_cache.stats()
+    lines.append(f"Settings cache: {c['size']} chats, {c['hits']} hits, {c['misses']} misses, {c['evictions']} evictions")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # route "start"
+    # route "start" (only lowercase the text when it could be the word itself)
     if update.effective_message and update.effective_message.text:
-        txt = update.effective_message.text.strip().lower()
-        if txt == "start":
+        txt = update.effective_message.text.strip()
+        if len(txt) == 5 and txt.lower() == "start":
             await start_cmd(update, context)
             return
 
     message = update.effective_message
     if not message or not message.from_user:
         return
-    user = message.from_user
     chat_id = update.effective_chat.id
+    user_directory.observe(message.from_user, chat_id)
 
-    await load_chat_settings(chat_id)
-    s = chat_settings_cache[chat_id]
-
+    s = await load_chat_settings(chat_id)
 
+    # Scan the content once; every rule below branches on this verdict
+    triggers = s.sticker_triggers or {}
+    matcher = get_trigger_matcher(chat_id, triggers) if message.text and triggers else None
+    verdict = classify_content(message.text or message.caption or "", matcher)
 
-
-    # If chat is locked, optionally delete messages from non-admins (set_chat_permissions already prevents sending, but some clients still allow via bots/api)
-    if s.get("locked", False) and not await is_user_admin(update, context, user.id):
-        try:
-            await message.delete()
-        except Exception:
-            pass
+    # lock, anti-link, profanity and spam rules; a message one of them acted on is done
+    if await run_moderation(ModContext(update, context, s, verdict)):
         return
 
      # Sticker trigger handling: match trigger as substring (works when message contains @username + phrase)
     if message.text:
         raw_text = message.text
-        txt = raw_text.lower()
-        triggers = s.get("sticker_triggers", {}) or {}
-
-        matched_trigger = None
-        matched_file_id = None
-        for trigger_phrase, file_id in triggers.items():
-            if not trigger_phrase:
-                continue
-            if trigger_phrase.lower() in txt:
-                matched_trigger = trigger_phrase
-                matched_file_id = file_id
-                break
+        matched_trigger = verdict.trigger
+        matched_file_id = triggers.get(matched_trigger) if matched_trigger else None
 
         if matched_trigger and matched_file_id:
-            # send sticker (best effort)
-            try:
-                await context.bot.send_sticker(chat_id, matched_file_id)
-            except Exception:
-                try:
-                    await context.bot.send_message(chat_id, f"(sticker unavailable for trigger '{matched_trigger}')")
-                except Exception:
-                    pass
+            # send sticker (best effort); replies are queued, never awaited, so a busy chat's
+            # reply budget cannot hold up moderation of its next updates
+            outbound.post(
+                PRIO_REPLY,
+                chat_id,
+                context.bot.send_sticker,
+                chat_id,
+                matched_file_id,
+                fallback=lambda: outbound.post(
+                    PRIO_REPLY,
+                    chat_id,
+                    context.bot.send_message,
+                    chat_id,
+                    f"(sticker unavailable for trigger '{matched_trigger}')",
+                ),
+            )
 
             # Determine mention_target_html (clickable) if possible
             mention_html = None
@@ -1302,17 +3906,16 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                 length = ent.length
                                 username_text = raw_text[start : start + length]  # like "@rohit_2007_18_11"
                                 username = username_text.lstrip("@")
-                                # try resolving username to a chat (this returns a Chat/User-like object)
+                                # resolve from the local user directory (no Telegram round-trip)
                                 try:
-                                    chat_obj = await context.bot.get_chat(username)
-                                    # chat_obj.id is the user's id when username refers to a user
-                                    user_id = getattr(chat_obj, "id", None)
-                                    display = username_text  # keep @username as visible text
+                                    known = await user_directory.lookup(username)
+                                    user_id = known[0] if known else None
+                                    display = html.escape(username_text)  # keep @username as visible text
                                     if user_id:
                                         mention_html = f'<a href="tg://user?id={user_id}">{display}</a>'
                                         break
                                 except Exception:
-                                    # resolution failed (user may not exist or privacy); continue to next entity
+                                    # lookup failed; continue to next entity
                                     mention_html = None
                                     continue
                 except Exception:
@@ -1325,141 +3928,28 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 except Exception:
                     mention_html = getattr(message.from_user, "first_name", "Someone")
 
-            # Send message replying to original with HTML parse_mode so mention works
-            try:
-                await context.bot.send_message(
+            # Send message replying to original with HTML parse_mode so mention works;
+            # final fallback: plain text without HTML mention
+            outbound.post(
+                PRIO_REPLY,
+                chat_id,
+                context.bot.send_message,
+                chat_id,
+                f"{mention_html} triggered: '{matched_trigger}'",
+                parse_mode="HTML",
+                reply_to_message_id=message.message_id,
+                fallback=lambda: outbound.post(
+                    PRIO_REPLY,
                     chat_id,
-                    f"{mention_html} triggered: '{matched_trigger}'",
-                    parse_mode="HTML",
+                    context.bot.send_message,
+                    chat_id,
+                    f"{getattr(message.from_user, 'first_name', 'Someone')} triggered: '{matched_trigger}'",
                     reply_to_message_id=message.message_id,
-                )
-            except Exception:
-                # final fallback: plain text without HTML mention
-                try:
-                    await context.bot.send_message(
-                        chat_id,
-                        f"{getattr(message.from_user, 'first_name', 'Someone')} triggered: '{matched_trigger}'",
-                        reply_to_message_id=message.message_id,
-                    )
-                except Exception:
-                    pass
+                ),
+            )
 
             return
 
-    # Anti-link: now enforced via toggle + auto-ban on 3 warns
-    if s.get("anti_link", True):
-        text = message.text or message.caption or ""
-        if text and LINK_PATTERN.search(text):
-            if not await is_user_admin(update, context, user.id):
-                # delete message if possible
-                try:
-                    await message.delete()
-                except Exception:
-                    pass
-                # increment warn
-                new = await change_warns(chat_id, user.id, 1)
-                try:
-                    await context.bot.send_message(chat_id, f"Links are not allowed — {user.first_name} was warned. Warns: {new}")
-                except Exception:
-                    pass
-                # auto-ban on 3 warns
-                if new >= 3:
-                    try:
-                        await context.bot.ban_chat_member(chat_id, user.id)
-                        await record_ban(chat_id, user.id, user.username or None, None, "auto-link-3")
-                        try:
-                            await context.bot.send_message(chat_id, f"{user.full_name} was banned after reaching {new} warns (links).")
-                        except Exception:
-                            pass
-                    except Exception as e:
-                        logger.exception("Failed to auto-ban user for link warns: %s", e)
-                return
-    
-    # --------------------- PROFANITY CHECK ---------------------
-    try:
-        text_for_check = (message.text or message.caption or "") or ""
-        if text_for_check and BAD_WORDS_RE.search(text_for_check):
-            # skip bots
-            if message.from_user and message.from_user.is_bot:
-                pass
-            else:
-                uid = message.from_user.id if message.from_user else None
-                # skip chat admins / global ADMINS
-                if uid and await is_user_admin(update, context, uid):
-                    # admins are not moderated
-                    pass
-                else:
-                    # Try to delete the offending message (best effort)
-                    try:
-                        await message.delete()
-                    except Exception:
-                        logger.debug("Could not delete profane message (may lack permission).")
-
-                    # issue a warn using existing helper
-                    new_warns = await change_warns(chat_id, uid, 1)
-
-                    # notify (best-effort)
-                    try:
-                        await context.bot.send_message(chat_id, f"{message.from_user.first_name}, inappropriate language is not allowed. Warns: {new_warns}")
-                    except Exception:
-                        logger.debug("Could not send profanity warn message.")
-
-                    # auto-ban on 3 warns (same behaviour as existing flows)
-                    if new_warns >= 3:
-                        try:
-                            await context.bot.ban_chat_member(chat_id, uid)
-                            await record_ban(chat_id, uid, message.from_user.username or None, None, "auto-profanity-3")
-                            try:
-                                await context.bot.send_message(chat_id, f"{message.from_user.full_name or message.from_user.first_name} was banned after reaching {new_warns} warns (bad language).")
-                            except Exception:
-                                pass
-                        except Exception:
-                            logger.exception("Failed auto-ban for profanity on user %s in chat %s", uid, chat_id)
-
-                    # stop further processing of this message
-                    return
-    except Exception as e:
-        logger.exception("Profanity filter failed: %s", e)
-
-
-    # Anti-spam (per-chat configurable)
-    now = time.time()
-    dq = message_history[user.id][chat_id]
-    dq.append(now)
-    while dq and now - dq[0] > SPAM_WINDOW_SEC:
-        dq.popleft()
-
-    # respect per-chat spam toggle/limit
-    spam_enabled = s.get("spam_enabled", True)
-    spam_limit = int(s.get("spam_limit", SPAM_MAX_MSG))
-
-    if spam_enabled and len(dq) > spam_limit and not await is_user_admin(update, context, user.id):
-        # delete offending message (best effort)
-        try:
-            await message.delete()
-        except Exception:
-            pass
-
-        new = await change_warns(chat_id, user.id, 1)
-        try:
-            await context.bot.send_message(chat_id, f"{user.first_name}, please stop spamming. You were warned. Warns: {new}")
-        except Exception:
-            pass
-
-        # auto-ban after 3 warns (same behaviour as existing flows)
-        if new >= 3:
-            try:
-                reason = s.get("spam_ban_reason", "auto-spam-limit")
-                await context.bot.ban_chat_member(chat_id, user.id)
-                await record_ban(chat_id, user.id, user.username or None, None, reason)
-                try:
-                    await context.bot.send_message(chat_id, f"{user.full_name} was banned after reaching {new} warns (spam).")
-                except Exception:
-                    pass
-            except Exception:
-                logger.exception("Failed auto-ban for spam on user %s in chat %s", user.id, chat_id)
-        return
-
 
 # --------------------- CallbackQuery handler ---------------------
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1529,6 +4019,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 "Rules: /setrules <text> (admin) — set rules; /rules — show rules; /delrules (admin) — delete rules\n\n"
 "Moderation & utility:\n"
 "/ban /unban /unbanall /banlog /kick /mute /unmute /warn /warnings\n"
+"/setwarn_decay <days> (admin) — warns older than this stop counting (0 = never)\n"
+"/modstats (bot owners) — moderation stage counters and latency\n"
 "/info — reply to a user (admin-only) to view user id and details\n"
 "/report — reply to a message and send /report <reason> to notify admins\n"
 "/ginfo — show group info\n"
@@ -1548,24 +4040,44 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send(chat_id, "Ban log is admin-only. Use /help for available commands.")
             return
         try:
-            rows = await get_bans_for_chat(chat_id)
+            rows, has_newer, has_older = await fetch_ban_page(chat_id)
             if not rows:
                 await send(chat_id, "No bans recorded for this chat.")
                 return
-            lines = []
-            for user_id, username, mod_id, reason, banned_at in rows:
-                ts = datetime.fromtimestamp(banned_at).strftime("%Y-%m-%d %H:%M") if banned_at else "(unknown)"
-                uname = f"@{username}" if username else "(no username)"
-                mod_text = f"{mod_id}" if mod_id else "(unknown)"
-                reason_text = f" — {reason}" if reason else ""
-                lines.append(f"• <code>{user_id}</code> — {uname}\n   banned at: {ts} by {mod_text}{reason_text}")
-            text = "<b>Ban Log:</b>\n\n" + "\n\n".join(lines)
-            await send(chat_id, text)
+            text, kb = render_ban_page(rows, has_newer, has_older)
+            await send(chat_id, text, reply_markup=kb)
         except Exception:
             logger.exception("Failed to handle cmd_banlog")
             await send(chat_id, "Failed to fetch ban log. Try /banlog.")
         return
 
+    # BAN LOG paging: banlog:<n|o>:<banned_at>:<user_id>
+    if data.startswith("banlog:"):
+        if not await clicker_is_admin():
+            try:
+                await q.answer(text="Ban log is admin-only.", show_alert=False)
+            except Exception:
+                await send(chat_id, "Ban log is admin-only. Use /help for available commands.")
+            return
+        try:
+            _, direction, banned_at, user_id = data.split(":")
+            key = (int(banned_at), int(user_id))
+            if direction == "n":
+                rows, has_newer, has_older = await fetch_ban_page(chat_id, newer_than=key)
+            else:
+                rows, has_newer, has_older = await fetch_ban_page(chat_id, older_than=key)
+            if not rows:
+                rows, has_newer, has_older = await fetch_ban_page(chat_id)
+            if not rows:
+                await q.message.edit_text("No bans recorded for this chat.")
+                return
+            text, kb = render_ban_page(rows, has_newer, has_older)
+            await q.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+        except Exception:
+            logger.exception("Failed to page ban log")
+            await send(chat_id, "Failed to fetch ban log. Try /banlog.")
+        return
+
     # Toggle anti-link button (admin-only)
     if data == "cmd_toggle_link":
         if not await clicker_is_admin():
@@ -1575,17 +4087,15 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send(chat_id, "This action is for chat admins only.")
             return
         try:
-            await load_chat_settings(chat_id)
-            s = chat_settings_cache.get(chat_id, {})
-            current = bool(s.get("anti_link", True))
-            s["anti_link"] = not current
-            chat_settings_cache[chat_id] = s
-            await save_chat_settings(chat_id)
+            s = await load_chat_settings(chat_id)
+            current = bool(s.anti_link)
+            s.anti_link = not current
+            await save_chat_settings(chat_id, s)
             try:
                 await q.message.edit_reply_markup(reply_markup=build_full_commands_menu(chat_id))
             except Exception:
                 pass
-            state_txt = "ON" if s["anti_link"] else "OFF"
+            state_txt = "ON" if s.anti_link else "OFF"
             await send(chat_id, f"Anti-link is now: {state_txt}")
         except Exception as e:
             logger.exception("Failed toggling anti-link: %s", e)
@@ -1601,9 +4111,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send(chat_id, "This action is for chat admins only.")
             return
         try:
-            await load_chat_settings(chat_id)
-            s = chat_settings_cache.get(chat_id, {})
-            locked = bool(s.get("locked", False))
+            s = await load_chat_settings(chat_id)
+            locked = bool(s.locked)
             # flip
             new_locked = not locked
             if new_locked:
@@ -1611,9 +4120,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 ok = await unlock_chat_permissions(context.bot, chat_id)
             if ok:
-                s["locked"] = new_locked
-                chat_settings_cache[chat_id] = s
-                await save_chat_settings(chat_id)
+                s.locked = new_locked
+                await save_chat_settings(chat_id, s)
                 try:
                     await q.message.edit_reply_markup(reply_markup=build_full_commands_menu(chat_id))
                 except Exception:
@@ -1640,17 +4148,15 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send(chat_id, "This action is for chat admins only.")
             return
         try:
-            await load_chat_settings(chat_id)
-            s = chat_settings_cache.get(chat_id, {})
-            current = bool(s.get("spam_enabled", True))
-            s["spam_enabled"] = not current
-            chat_settings_cache[chat_id] = s
-            await save_chat_settings(chat_id)
+            s = await load_chat_settings(chat_id)
+            current = bool(s.spam_enabled)
+            s.spam_enabled = not current
+            await save_chat_settings(chat_id, s)
             try:
                 await q.message.edit_reply_markup(reply_markup=build_full_commands_menu(chat_id))
             except Exception:
                 pass
-            state_txt = "ON" if s["spam_enabled"] else "OFF"
+            state_txt = "ON" if s.spam_enabled else "OFF"
             await send(chat_id, f"Spam protection is now: {state_txt}")
         except Exception as e:
             logger.exception("Failed toggling spam: %s", e)
@@ -1672,17 +4178,15 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await send(chat_id, "This action is for chat admins only.")
             return
         try:
-            await load_chat_settings(chat_id)
-            s = chat_settings_cache.get(chat_id, {})
-            current = bool(s.get("spam_enabled", True))
-            s["spam_enabled"] = not current
-            chat_settings_cache[chat_id] = s
-            await save_chat_settings(chat_id)
+            s = await load_chat_settings(chat_id)
+            current = bool(s.spam_enabled)
+            s.spam_enabled = not current
+            await save_chat_settings(chat_id, s)
             try:
                 await q.message.edit_reply_markup(reply_markup=build_full_commands_menu(chat_id))
             except Exception:
                 pass
-            state_txt = "ON" if s["spam_enabled"] else "OFF"
+            state_txt = "ON" if s.spam_enabled else "OFF"
             await send(chat_id, f"Spam protection is now: {state_txt}")
         except Exception as e:
             logger.exception("Failed toggling spam: %s", e)
@@ -1770,9 +4274,29 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --------------------- Periodic job wrapper ---------------------
+def flush_chat_activity():
+    """Hand the last-seen times collected since the previous call to the settings write path."""
+    if not chat_activity:
+        return
+    seen = dict(chat_activity)
+    chat_activity.clear()
+    for cid, ts in seen.items():
+        write_queue.put_settings(cid, {"last_seen": ts})
+
+
 async def periodic_job(context: ContextTypes.DEFAULT_TYPE):
     try:
-        await clear_expired_mutes(context.application)
+        raid_guard.joins.sweep(time.monotonic())
+        removed = spam_windows.sweep(time.monotonic())
+        if removed:
+            logger.debug("Swept %d idle spam windows (%d tracked)", removed, len(spam_windows))
+        cross_chat_windows.sweep(time.monotonic())
+        dup_tracker.sweep(time.monotonic())
+        admin_cache.sweep(time.monotonic())
+        outbound.sweep()
+        flush_chat_activity()
+        await user_directory.flush()
+        logger.debug("Settings cache: %s", chat_settings_cache.stats())
     except Exception as e:
         logger.exception("Periodic job failed: %s", e)
 
@@ -1784,9 +4308,9 @@ async def lock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     ok = await lock_chat_permissions(context.bot, chat_id)
     if ok:
-        await load_chat_settings(chat_id)
-        chat_settings_cache[chat_id]["locked"] = True
-        await save_chat_settings(chat_id)
+        s = await load_chat_settings(chat_id)
+        s.locked = True
+        await save_chat_settings(chat_id, s)
         await update.effective_message.reply_text("Chat has been locked (non-admins cannot send messages).")
     else:
         await update.effective_message.reply_text("Failed to lock chat — ensure I have permission to change chat settings.")
@@ -1798,9 +4322,9 @@ async def unlock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     ok = await unlock_chat_permissions(context.bot, chat_id)
     if ok:
-        await load_chat_settings(chat_id)
-        chat_settings_cache[chat_id]["locked"] = False
-        await save_chat_settings(chat_id)
+        s = await load_chat_settings(chat_id)
+        s.locked = False
+        await save_chat_settings(chat_id, s)
         await update.effective_message.reply_text("Chat has been unlocked.")
     else:
         await update.effective_message.reply_text("Failed to unlock chat — ensure I have permission to change chat settings.")
@@ -1812,10 +4336,10 @@ async def setspam_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Usage: /setspam on|off")
         return
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["spam_enabled"] = (context.args[0].lower() == "on")
-    await save_chat_settings(chat_id)
-    await update.effective_message.reply_text(f"Spam protection set to: {'ON' if chat_settings_cache[chat_id]['spam_enabled'] else 'OFF'}")
+    s = await load_chat_settings(chat_id)
+    s.spam_enabled = (context.args[0].lower() == "on")
+    await save_chat_settings(chat_id, s)
+    await update.effective_message.reply_text(f"Spam protection set to: {'ON' if s.spam_enabled else 'OFF'}")
 
 async def setspam_limit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await require_admin(update, context):
@@ -1831,9 +4355,9 @@ async def setspam_limit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Please provide a positive integer for the limit.")
         return
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["spam_limit"] = n
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.spam_limit = n
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text(f"Spam limit updated to {n} messages (per {SPAM_WINDOW_SEC}s window).")
 
 async def setspam_reason_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1844,12 +4368,36 @@ async def setspam_reason_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     reason = " ".join(context.args).strip()
     chat_id = update.effective_chat.id
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["spam_ban_reason"] = reason
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.spam_ban_reason = reason
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text(f"Spam auto-ban reason set to: {reason}")
 
 
+async def setwarn_decay_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_admin(update, context):
+        return
+    if not context.args:
+        await update.effective_message.reply_text("Usage: /setwarn_decay <days>  — warns older than this stop counting (0 = never expire).")
+        return
+    try:
+        days = int(context.args[0])
+        if days < 0:
+            raise ValueError()
+    except Exception:
+        await update.effective_message.reply_text("Please provide a whole number of days (0 or more).")
+        return
+    chat_id = update.effective_chat.id
+    s = await load_chat_settings(chat_id)
+    s.warn_decay_days = days
+    await save_chat_settings(chat_id, s)
+    forget_chat_warns(chat_id)
+    if days:
+        await update.effective_message.reply_text(f"Warns now expire after {days} days.")
+    else:
+        await update.effective_message.reply_text("Warns no longer expire.")
+
+
 
 # --------------------- /lock_status command ---------------------
 async def lock_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1859,7 +4407,7 @@ async def lock_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     chat_id = update.effective_chat.id
     await load_chat_settings(chat_id)
-    locked = chat_settings_cache.get(chat_id, {}).get("locked", False)
+    locked = chat_settings_cache.get(chat_id, DEFAULT_SETTINGS).locked
     if locked:
         await update.effective_message.reply_text("🔒 Chat is currently locked. Only admins can send messages.")
     else:
@@ -1870,7 +4418,7 @@ async def lock_status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def rules_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     await load_chat_settings(chat_id)
-    rules = chat_settings_cache.get(chat_id, {}).get("rules_text", "") or ""
+    rules = chat_settings_cache.get(chat_id, DEFAULT_SETTINGS).rules_text
     if not rules:
         await update.effective_message.reply_text("No rules set for this chat. Admins can set rules with /setrules <text>.")
     else:
@@ -1885,9 +4433,9 @@ async def setrules_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Usage: /setrules <text>\nExample: /setrules Be respectful. No spam.")
         return
     rules_text = " ".join(context.args).strip()
-    await load_chat_settings(chat_id)
-    chat_settings_cache[chat_id]["rules_text"] = rules_text
-    await save_chat_settings(chat_id)
+    s = await load_chat_settings(chat_id)
+    s.rules_text = rules_text
+    await save_chat_settings(chat_id, s)
     await update.effective_message.reply_text("Rules updated.")
 
 
@@ -1928,19 +4476,40 @@ async def report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if adm not in admin_ids:
             admin_ids.append(adm)
 
-    forwarded_count = 0
+    # the DMs run as a side effect: each admin's report is sent before the forward, and the
+    # chat's next updates do not wait on the admins' reply budgets
+    await side_effects.spawn(
+        _deliver_report(context.bot, admin_ids, report_text, update.effective_chat, reported.message_id),
+        f"report:{update.effective_chat.id}",
+    )
+
+    await msg.reply_text(f"Report submitted. Admins notified (attempted {len(admin_ids)} admins). Thank you.")
+
+
+async def _deliver_report(bot, admin_ids: List[int], report_text: str, chat, message_id: int):
+    delivered = 0
     for admin_id in admin_ids:
         try:
-            await context.bot.send_message(admin_id, report_text, parse_mode="HTML")
-            try:
-                await context.bot.forward_message(admin_id, update.effective_chat.id, reported.message_id)
-            except Exception:
-                await context.bot.send_message(admin_id, f"(Could not forward full message) from {update.effective_chat.title or update.effective_chat.id}")
-            forwarded_count += 1
+            await outbound.call(PRIO_REPLY, admin_id, bot.send_message, admin_id, report_text, parse_mode="HTML")
         except Exception:
             continue
-
-    await msg.reply_text(f"Report submitted. Admins notified (attempted {forwarded_count} admins). Thank you.")
+        delivered += 1
+        outbound.post(
+            PRIO_REPLY,
+            admin_id,
+            bot.forward_message,
+            admin_id,
+            chat.id,
+            message_id,
+            fallback=lambda a=admin_id: outbound.post(
+                PRIO_REPLY,
+                a,
+                bot.send_message,
+                a,
+                f"(Could not forward full message) from {chat.title or chat.id}",
+            ),
+        )
+    logger.info("Report from chat %s delivered to %d of %d admins", chat.id, delivered, len(admin_ids))
 
 
 # --------------------- ginfo command ---------------------
@@ -2065,19 +4634,110 @@ async def translate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text("Translation failed: " + str(e))
 
 
+# --------------------- Update processing (per-chat ordering) ---------------------
+def _update_chat_id(update: object) -> Optional[int]:
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates from different chats concurrently while updates from the same
+    chat run strictly one after another, in arrival order. Updates without a chat
+    (e.g. inline queries) only take a concurrency slot.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # The base semaphore only bounds how many updates may wait in here. The real
+        # limit is taken after the per-chat lock, so one busy chat queueing behind
+        # itself cannot occupy every slot and stall the other chats.
+        super().__init__(max(1, max_concurrent_updates) * 16)
+        self._running = asyncio.BoundedSemaphore(max(1, max_concurrent_updates))
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat_id = _update_chat_id(update)
+        if chat_id is None:
+            async with self._running:
+                await coroutine
+            return
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            left = self._chat_waiters[chat_id] - 1
+            if left:
+                self._chat_waiters[chat_id] = left
+            else:
+                # last one out drops the lock so idle chats cost nothing
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 # --------------------- Main / startup ---------------------
+async def on_startup(application):
+    await init_db()
+    write_queue.start()
+    outbound.start()
+    await mute_scheduler.start(application.bot)
+    await unbanall_runner.resume_all(application.bot)
+    await raid_guard.resume(application.bot)
+    try:
+        warmed = await warm_chat_settings()
+        logger.info("Pre-loaded settings for %d chats", warmed)
+    except Exception as e:
+        logger.warning("Settings warm-up failed: %s", e)
+
+
+async def on_shutdown(application):
+    await mute_scheduler.stop()
+    await unbanall_runner.stop()
+    await welcome_batcher.stop()
+    await raid_guard.stop()
+    # pending auto-bans still need the outbound scheduler and the write queue
+    await side_effects.drain()
+    await outbound.stop()
+    # drain buffered warns/bans/mutes/settings before the pool goes away
+    flush_chat_activity()
+    try:
+        await user_directory.flush()
+    except Exception:
+        logger.exception("User directory flush failed at shutdown")
+    await write_queue.close()
+    await close_db()
+
+
 def main():
     if BOT_TOKEN == "REPLACE_ME" or not BOT_TOKEN:
         print("Please set BOT_TOKEN environment variable in .env file.")
         return
 
-    asyncio.run(init_db())
-
     # Ensure event loop exists
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # DB pool lives on the application's event loop: opened in post_init, closed in post_shutdown
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Commands
     app.add_handler(CommandHandler("start", start_cmd))
@@ -2123,6 +4783,8 @@ def main():
     app.add_handler(CommandHandler("warnings", warnings_cmd))
     app.add_handler(CommandHandler("setspam", setspam_cmd))
     app.add_handler(CommandHandler("setspam_limit", setspam_limit_cmd))
+    app.add_handler(CommandHandler("setwarn_decay", setwarn_decay_cmd))
+    app.add_handler(CommandHandler("modstats", modstats_cmd))
     app.add_handler(CommandHandler("setspam_reason", setspam_reason_cmd))
 
 
@@ -2138,11 +4800,16 @@ def main():
     # Callback queries
     app.add_handler(CallbackQueryHandler(callback_router))
 
-    # Job queue
-    app.job_queue.run_repeating(periodic_job, interval=30, first=10)
+    # Job queue (idle in-memory state sweeps)
+    app.job_queue.run_repeating(periodic_job, interval=60, first=60)
+    app.job_queue.run_repeating(compact_warn_events, interval=WARN_COMPACT_INTERVAL, first=300)
+
+    # Promotions / demotions (keeps the admin roster cache fresh)
+    app.add_handler(ChatMemberHandler(on_chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
 
     logger.info("Bot starting...")
-    app.run_polling()
+    # chat_member updates are only delivered when requested explicitly
+    app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_PATH", os.devnull)
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_runtime():
+    """Each test starts with empty in-memory caches."""
+    main.chat_settings_cache._entries.clear()
+    main.chat_settings_cache._loaded_at.clear()
+    main.trigger_matchers.clear()
+    main.warn_history.clear()
+    main.chat_activity.clear()
+    main.spam_windows._entries.clear()
+    main.cross_chat_windows._entries.clear()
+    main.dup_tracker._chats.clear()
+    saved = main.outbound, main.side_effects, main.admin_cache, main.raid_guard, main.welcome_batcher
+    main.admin_cache = main.AdminCache()
+    yield
+    main.outbound, main.side_effects, main.admin_cache, main.raid_guard, main.welcome_batcher = saved
+
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    Open the real pool, schema and write-behind queue on a throwaway database.
+    Tests are plain functions that drive coroutines with asyncio.run, so the
+    fixture hands back a pair of coroutine factories to bracket the test body.
+    """
+    main.db_pool.path = str(tmp_path / "bot.db")
+
+    async def start():
+        await main.init_db()
+        main.write_queue.start()
+
+    async def stop():
+        await main.write_queue.close()
+        await main.close_db()
+
+    return start, stop
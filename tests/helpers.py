@@ -0,0 +1,98 @@
+"""Stand-ins for the Telegram objects handlers touch; just enough surface for main.py."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+class FakeBot:
+    """
+    Records every Bot API call as (method, args, kwargs, monotonic time).
+    fail[method] is an exception instance raised by that method, or a list of
+    them consumed one per call; delay[method] makes the call take that long.
+    """
+
+    def __init__(self, bot_id: int = 999):
+        self.id = bot_id
+        self.calls = []
+        self.fail = {}
+        self.delay = {}
+        self.admins = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            self.calls.append((name, args, kwargs, time.monotonic()))
+            if self.delay.get(name):
+                await asyncio.sleep(self.delay[name])
+            err = self.fail.get(name)
+            if isinstance(err, list):
+                err = err.pop(0) if err else None
+            if err is not None:
+                raise err
+            return SimpleNamespace(message_id=len(self.calls))
+
+        return method
+
+    async def get_chat_administrators(self, chat_id):
+        return [SimpleNamespace(user=SimpleNamespace(id=uid)) for uid in self.admins.get(chat_id, ())]
+
+    def called(self, name):
+        return [c for c in self.calls if c[0] == name]
+
+
+def make_user(user_id: int, first_name: str = "", username: str = None, is_bot: bool = False):
+    first_name = first_name or f"user{user_id}"
+    return SimpleNamespace(
+        id=user_id,
+        first_name=first_name,
+        full_name=first_name,
+        username=username,
+        is_bot=is_bot,
+        mention_html=lambda: f'<a href="tg://user?id={user_id}">{first_name}</a>',
+    )
+
+
+def make_update(chat_id: int, user=None, text=None, message_id: int = 1, **message_fields):
+    chat = SimpleNamespace(id=chat_id, type="supergroup" if chat_id < 0 else "private", title=f"chat{chat_id}")
+
+    replies = []
+
+    async def delete():
+        message.deleted = True
+        return True
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(
+        message_id=message_id,
+        from_user=user,
+        text=text,
+        caption=None,
+        entities=None,
+        chat=chat,
+        delete=delete,
+        left_chat_member=None,
+        new_chat_members=None,
+        reply_to_message=None,
+        deleted=False,
+        replies=replies,
+        reply_text=reply_text,
+        reply_html=reply_text,
+    )
+    for key, value in message_fields.items():
+        setattr(message, key, value)
+    return SimpleNamespace(
+        effective_message=message,
+        effective_chat=chat,
+        effective_user=user,
+        message=message,
+        chat_member=None,
+        my_chat_member=None,
+    )
+
+
+def make_context(bot: FakeBot, args=None):
+    return SimpleNamespace(bot=bot, args=args or [], job_queue=None)
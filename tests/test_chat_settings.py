@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+import main
+
+CHAT = -600
+
+CUSTOM = {
+    "welcome": "Hello {first_name}",
+    "welcome_photo": "photo-file-id",
+    "welcome_video": "video-file-id",
+    "rules_text": "Be nice.",
+    "bye_text": "Bye {first_name}",
+    "bye_photo": "bye-photo-id",
+    "spam_limit": 7,
+    "spam_ban_reason": "custom spam reason",
+    "warn_decay_days": 0,
+    "anti_link": False,
+    "locked": True,
+    "spam_enabled": False,
+}
+
+
+def _fields(s: main.ChatSettings):
+    return {key: getattr(s, key) for key in main.SETTINGS_COLUMNS}
+
+
+async def _reload(chat_id: int) -> main.ChatSettings:
+    """Push pending writes to the DB and read the chat back from it, bypassing the cache."""
+    await main.write_queue.flush(force=True)
+    main.chat_settings_cache.pop(chat_id)
+    return await main.load_chat_settings(chat_id)
+
+
+def test_every_setting_round_trips(db):
+    start, stop = db
+    assert set(CUSTOM) == set(main.SETTINGS_COLUMNS)
+
+    async def scenario():
+        await start()
+        try:
+            s = await main.load_chat_settings(CHAT)
+            for key, value in CUSTOM.items():
+                setattr(s, key, value)
+            await main.save_chat_settings(CHAT, s)
+            await main.add_sticker_trigger(CHAT, "hello", "sticker-id")
+            return await _reload(CHAT)
+        finally:
+            await stop()
+
+    loaded = asyncio.run(scenario())
+    assert _fields(loaded) == CUSTOM
+    assert loaded.flags == main.FLAG_LOCKED
+    assert loaded.sticker_triggers == {"hello": "sticker-id"}
+    assert not loaded.dirty
+
+
+def test_new_chat_round_trips_as_defaults(db):
+    start, stop = db
+
+    async def scenario():
+        await start()
+        try:
+            await main.load_chat_settings(CHAT)
+            return await _reload(CHAT)
+        finally:
+            await stop()
+
+    loaded = asyncio.run(scenario())
+    assert _fields(loaded) == _fields(main.ChatSettings())
+    assert loaded.sticker_triggers is None
+
+
+@pytest.mark.parametrize("key,bit", [("anti_link", main.FLAG_ANTI_LINK), ("locked", main.FLAG_LOCKED), ("spam_enabled", main.FLAG_SPAM)])
+def test_each_flag_bit_round_trips_alone(db, key, bit):
+    start, stop = db
+    default_flags = main.ChatSettings().flags
+
+    async def scenario():
+        await start()
+        try:
+            s = await main.load_chat_settings(CHAT)
+            setattr(s, key, not getattr(s, key))
+            await main.save_chat_settings(CHAT, s)
+            return await _reload(CHAT)
+        finally:
+            await stop()
+
+    loaded = asyncio.run(scenario())
+    assert loaded.flags == default_flags ^ bit
+
+
+def test_only_changed_columns_are_written(db):
+    start, stop = db
+
+    async def scenario():
+        await start()
+        try:
+            s = await main.load_chat_settings(CHAT)
+            s.rules_text = "first"
+            await main.save_chat_settings(CHAT, s)
+            await main.write_queue.flush(force=True)
+            # another writer changes a column this copy never touched
+            async with main.db_pool.write() as db_:
+                await db_.execute("UPDATE chat_settings SET bye_text='from elsewhere' WHERE chat_id=?", (CHAT,))
+            s.spam_limit = 11
+            assert s.take_dirty() == {"spam_limit": 11}
+            s.spam_limit = 11
+            await main.save_chat_settings(CHAT, s)
+            return await _reload(CHAT)
+        finally:
+            await stop()
+
+    loaded = asyncio.run(scenario())
+    assert (loaded.rules_text, loaded.bye_text, loaded.spam_limit) == ("first", "from elsewhere", 11)
+
+
+def test_save_after_eviction_keeps_the_change(db):
+    start, stop = db
+
+    async def scenario():
+        await start()
+        try:
+            s = await main.load_chat_settings(CHAT)
+            s.rules_text = "set while evicted"
+            # the entry is evicted while the handler awaits a Telegram call
+            main.chat_settings_cache.pop(CHAT)
+            await main.save_chat_settings(CHAT, s)
+            return await _reload(CHAT)
+        finally:
+            await stop()
+
+    assert asyncio.run(scenario()).rules_text == "set while evicted"
+
+
+def test_ttl_expiry_drops_the_trigger_matcher(monkeypatch):
+    cache = main.SettingsCache(8, ttl=60, on_evict=main.trigger_matchers.pop)
+    cache[CHAT] = main.ChatSettings()
+    main.get_trigger_matcher(CHAT, {"hi": "sticker-id"})
+    now = main.time.monotonic()
+    monkeypatch.setattr(main.time, "monotonic", lambda: now + 61)
+    assert cache.lookup(CHAT) is None
+    assert CHAT not in main.trigger_matchers
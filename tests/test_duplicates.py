@@ -0,0 +1,59 @@
+import asyncio
+
+import main
+from helpers import FakeBot, make_context, make_update, make_user
+
+CHAT = -500
+ADMIN = 1
+SPAM = "Join our amazing crypto giveaway now and win free tokens, limited offer for the first 100 members"
+
+
+def _flood(bot, senders):
+    updates = []
+
+    async def scenario():
+        for i, uid in enumerate(senders, start=1):
+            update = make_update(CHAT, make_user(uid), text=SPAM if i % 2 else SPAM + " hurry", message_id=i)
+            updates.append(update)
+            await main.on_message(update, make_context(bot))
+        await main.side_effects.drain()
+
+    return updates, scenario
+
+
+def test_near_duplicates_from_distinct_users_are_bulk_deleted(db):
+    start, stop = db
+    bot = FakeBot()
+    updates, flood = _flood(bot, [10, 11, 12, 13])
+
+    async def scenario():
+        await start()
+        try:
+            await flood()
+        finally:
+            await stop()
+
+    asyncio.run(scenario())
+    assert [u.effective_message.deleted for u in updates] == [False, False, True, True]
+    [(_, args, _, _)] = bot.called("delete_messages")
+    assert args == (CHAT, [1, 2])
+
+
+def test_admin_copies_neither_count_nor_swallow_the_flood(db):
+    start, stop = db
+    bot = FakeBot()
+    bot.admins[CHAT] = {ADMIN}
+    updates, flood = _flood(bot, [10, 11, ADMIN, 12])
+
+    async def scenario():
+        await start()
+        try:
+            await flood()
+        finally:
+            await stop()
+
+    asyncio.run(scenario())
+    # the admin's copy is left alone and the third *non-admin* sender completes the flood
+    assert [u.effective_message.deleted for u in updates] == [False, False, False, True]
+    [(_, args, _, _)] = bot.called("delete_messages")
+    assert args == (CHAT, [1, 2])
@@ -0,0 +1,73 @@
+import asyncio
+
+import main
+from helpers import FakeBot, make_context, make_update, make_user
+
+CHAT = -700
+BOT_SENDER = 50
+ADMIN = 1
+
+
+def _post(bot, user, text, message_id=1):
+    update = make_update(CHAT, user, text=text, message_id=message_id)
+
+    async def scenario():
+        await main.on_message(update, make_context(bot))
+        await main.side_effects.drain()
+
+    return update, scenario
+
+
+def test_bots_are_held_to_anti_link_but_not_profanity(db):
+    start, stop = db
+    bot = FakeBot()
+    sender = make_user(BOT_SENDER, "Relay", is_bot=True)
+    link, post_link = _post(bot, sender, "see https://example.com", message_id=1)
+    swear, post_swear = _post(bot, sender, "well shit", message_id=2)
+
+    async def scenario():
+        await start()
+        try:
+            await post_link()
+            await post_swear()
+            return await main.get_warns(CHAT, BOT_SENDER)
+        finally:
+            await stop()
+
+    warns = asyncio.run(scenario())
+    assert link.effective_message.deleted
+    assert not swear.effective_message.deleted
+    assert warns == 1
+
+
+def test_admins_are_exempt_from_anti_link(db):
+    start, stop = db
+    bot = FakeBot()
+    bot.admins[CHAT] = {ADMIN}
+    link, post_link = _post(bot, make_user(ADMIN, "Owner"), "see https://example.com")
+
+    async def scenario():
+        await start()
+        try:
+            await post_link()
+        finally:
+            await stop()
+
+    asyncio.run(scenario())
+    assert not link.effective_message.deleted
+
+
+def test_admin_cache_sweep_forgets_expired_rosters():
+    bot = FakeBot()
+    bot.admins[CHAT] = {ADMIN}
+    cache = main.AdminCache(ttl=60)
+
+    async def scenario():
+        await cache.get_admins(bot, CHAT)
+        await cache.get_admins(bot, CHAT - 1)
+        cache.invalidate(CHAT - 1)
+        now = main.time.monotonic()
+        return cache.sweep(now), cache.sweep(now + 61)
+
+    assert asyncio.run(scenario()) == (0, 1)
+    assert not cache._rosters and not cache._generation
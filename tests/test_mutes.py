@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+from helpers import FakeBot
+
+CHAT = -800
+USER = 3
+
+
+def test_expiry_clears_a_mute_still_waiting_in_the_write_queue(db):
+    start, stop = db
+    bot = FakeBot()
+    scheduler = main.MuteScheduler()
+
+    async def scenario():
+        await start()
+        try:
+            await scheduler.start(bot)
+            now = int(main.time.time())
+            # a short mute whose row has not been written yet when it expires
+            main.write_queue.put_mute(CHAT, USER, now - 1)
+            await scheduler._expire([(CHAT, USER)], now)
+            await main.write_queue.flush(force=True)
+            async with main.db_pool.read() as conn:
+                return await conn.execute_fetchall("SELECT * FROM mutes")
+        finally:
+            await scheduler.stop()
+            await stop()
+
+    assert asyncio.run(scenario()) == []
+    assert [c[1][:2] for c in bot.called("restrict_chat_member")] == [(CHAT, USER)]
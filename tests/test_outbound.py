@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+import main
+from helpers import FakeBot, make_context, make_update, make_user
+
+
+def test_bye_does_not_wait_for_a_throttled_chat(db):
+    start, stop = db
+    bot = FakeBot()
+
+    async def scenario():
+        await start()
+        main.outbound = main.OutboundScheduler(global_rate=100, chat_per_min=2)
+        main.outbound.start()
+        try:
+            began = time.monotonic()
+            for i in range(6):
+                update = make_update(-300, make_user(i), left_chat_member=make_user(i))
+                await main.on_member_left(update, make_context(bot))
+            handler_time = time.monotonic() - began
+            await asyncio.sleep(0.05)
+        finally:
+            await main.outbound.stop()
+            await stop()
+        return handler_time
+
+    handler_time = asyncio.run(scenario())
+    # the chat budget covers 2 goodbyes; the other 4 stay queued instead of blocking the handler
+    assert handler_time < 0.5
+    assert len(bot.called("send_message")) == 2
+
+
+def test_post_runs_fallback_when_the_call_fails():
+    bot = FakeBot()
+    bot.fail["send_sticker"] = RuntimeError("sticker gone")
+
+    async def scenario():
+        sched = main.OutboundScheduler(global_rate=100, chat_per_min=60)
+        sched.start()
+        sched.post(
+            main.PRIO_REPLY,
+            -1,
+            bot.send_sticker,
+            -1,
+            "file",
+            fallback=lambda: sched.post(main.PRIO_REPLY, -1, bot.send_message, -1, "(sticker unavailable)"),
+        )
+        await asyncio.sleep(0.05)
+        await sched.stop()
+
+    asyncio.run(scenario())
+    assert [c[0] for c in bot.calls] == ["send_sticker", "send_message"]
+
+
+def test_lanes_are_served_by_priority():
+    bot = FakeBot()
+
+    async def scenario():
+        sched = main.OutboundScheduler(global_rate=100, chat_per_min=60, max_inflight=1)
+        sched.start()
+        # all queued before the scheduler task first runs
+        futures = [
+            sched.submit(main.PRIO_BULK, -1, bot.unban_chat_member, "bulk"),
+            sched.submit(main.PRIO_NOTICE, -1, bot.send_message, "notice"),
+            sched.submit(main.PRIO_REPLY, -1, bot.send_sticker, "reply"),
+            sched.submit(main.PRIO_ENFORCE, -1, bot.delete_message, "enforce"),
+        ]
+        await asyncio.gather(*futures)
+        await sched.stop()
+
+    asyncio.run(scenario())
+    assert [c[1][0] for c in bot.calls] == ["enforce", "reply", "notice", "bulk"]
+
+
+def test_retry_after_pauses_only_that_chat_and_retries():
+    bot = FakeBot()
+    bot.fail["send_message"] = [RetryAfter(0)]
+
+    async def scenario():
+        sched = main.OutboundScheduler(global_rate=100, chat_per_min=60)
+        sched.start()
+        began = time.monotonic()
+        limited = sched.submit(main.PRIO_REPLY, -1, bot.send_message, -1, "first")
+        await asyncio.sleep(0.05)
+        other = await sched.call(main.PRIO_REPLY, -2, bot.send_sticker, -2, "other chat")
+        queued_behind = sched.submit(main.PRIO_ENFORCE, -1, bot.delete_message, -1, 5)
+        result = await limited
+        await queued_behind
+        await sched.stop()
+        return began, other, result
+
+    began, other, result = asyncio.run(scenario())
+    first, other_call, enforce, retry = bot.calls
+    assert (first[0], other_call[0]) == ("send_message", "send_sticker")
+    # the 429 pauses chat -1 (RetryAfter + 1s backoff on the first attempt); chat -2 is untouched
+    assert other_call[3] - began < 0.5
+    # the paused chat's ENFORCE call waits out the pause too, then still goes ahead of the retried reply
+    assert enforce[0] == "delete_message" and enforce[3] - first[3] >= 1.0
+    assert retry[0] == "send_message" and retry[3] >= enforce[3]
+    assert other is not None and result is not None
+
+
+def test_chat_budget_limits_messages_but_not_enforcement():
+    bot = FakeBot()
+
+    async def scenario():
+        sched = main.OutboundScheduler(global_rate=100, chat_per_min=3)
+        sched.start()
+        for i in range(5):
+            sched.post(main.PRIO_NOTICE, -1, bot.send_message, -1, f"notice {i}")
+            sched.post(main.PRIO_ENFORCE, -1, bot.delete_message, -1, i)
+        sched.post(main.PRIO_NOTICE, -2, bot.send_message, -2, "other chat")
+        await asyncio.sleep(0.2)
+        await sched.stop()
+
+    asyncio.run(scenario())
+    sent = [c[1] for c in bot.called("send_message")]
+    assert sent == [(-1, "notice 0"), (-1, "notice 1"), (-1, "notice 2"), (-2, "other chat")]
+    assert len(bot.called("delete_message")) == 5
@@ -0,0 +1,72 @@
+import asyncio
+
+import main
+from helpers import FakeBot, make_context, make_update, make_user
+
+CHAT = -700
+
+
+def _join(bot, *user_ids):
+    update = make_update(CHAT, make_user(user_ids[0]), new_chat_members=[make_user(u) for u in user_ids])
+    return main.on_member_join(update, make_context(bot))
+
+
+def test_join_burst_locks_restricts_and_unlocks(db):
+    start, stop = db
+    bot = FakeBot()
+    main.raid_guard = main.RaidGuard(threshold=3, window=60, cooldown=1)
+    main.welcome_batcher = main.WelcomeBatcher(delay_ms=200)
+
+    async def scenario():
+        await start()
+        try:
+            await _join(bot, 1)
+            await _join(bot, 2)
+            assert not main.raid_guard.active(CHAT)
+            await _join(bot, 3, 4, 5)  # 5 joins in the window > threshold of 3
+            await _join(bot, 6)  # arrives during the raid
+            await asyncio.sleep(0)
+            during = {
+                "active": main.raid_guard.active(CHAT),
+                "locked": (await main.load_chat_settings(CHAT)).locked,
+                "restricted": [c[1][1] for c in bot.called("restrict_chat_member")],
+                "permissions": [c[1][1].can_send_messages for c in bot.called("set_chat_permissions")],
+            }
+            await main.write_queue.flush(force=True)
+            async with main.db_pool.read() as conn:
+                [(raid_until, raid_locked)] = await conn.execute_fetchall(
+                    "SELECT raid_until, raid_locked FROM chat_settings WHERE chat_id=?", (CHAT,)
+                )
+            during["persisted"] = (raid_until > 0, raid_locked)
+
+            await asyncio.sleep(1.3)  # cooldown elapses
+            after = {
+                "active": main.raid_guard.active(CHAT),
+                "locked": (await main.load_chat_settings(CHAT)).locked,
+                "permissions": [c[1][1].can_send_messages for c in bot.called("set_chat_permissions")],
+            }
+            await main.write_queue.flush(force=True)
+            async with main.db_pool.read() as conn:
+                after["persisted"] = (await conn.execute_fetchall(
+                    "SELECT raid_until, raid_locked FROM chat_settings WHERE chat_id=?", (CHAT,)
+                ))[0]
+        finally:
+            await main.raid_guard.stop()
+            await main.welcome_batcher.stop()
+            await stop()
+        return during, after
+
+    during, after = asyncio.run(scenario())
+    assert during == {
+        "active": True,
+        "locked": True,
+        # the burst that tipped the window and every later joiner; the first two were let in
+        "restricted": [3, 4, 5, 6],
+        "permissions": [False],
+        "persisted": (True, 1),
+    }
+    assert after == {"active": False, "locked": False, "permissions": [False, True], "persisted": (0, 0)}
+    notices = [c[1][1] for c in bot.called("send_message")]
+    # the pending welcome for the first two joiners was discarded when the raid started
+    assert notices[0].startswith("🚨 Join raid detected") and notices[-1] == "Raid mode ended. Chat unlocked."
+    assert len(notices) == 2
@@ -0,0 +1,54 @@
+import asyncio
+
+import main
+from helpers import FakeBot, make_context, make_update, make_user
+
+CHAT = -400
+ADMIN = 1
+USER = 2
+
+
+def test_unban_rearms_the_warn_limit(db):
+    start, stop = db
+    bot = FakeBot()
+    bot.admins[CHAT] = {ADMIN}
+
+    async def scenario():
+        await start()
+        try:
+            first = [await main.add_warn(CHAT, USER, "link") for _ in range(main.WARN_BAN_LIMIT + 1)]
+            update = make_update(CHAT, make_user(ADMIN))
+            await main.unban_cmd(update, make_context(bot, [str(USER)]))
+            # the cleared events must be gone from the DB too, not just the cache
+            await main.write_queue.flush()
+            main.warn_history.clear()
+            after_unban = await main.get_warns(CHAT, USER)
+            second = [await main.add_warn(CHAT, USER, "link") for _ in range(main.WARN_BAN_LIMIT)]
+        finally:
+            await stop()
+        return first, update.effective_message.replies, after_unban, second
+
+    first, replies, after_unban, second = asyncio.run(scenario())
+    assert [crossed for _, crossed in first] == [False] * (main.WARN_BAN_LIMIT - 1) + [True, False]
+    assert replies == [f"User {USER} has been unbanned."]
+    assert after_unban == 0
+    assert second[-1] == (main.WARN_BAN_LIMIT, True)
+
+
+def test_clear_is_ordered_before_newer_events(db):
+    start, stop = db
+
+    async def scenario():
+        await start()
+        try:
+            await main.add_warn(CHAT, USER, "link")
+            await main.write_queue.flush()
+            await main.add_warn(CHAT, USER, "link")
+            await main.reset_warns(CHAT, USER)
+            await main.add_warn(CHAT, USER, "spam")
+            main.warn_history.clear()
+            return await main.get_warns(CHAT, USER)
+        finally:
+            await stop()
+
+    assert asyncio.run(scenario()) == 1
@@ -0,0 +1,67 @@
+import asyncio
+
+import main
+from helpers import FakeBot, make_user
+
+
+def test_welcome_text_uses_cached_settings():
+    s = main.ChatSettings()
+    s.welcome = "Hi {first_name} ({username})"
+    main.chat_settings_cache[-100] = s
+    text = main.pretty_welcome_text(-100, "Ann", "ann")
+    assert "<b>Message:</b> Hi Ann (@ann)" in text
+    assert "ENJOY YOUR STAY, Ann!" in text
+
+
+def test_welcome_text_without_cached_settings():
+    text = main.pretty_welcome_text(-101, "Bob", None)
+    assert text.endswith(main.WELCOME_FALLBACK.format(first_name="Bob"))
+
+
+def test_last_welcome_ids_are_capped_and_forgotten(db):
+    start, stop = db
+    bot = FakeBot()
+    batcher = main.WelcomeBatcher(delay_ms=0, max_chats=2)
+
+    async def scenario():
+        await start()
+        try:
+            for chat_id in (-1, -2, -3):
+                batcher.add(bot, chat_id, [make_user(chat_id)], None)
+                await asyncio.sleep(0.05)
+            kept = list(batcher._last_welcome)
+            batcher.forget(-3)
+            return kept, list(batcher._last_welcome)
+        finally:
+            await batcher.stop()
+            await stop()
+
+    kept, after_forget = asyncio.run(scenario())
+    assert kept == [-2, -3]
+    assert after_forget == [-2]
+
+
+def test_cancelled_timer_leaves_the_newer_one_alone(db):
+    start, stop = db
+    bot = FakeBot()
+    batcher = main.WelcomeBatcher(delay_ms=100)
+
+    async def scenario():
+        await start()
+        try:
+            batcher.add(bot, -1, [make_user(1)], None)
+            await asyncio.sleep(0)
+            batcher.discard(-1)
+            batcher.add(bot, -1, [make_user(2)], None)
+            newer = batcher._timers[-1]
+            await asyncio.sleep(0)  # the cancelled timer unwinds
+            still_pending = batcher._timers.get(-1) is newer
+            await asyncio.sleep(0.2)
+            return still_pending, [c[2]["text"] for c in bot.called("send_message")]
+        finally:
+            await batcher.stop()
+            await stop()
+
+    still_pending, sent = asyncio.run(scenario())
+    assert still_pending
+    assert len(sent) == 1